@@ -0,0 +1,174 @@
+"""
+Streaming extraction from Document AI batch output shards.
+
+An output shard is one JSON Document whose layout (pages, blocks, lines,
+tokens with bounding boxes and confidences) is many times larger than its
+text. Only the text, the shard info and, when asked for, each page's text
+span are kept:
+
+  - 'shardInfo' comes after the layout; read_shard_info takes it from a
+    ranged read of the object's tail, and only falls back to streaming the
+    whole object if it is not there.
+  - Document AI writes fields in proto field order, so the top-level 'text'
+    comes before 'pages'. Without page spans (template samples), read_text
+    streams the object with ijson and stops as soon as the text has been
+    parsed, so the layout is never downloaded.
+  - Page spans are the first text anchor after each page's pageNumber (the
+    page's own layout comes before its blocks, lines and tokens). They need
+    the whole layout, so read_text_and_pages streams the object once: the
+    bytes ijson reads for the text also go through a byte-level scan for
+    the anchors, which then carries on over the rest of the object instead
+    of parsing the layout (that would cost several times the download).
+
+A shard with page spans is therefore read once plus its tail; one without
+is read up to the end of its text plus its tail. Memory stays at one read
+buffer plus the text, however large the layout is.
+"""
+import json
+import re
+
+import ijson
+
+READ_CHUNK_BYTES = 1024 * 1024
+# The fields after the layout (shardInfo, revisions, error) fit well within this.
+TAIL_BYTES = 64 * 1024
+
+_SHARD_INFO_KEY = re.compile(rb'"shardInfo"\s*:\s*')
+_PAGE_NUMBER = re.compile(rb'"pageNumber"\s*:\s*"?\d+"?\s*[,}]')
+_TEXT_SEGMENTS = re.compile(rb'"textSegments"\s*:\s*(\[[^\]]*\])')
+# Enough to hold a match cut off at the end of a read.
+_SCAN_CARRY_BYTES = 4096
+
+
+def _open(blob):
+    return blob.open("rb", chunk_size=READ_CHUNK_BYTES)
+
+
+def read_text(blob):
+    """Returns the document text, reading the object only as far as the end of the text."""
+    with _open(blob) as stream:
+        for text in ijson.items(stream, "text", buf_size=READ_CHUNK_BYTES):
+            return text
+    return ""
+
+
+def _shard_info_from_tail(tail):
+    matches = list(_SHARD_INFO_KEY.finditer(tail))
+    if not matches:
+        return None
+    try:
+        value, _ = json.JSONDecoder().raw_decode(tail[matches[-1].end():].decode("utf-8", errors="replace"))
+    except ValueError:
+        return None
+    return value if isinstance(value, dict) else None
+
+
+def read_shard_info(blob, size):
+    """
+    Returns (shard_index, shard_count). Proto JSON writes int64 fields as
+    strings and leaves out zero values.
+    """
+    tail = blob.download_as_bytes(start=max(0, size - TAIL_BYTES))
+    info = _shard_info_from_tail(tail)
+    if info is None and size > TAIL_BYTES:
+        print("shardInfo not found in the output's tail; streaming the whole shard.")
+        with _open(blob) as stream:
+            info = next(ijson.items(stream, "shardInfo", buf_size=READ_CHUNK_BYTES), None)
+    info = info or {}
+    return int(info.get("shardIndex", 0)), int(info.get("shardCount", 1) or 1)
+
+
+def _segments_span(raw):
+    segments = json.loads(raw)
+    if not segments:
+        return None
+    return min(int(s.get("startIndex", 0)) for s in segments), max(int(s.get("endIndex", 0)) for s in segments)
+
+
+def _search_key(pattern, buffer, position, end=None):
+    """Finds the next `pattern` key outside the text, where key-like strings have escaped quotes."""
+    while True:
+        match = pattern.search(buffer, position, len(buffer) if end is None else end)
+        if match is None or match.start() == 0 or buffer[match.start() - 1] != 0x5C:  # backslash
+            return match
+        position = match.end()
+
+
+class _PageScanner:
+    """
+    Collects each page's (start, end) text span, relative to the shard's
+    text, from the object's bytes as they are fed in. Proto JSON leaves out
+    a zero startIndex; pages without text have no anchor and are left out.
+    """
+
+    def __init__(self):
+        self.spans = []
+        self._in_page = False
+        self._buffer = b""
+
+    def feed(self, data):
+        buffer = self._buffer + data
+        position = 0
+        while True:
+            if not self._in_page:
+                page = _search_key(_PAGE_NUMBER, buffer, position)
+                if page is None:
+                    break
+                self._in_page, position = True, page.end()
+            segments = _search_key(_TEXT_SEGMENTS, buffer, position)
+            # A page that comes first means the previous page had no text anchor.
+            page = _search_key(_PAGE_NUMBER, buffer, position, segments.start() if segments else None)
+            if page is not None:
+                position = page.end()
+                continue
+            if segments is None:
+                break
+            span = _segments_span(segments.group(1))
+            if span is not None:
+                self.spans.append(span)
+            self._in_page, position = False, segments.end()
+        self._buffer = buffer[position if self._in_page else max(position, len(buffer) - _SCAN_CARRY_BYTES):]
+
+
+class _ScannedStream:
+    """Passes reads through to `stream`, feeding every chunk to `scanner` on the way."""
+
+    def __init__(self, stream, scanner):
+        self._stream = stream
+        self._scanner = scanner
+
+    def read(self, size=-1):
+        data = self._stream.read(size)
+        self._scanner.feed(data)
+        return data
+
+
+def read_text_and_pages(blob):
+    """
+    Returns (text, [(start, end)]) in one streaming pass: the text is parsed
+    from the front of the object while the page scan reads every byte.
+    """
+    scanner = _PageScanner()
+    with _open(blob) as stream:
+        text = next(ijson.items(_ScannedStream(stream, scanner), "text", buf_size=READ_CHUNK_BYTES), "")
+        while True:
+            data = stream.read(READ_CHUNK_BYTES)
+            if not data:
+                break
+            scanner.feed(data)
+    return text, scanner.spans
+
+
+def extract_shard(blob, size, with_pages=False):
+    """
+    Extracts one output shard. Returns a dict with 'text', 'shard_index',
+    'shard_count' and, with `with_pages`, 'pages' (each page's text span;
+    see read_text_and_pages).
+    """
+    shard_index, shard_count = read_shard_info(blob, size)
+    shard = {"shard_index": shard_index, "shard_count": shard_count}
+    if with_pages:
+        shard["text"], shard["pages"] = read_text_and_pages(blob)
+    else:
+        shard["text"] = read_text(blob)
+    return shard
@@ -1,9 +1,120 @@
 import functions_framework
-from google.cloud import storage, firestore
-import json
+from google.cloud import firestore
 import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+from docai_json import extract_shard
+from shared.bulk_batches import BULK_BATCH_COLLECTION, is_bulk_output, parse_bulk_output
+from shared.idempotency import EventLease
+from shared.instrumentation import StageRecorder, resolve_trace_id
+from shared.page_index import SOURCE_MD5_KEY, build_page_index, upload_page_index
+from shared.pipeline_state import DEFAULT_PROGRESS_INTERVAL_SECONDS, TEXT_EXTRACTED, StageWrites, status_fields
+from shared.runtime import get_firestore_client, get_storage_client
 
 OUTPUT_TEXT_BUCKET_NAME = "sow-forge-texas-dmv-processed-text"
+# Tracks which output shards of a batch operation have been extracted.
+SHARD_PROGRESS_COLLECTION = "batch_shard_progress"
+# Progress documents carry an 'expires_at' field for the Firestore TTL policy.
+SHARD_PROGRESS_RETENTION = timedelta(days=7)
+TEXT_PARTS_DIR = "text-parts"
+# A claim to assemble the document that has not led to assembled_at within
+# this long is taken to have died with its invocation.
+ASSEMBLY_CLAIM_SECONDS = 600
+# bulk_batches input mappings never change once submitted, so warm instances keep them.
+_bulk_batch_documents = {}
+
+
+def resolve_bulk_document(db, file_name):
+    """Returns the sows id for one output file of a multi-document bulk batch, or None."""
+    parsed = parse_bulk_output(file_name)
+    if parsed is None:
+        return None
+    batch_id, input_index = parsed
+    documents = _bulk_batch_documents.get(batch_id)
+    if documents is None:
+        snapshot = db.collection(BULK_BATCH_COLLECTION).document(batch_id).get()
+        if not snapshot.exists:
+            return None
+        documents = (snapshot.to_dict() or {}).get("documents", {})
+        _bulk_batch_documents[batch_id] = documents
+    return (documents.get(input_index) or {}).get("doc_id")
+
+
+@firestore.transactional
+def record_shard(transaction, progress_ref, sow_ref, shard_index, shard_count, part_name, page_spans, owner):
+    """
+    Marks one output shard as extracted, with its pages' (start, end) spans.
+    Returns the ordered list of (part name, page spans) if this call
+    completed the set and holds the claim to assemble the document,
+    otherwise None. The claim belongs to `owner` (the shard's output file),
+    so a redelivery of the event that failed to assemble claims it again;
+    the document counts as assembled only once mark_assembled has run after
+    the text was uploaded. The shard counters on the sows document are
+    refreshed at most once per progress interval.
+    """
+    snapshot = progress_ref.get(transaction=transaction)
+    progress = snapshot.to_dict() if snapshot.exists else {}
+    parts = dict(progress.get("parts", {}))
+    parts[str(shard_index)] = part_name
+    # Firestore has no nested arrays, so each shard's spans are stored flattened.
+    pages = dict(progress.get("pages", {}))
+    pages[str(shard_index)] = [offset for span in page_spans for offset in span]
+
+    now = time.time()
+    claim_owner = progress.get("assembly_owner")
+    claim_free = (
+        claim_owner is None or claim_owner == owner
+        or now - progress.get("assembly_claimed_at", 0) >= ASSEMBLY_CLAIM_SECONDS
+    )
+    complete = len(parts) >= shard_count and not progress.get("assembled_at") and claim_free
+    write_sow_progress = sow_ref is not None and (
+        now - progress.get("sow_progress_written_at", 0) >= DEFAULT_PROGRESS_INTERVAL_SECONDS
+    )
+    progress_update = {
+        "shard_count": shard_count,
+        "parts": parts,
+        "pages": pages,
+        "last_updated_at": firestore.SERVER_TIMESTAMP,
+        "expires_at": datetime.now(timezone.utc) + SHARD_PROGRESS_RETENTION,
+    }
+    if complete:
+        progress_update["assembly_owner"] = owner
+        progress_update["assembly_claimed_at"] = now
+    if write_sow_progress:
+        progress_update["sow_progress_written_at"] = now
+    transaction.set(progress_ref, progress_update, merge=True)
+    if write_sow_progress:
+        transaction.set(sow_ref, {
+            "ocr_shard_count": shard_count,
+            "ocr_shards_completed": len(parts),
+            "last_updated_at": firestore.SERVER_TIMESTAMP,
+        }, merge=True)
+
+    if not complete:
+        return None
+    flat_spans = [pages.get(str(i), []) for i in range(shard_count)]
+    return [(parts[str(i)], list(zip(flat_spans[i][::2], flat_spans[i][1::2]))) for i in range(shard_count)]
+
+
+def mark_assembled(writes, progress_ref):
+    """Records that the assembled text was written, ending the assembly claim."""
+    writes.set_fields(progress_ref, {"assembled_at": firestore.SERVER_TIMESTAMP})
+
+
+def assemble_parts(bucket, parts):
+    """
+    Downloads the per-shard text parts concurrently and joins them in page
+    order. Returns the text and its pages' spans.
+    """
+    with ThreadPoolExecutor(max_workers=min(8, len(parts))) as executor:
+        texts = list(executor.map(lambda part: bucket.blob(part[0]).download_as_text(), parts))
+    page_spans, offset = [], 0
+    for text, (_, spans) in zip(texts, parts):
+        page_spans.extend((start + offset, end + offset) for start, end in spans)
+        offset += len(text)
+    return "".join(texts), page_spans
+
 
 @functions_framework.cloud_event
 def handle_batch_result(cloud_event):
@@ -18,61 +129,163 @@ def handle_batch_result(cloud_event):
 
     print(f"--- BATCH HANDLER START: Processing result file gs://{bucket_name}/{file_name} ---")
 
-    storage_client = storage.Client()
-    db = firestore.Client()
-    
+    storage_client = get_storage_client()
+    db = get_firestore_client()
+
+    # Redelivered shard events exit here instead of re-downloading the shard.
+    lease = EventLease(db, "handle_batch_result", data)
+    if not lease.acquire():
+        return
+
+    recorder = StageRecorder("handle_batch_result")
+    # Timings are saved by the invocation that finishes the document; the others only log them.
+    timings_ref = None
+    # Timings and the lease state are committed together once the invocation ends.
+    writes = StageWrites(db)
+
     try:
-        # 1. Read the JSON output file from GCS
+        # Single-document batches write under {doc_id}/; bulk batches under
+        # bulk/{batch_id}/, with the input index leading to the document.
+        is_bulk = is_bulk_output(file_name)
+        if is_bulk:
+            with recorder.stage("firestore.read"):
+                doc_id = resolve_bulk_document(db, file_name)
+            if doc_id is None:
+                print(f"Warning: '{file_name}' does not belong to a known bulk batch. Exiting.")
+                lease.complete(writes)
+                return
+        else:
+            # '{doc_id}/<operation>/<input index>/<name>-<shard>.json'; ids keep the upload's folders.
+            parts = file_name.split('/')
+            doc_id = '/'.join(parts[:-3]) if len(parts) > 3 else parts[0]
+        recorder.doc_id = doc_id
+        is_template_job = doc_id.startswith('template_job_')
+
+        # process_pdf (or bulk ingestion) recorded the trace and the source PDF's hash.
+        sow_data = {}
+        if not is_template_job:
+            with recorder.stage("firestore.read"):
+                sow_data = db.collection("sows").document(doc_id).get().to_dict() or {}
+            recorder.trace_id = resolve_trace_id(sow_data)
+
+        # 1. Read this shard's text, shard info and page spans from the JSON
+        # output file without loading its layout into memory (see
+        # docai_json.py). Large documents are split by Document AI into
+        # several JSON shards ({name}-0.json, {name}-1.json, ...), each holding
+        # the text of its own page range. Template samples need no page index.
         source_bucket = storage_client.bucket(bucket_name)
         blob = source_bucket.blob(file_name)
-        json_text = blob.download_as_text()
-        result_data = json.loads(json_text)
+        with recorder.stage("gcs.download") as span:
+            size = int(data.get("size") or 0)
+            if not size:
+                blob.reload()
+                size = blob.size
+            shard = extract_shard(blob, size, with_pages=not is_template_job)
+            span["object_bytes"] = size
 
-        # 2. Extract the full text directly from this file's content
-        # The full text is already aggregated in the 'text' field of the main document object
-        full_text = result_data.get('text', '')
-        
-        print(f"Extracted {len(full_text)} characters of text from the result file.")
+        # 2. This shard's text and its place in the document.
+        shard_text = shard["text"]
+        shard_index = shard["shard_index"]
+        shard_count = shard["shard_count"]
 
-        if not full_text:
-            print("Warning: No text found in the result file. Exiting.")
-            return
+        print(f"Extracted {len(shard_text)} characters of text from shard {shard_index + 1}/{shard_count}.")
 
         # 3. Prepare for the next stage
-        original_filename_base = file_name.split('/')[0]
-        output_filename = f"{original_filename_base}.txt"
+        output_filename = f"{doc_id}.txt"
 
-        # ... (the rest of the code to save to Firestore and the output bucket is correct) ...
-        
-        doc_id = original_filename_base
-        is_template_job = doc_id.startswith('template_job_')
+        progress_ref = None
+        if shard_count == 1:
+            full_text = shard_text
+            page_spans = shard.get("pages", [])
+        else:
+            # Stash this shard's text, then let whichever shard finishes last assemble the document.
+            output_dir = os.path.dirname(file_name)
+            part_name = f"{output_dir}/{TEXT_PARTS_DIR}/{shard_index:05d}.txt"
+            with recorder.stage("gcs.upload", bytes=len(shard_text.encode("utf-8"))):
+                source_bucket.blob(part_name).upload_from_string(shard_text)
+
+            progress_ref = db.collection(SHARD_PROGRESS_COLLECTION).document(output_dir.replace('/', '__'))
+            sow_ref = None if is_template_job else db.collection("sows").document(doc_id)
+            with recorder.stage("firestore.transaction"):
+                parts = record_shard(
+                    db.transaction(), progress_ref, sow_ref, shard_index, shard_count, part_name, shard.get("pages", []),
+                    file_name
+                )
+            if parts is None:
+                print(f"Shard {shard_index + 1}/{shard_count} recorded; waiting for the remaining shards.")
+                lease.complete(writes)
+                return
+            print(f"All {shard_count} shards extracted. Assembling document text in page order.")
+            with recorder.stage("gcs.assemble_parts", parts=len(parts)):
+                full_text, page_spans = assemble_parts(source_bucket, parts)
 
+        if not full_text:
+            print("Warning: No text found in the result file. Exiting.")
+            if progress_ref is not None:
+                mark_assembled(writes, progress_ref)
+            lease.complete(writes)
+            return
+
+        # The status is committed before the text is uploaded, so it can never
+        # overwrite the ANALYZING status the upload leads to.
+        status_writes = StageWrites(db)
         if not is_template_job:
             doc_ref = db.collection("sows").document(doc_id)
-            # --- Create a complete document so the UI displays it correctly ---
-            doc_ref.set({
-                "original_filename": f"{doc_id}.pdf", # Re-construct original name
-                "display_name": f"{doc_id}.pdf",
-                "status": "TEXT_EXTRACTED",
-                "processing_method": "batch",
-                "created_at": firestore.SERVER_TIMESTAMP,
-                "last_updated_at": firestore.SERVER_TIMESTAMP
-            }, merge=True)
-            print(f"Created/updated SOW document with ID: {doc_id}")
-        
+            timings_ref = doc_ref
+            if is_bulk:
+                # Bulk ingestion created the full record before submitting the batch.
+                status_writes.set_fields(doc_ref, status_fields(TEXT_EXTRACTED))
+            else:
+                # --- Create a complete document so the UI displays it correctly ---
+                status_writes.set_fields(doc_ref, status_fields(
+                    TEXT_EXTRACTED,
+                    original_filename=f"{doc_id}.pdf", # Re-construct original name
+                    display_name=f"{doc_id}.pdf",
+                    processing_method="batch",
+                    created_at=firestore.SERVER_TIMESTAMP,
+                ))
+
         # This part is still relevant for the aggregator function
         if is_template_job:
             job_id = doc_id.split('_')[2]
             job_ref = db.collection('template_jobs').document(job_id)
-            job_ref.update({f'processed_files.{doc_id}': 'Text extracted, ready for aggregation.'})
-            print(f"Updated template job: {job_id}")
+            status_writes.set_fields(job_ref, {f'processed_files.{doc_id}': 'Text extracted, ready for aggregation.'})
+
+        with recorder.stage("firestore.write"):
+            status_writes.commit()
+        print(f"Created/updated {'template job' if is_template_job else 'SOW document'} for: {doc_id}")
 
         output_bucket = storage_client.bucket(OUTPUT_TEXT_BUCKET_NAME)
+        if not is_template_job:
+            # The page index goes first so analyze_text, triggered by the text, finds it.
+            with recorder.stage("gcs.upload_page_index") as span:
+                span["bytes"] = upload_page_index(
+                    output_bucket, doc_id, build_page_index(full_text, page_spans), {'trace_id': recorder.trace_id}
+                )
         output_blob = output_bucket.blob(output_filename)
-        output_blob.metadata = {'processing_mode': 'template_sample' if is_template_job else 'default'}
-        output_blob.upload_from_string(full_text)
-        
+        output_blob.metadata = {
+            'processing_mode': 'template_sample' if is_template_job else 'default',
+            'trace_id': recorder.trace_id
+        }
+        if sow_data.get("source_md5_hash"):
+            output_blob.metadata[SOURCE_MD5_KEY] = sow_data["source_md5_hash"]
+        with recorder.stage("gcs.upload", bytes=len(full_text.encode("utf-8"))):
+            output_blob.upload_from_string(full_text)
+
         print(f"--- BATCH HANDLER END: Successfully saved '{output_filename}' ---")
+        if progress_ref is not None:
+            # Only now is the document assembled; until here a retry of this event reassembles it.
+            mark_assembled(writes, progress_ref)
+        lease.complete(writes)
 
     except Exception as e:
-        print(f"!!! CRITICAL ERROR in batch_result_handler: {e}")
\ No newline at end of file
+        print(f"!!! CRITICAL ERROR in batch_result_handler: {e}")
+        lease.release(e, writes)
+        # Re-raise so the event is redelivered under RETRY_POLICY_RETRY.
+        raise
+    finally:
+        recorder.flush(timings_ref, writes)
+        try:
+            writes.commit()
+        except Exception as e:
+            print(f"Warning: could not save final batch handler state: {e}")
@@ -0,0 +1,962 @@
+"""
+In-memory stand-ins for the Google Cloud services the pipeline talks to.
+
+install() registers fake `google.cloud.storage`, `google.cloud.firestore`,
+`google.cloud.documentai`, `google.api_core`, `vertexai`, `functions_framework`,
+`flask` and `PyPDF2` modules in sys.modules, so the Cloud Function sources can
+be imported and driven unchanged without GCP credentials or network access.
+
+All fakes share one World. Each remote call goes through World.call(). That
+call records the call, the bytes moved and, when configured, sleeps for an
+injected latency or raises an injected failure. The benchmark harness resets
+the counters between stages.
+"""
+import base64
+import copy
+import hashlib
+import io
+import json
+import random
+import re
+import sys
+import threading
+import time
+import types
+import uuid
+from collections import Counter, defaultdict
+from datetime import datetime, timezone
+
+
+# ---------------------------------------------------------------------------
+# Shared state and call accounting
+# ---------------------------------------------------------------------------
+
+class World:
+
+    def __init__(self, latency=None, failure_rate=None, seed=0):
+        # Keys are call names such as 'gcs.download' or 'vertex.generate_content'.
+        # A key of '*' applies to every call without a more specific entry.
+        self.latency = dict(latency or {})
+        self.failure_rate = dict(failure_rate or {})
+        self.random = random.Random(seed)
+        self.lock = threading.RLock()
+        self.reset_state()
+        self.reset_counters()
+
+    def reset_state(self):
+        self.buckets = defaultdict(dict)      # bucket -> {name: FakeObject}
+        self.documents = {}                   # 'coll/doc[/coll/doc...]' -> dict
+        self.docai_sources = {}               # gs:// uri -> [page text, ...]
+        self.uploaded = []                    # [(bucket, name)] in upload order
+        self.pending_operations = []          # batch requests awaiting output
+        self.context_caches = {}              # cached content name -> CachedContent
+
+    def reset_counters(self):
+        with self.lock:
+            self.calls = Counter()
+            self.failures = Counter()
+            self.bytes_downloaded = 0
+            self.bytes_uploaded = 0
+
+    def _lookup(self, table, key):
+        if key in table:
+            return table[key]
+        service = key.split(".")[0]
+        if f"{service}.*" in table:
+            return table[f"{service}.*"]
+        return table.get("*", 0)
+
+    def call(self, key, bytes_down=0, bytes_up=0, error_cls=None):
+        with self.lock:
+            self.calls[key] += 1
+            self.bytes_downloaded += bytes_down
+            self.bytes_uploaded += bytes_up
+            fail = self.random.random() < self._lookup(self.failure_rate, key)
+            if fail:
+                self.failures[key] += 1
+        delay = self._lookup(self.latency, key)
+        if delay:
+            time.sleep(delay)
+        if fail:
+            raise (error_cls or exceptions.ServiceUnavailable)(f"Injected failure for {key}")
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                "remote_calls": dict(sorted(self.calls.items())),
+                "injected_failures": dict(sorted(self.failures.items())),
+                "bytes_downloaded": self.bytes_downloaded,
+                "bytes_uploaded": self.bytes_uploaded,
+            }
+
+
+WORLD = World()
+
+
+class _Proto:
+    """Accepts arbitrary keyword fields, like the generated proto-plus types."""
+
+    def __init__(self, **kwargs):
+        for key, value in kwargs.items():
+            setattr(self, key, value)
+
+    def __getattr__(self, name):
+        # Unset message fields read as None instead of raising.
+        if name.startswith("__"):
+            raise AttributeError(name)
+        return None
+
+
+# ---------------------------------------------------------------------------
+# google.api_core
+# ---------------------------------------------------------------------------
+
+exceptions = types.ModuleType("google.api_core.exceptions")
+
+
+class GoogleAPICallError(Exception):
+    code = None
+
+
+for _name, _code in [
+    ("ResourceExhausted", 429), ("TooManyRequests", 429), ("ServiceUnavailable", 503),
+    ("NotFound", 404), ("NotModified", 304), ("PreconditionFailed", 412), ("Conflict", 409),
+    ("AlreadyExists", 409), ("DeadlineExceeded", 504), ("InternalServerError", 500),
+    ("InvalidArgument", 400), ("Aborted", 409), ("FailedPrecondition", 400), ("PermissionDenied", 403),
+]:
+    setattr(exceptions, _name, type(_name, (GoogleAPICallError,), {"code": _code}))
+exceptions.GoogleAPICallError = GoogleAPICallError
+
+client_options = types.ModuleType("google.api_core.client_options")
+client_options.ClientOptions = _Proto
+
+
+# ---------------------------------------------------------------------------
+# google.cloud.storage
+# ---------------------------------------------------------------------------
+
+class FakeObject:
+
+    def __init__(self, data, metadata=None, content_type=None):
+        self.data = data
+        self.metadata = dict(metadata or {})
+        self.content_type = content_type
+        self.generation = time.time_ns()
+        self.time_created = datetime.now(timezone.utc)
+        self.md5_hash = base64.b64encode(hashlib.md5(data).digest()).decode("ascii")
+
+
+class _BlobReader(io.RawIOBase):
+    """File-like reader over an object that accounts for bytes as they are read."""
+
+    def __init__(self, data, key):
+        self._buffer = io.BytesIO(data)
+        self._key = key
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        n = self._buffer.readinto(b)
+        WORLD.call(self._key, bytes_down=n) if n else None
+        return n
+
+
+class Blob:
+
+    def __init__(self, name, bucket):
+        self.name = name
+        self.bucket = bucket
+        self.metadata = None
+        self.content_type = None
+        self.size = None
+        self.generation = None
+        self.time_created = None
+        self.md5_hash = None
+
+    def _object(self):
+        obj = WORLD.buckets[self.bucket.name].get(self.name)
+        if obj is None:
+            raise exceptions.NotFound(f"gs://{self.bucket.name}/{self.name}")
+        return obj
+
+    def _load_properties(self, obj):
+        self.metadata = dict(obj.metadata) or None
+        self.content_type = obj.content_type
+        self.size = len(obj.data)
+        self.generation = obj.generation
+        self.time_created = obj.time_created
+        self.md5_hash = obj.md5_hash
+
+    def reload(self):
+        WORLD.call("gcs.get_metadata")
+        self._load_properties(self._object())
+
+    def exists(self):
+        WORLD.call("gcs.get_metadata")
+        return self.name in WORLD.buckets[self.bucket.name]
+
+    def download_as_bytes(self, start=None, end=None, if_generation_not_match=None, if_generation_match=None, **kwargs):
+        if self.name not in WORLD.buckets[self.bucket.name]:
+            WORLD.call("gcs.download")
+        obj = self._object()
+        if if_generation_not_match is not None and obj.generation == if_generation_not_match:
+            WORLD.call("gcs.download")
+            raise exceptions.NotModified("Generation matches")
+        if if_generation_match is not None and obj.generation != if_generation_match:
+            WORLD.call("gcs.download")
+            raise exceptions.PreconditionFailed(f"gs://{self.bucket.name}/{self.name}")
+        data = obj.data
+        if start is not None or end is not None:
+            data = data[start or 0:(end + 1) if end is not None else None]
+        WORLD.call("gcs.download", bytes_down=len(data))
+        self._load_properties(obj)
+        return data
+
+    def download_as_text(self, encoding="utf-8", **kwargs):
+        return self.download_as_bytes(**kwargs).decode(encoding)
+
+    def open(self, mode="rb", **kwargs):
+        obj = self._object()
+        reader = io.BufferedReader(_BlobReader(obj.data, "gcs.download_chunk"), buffer_size=256 * 1024)
+        if "b" in mode:
+            return reader
+        return io.TextIOWrapper(reader, encoding="utf-8")
+
+    def upload_from_string(self, data, content_type=None, if_generation_match=None, **kwargs):
+        if isinstance(data, str):
+            data = data.encode("utf-8")
+        existing = WORLD.buckets[self.bucket.name].get(self.name)
+        if if_generation_match is not None:
+            current = existing.generation if existing else 0
+            if current != if_generation_match:
+                WORLD.call("gcs.upload")
+                raise exceptions.PreconditionFailed(f"gs://{self.bucket.name}/{self.name}")
+        WORLD.call("gcs.upload", bytes_up=len(data))
+        obj = FakeObject(data, self.metadata, content_type or self.content_type)
+        with WORLD.lock:
+            WORLD.buckets[self.bucket.name][self.name] = obj
+            WORLD.uploaded.append((self.bucket.name, self.name))
+        self._load_properties(obj)
+
+    def patch(self):
+        WORLD.call("gcs.patch")
+        self._object().metadata.update(self.metadata or {})
+
+    def delete(self):
+        WORLD.call("gcs.delete")
+        WORLD.buckets[self.bucket.name].pop(self.name, None)
+
+
+class Bucket:
+
+    def __init__(self, name):
+        self.name = name
+
+    def blob(self, name):
+        return Blob(name, self)
+
+    def get_blob(self, name):
+        WORLD.call("gcs.get_metadata")
+        obj = WORLD.buckets[self.name].get(name)
+        if obj is None:
+            return None
+        blob = Blob(name, self)
+        blob._load_properties(obj)
+        return blob
+
+    def list_blobs(self, prefix=None, **kwargs):
+        WORLD.call("gcs.list")
+        blobs = []
+        for name, obj in sorted(WORLD.buckets[self.name].items()):
+            if prefix and not name.startswith(prefix):
+                continue
+            blob = Blob(name, self)
+            blob._load_properties(obj)
+            blobs.append(blob)
+        return iter(blobs)
+
+
+class StorageClient:
+
+    def __init__(self, *args, **kwargs):
+        pass
+
+    def bucket(self, name):
+        return Bucket(name)
+
+    def list_blobs(self, bucket_or_name, prefix=None, **kwargs):
+        bucket = bucket_or_name if isinstance(bucket_or_name, Bucket) else Bucket(bucket_or_name)
+        return bucket.list_blobs(prefix=prefix)
+
+
+storage = types.ModuleType("google.cloud.storage")
+storage.Client = StorageClient
+storage.Bucket = Bucket
+storage.Blob = Blob
+
+
+# ---------------------------------------------------------------------------
+# google.cloud.firestore
+# ---------------------------------------------------------------------------
+
+SERVER_TIMESTAMP = object()
+DELETE_FIELD = object()
+
+
+class Increment:
+
+    def __init__(self, value):
+        self.value = value
+
+
+class ArrayUnion:
+
+    def __init__(self, values):
+        self.values = list(values)
+
+
+def _resolve(value, current=None):
+    if value is SERVER_TIMESTAMP:
+        return datetime.now(timezone.utc)
+    if isinstance(value, Increment):
+        return (current or 0) + value.value
+    if isinstance(value, ArrayUnion):
+        merged = list(current or [])
+        merged.extend(v for v in value.values if v not in merged)
+        return merged
+    if isinstance(value, dict):
+        return {k: _resolve(v, (current or {}).get(k) if isinstance(current, dict) else None)
+                for k, v in value.items() if v is not DELETE_FIELD}
+    return copy.deepcopy(value)
+
+
+def _deep_merge(target, updates):
+    for key, value in updates.items():
+        if value is DELETE_FIELD:
+            target.pop(key, None)
+        elif isinstance(value, dict) and isinstance(target.get(key), dict):
+            _deep_merge(target[key], value)
+        else:
+            target[key] = _resolve(value, target.get(key))
+
+
+def _set_path(target, dotted, value):
+    parts = dotted.split(".")
+    for part in parts[:-1]:
+        target = target.setdefault(part, {})
+    if value is DELETE_FIELD:
+        target.pop(parts[-1], None)
+    else:
+        target[parts[-1]] = _resolve(value, target.get(parts[-1]))
+
+
+def _get_path(data, dotted):
+    for part in dotted.split("."):
+        if not isinstance(data, dict) or part not in data:
+            raise KeyError(dotted)
+        data = data[part]
+    return data
+
+
+class DocumentSnapshot:
+
+    def __init__(self, reference, data):
+        self.reference = reference
+        self.id = reference.id
+        self._data = data
+        self.exists = data is not None
+        self.update_time = datetime.now(timezone.utc) if self.exists else None
+        self.create_time = self.update_time
+
+    def to_dict(self):
+        return copy.deepcopy(self._data) if self.exists else None
+
+    def get(self, field_path):
+        return copy.deepcopy(_get_path(self._data or {}, field_path))
+
+
+class DocumentReference:
+
+    def __init__(self, path):
+        self.path = path
+        self.id = path.rsplit("/", 1)[-1]
+
+    def collection(self, name):
+        return CollectionReference(f"{self.path}/{name}")
+
+    def _read(self):
+        data = WORLD.documents.get(self.path)
+        return DocumentSnapshot(self, copy.deepcopy(data) if data is not None else None)
+
+    def get(self, field_paths=None, transaction=None, **kwargs):
+        WORLD.call("firestore.get")
+        return self._read()
+
+    def _apply_set(self, data, merge=False):
+        with WORLD.lock:
+            if isinstance(merge, (list, tuple)):
+                target = WORLD.documents.setdefault(self.path, {})
+                for field_path in merge:
+                    _set_path(target, field_path, _get_path(data, field_path))
+            elif merge and self.path in WORLD.documents:
+                _deep_merge(WORLD.documents[self.path], data)
+            else:
+                WORLD.documents[self.path] = _resolve(data)
+
+    def _apply_update(self, data):
+        with WORLD.lock:
+            if self.path not in WORLD.documents:
+                raise exceptions.NotFound(f"No document to update: {self.path}")
+            for key, value in data.items():
+                _set_path(WORLD.documents[self.path], key, value)
+
+    def _apply_delete(self):
+        with WORLD.lock:
+            WORLD.documents.pop(self.path, None)
+
+    def set(self, data, merge=False):
+        WORLD.call("firestore.write")
+        self._apply_set(data, merge)
+
+    def update(self, data):
+        WORLD.call("firestore.write")
+        self._apply_update(data)
+
+    def create(self, data):
+        WORLD.call("firestore.write")
+        with WORLD.lock:
+            if self.path in WORLD.documents:
+                raise exceptions.AlreadyExists(self.path)
+            WORLD.documents[self.path] = _resolve(data)
+
+    def delete(self):
+        WORLD.call("firestore.write")
+        self._apply_delete()
+
+
+class Query:
+    ASCENDING = "ASCENDING"
+    DESCENDING = "DESCENDING"
+
+    def __init__(self, path, filters=(), orders=(), limit=None, fields=None, start_after=None):
+        self._path = path
+        self._filters = list(filters)
+        self._orders = list(orders)
+        self._limit = limit
+        self._fields = fields
+        self._start_after = start_after
+
+    def _copy(self, **changes):
+        state = dict(filters=self._filters, orders=self._orders, limit=self._limit,
+                     fields=self._fields, start_after=self._start_after)
+        state.update(changes)
+        return Query(self._path, **state)
+
+    def where(self, field_path=None, op_string=None, value=None, filter=None):
+        if filter is not None:
+            field_path, op_string, value = filter.field_path, filter.op_string, filter.value
+        return self._copy(filters=self._filters + [(field_path, op_string, value)])
+
+    def order_by(self, field_path, direction=ASCENDING):
+        return self._copy(orders=self._orders + [(field_path, direction)])
+
+    def limit(self, count):
+        return self._copy(limit=count)
+
+    def select(self, field_paths):
+        return self._copy(fields=list(field_paths))
+
+    def start_after(self, document_fields_or_snapshot):
+        return self._copy(start_after=document_fields_or_snapshot)
+
+    def _matches(self, data):
+        for field_path, op, value in self._filters:
+            try:
+                actual = _get_path(data, field_path)
+            except KeyError:
+                return False
+            compare = {
+                "==": lambda: actual == value, "!=": lambda: actual != value, "<": lambda: actual < value,
+                "<=": lambda: actual <= value, ">": lambda: actual > value, ">=": lambda: actual >= value,
+                "in": lambda: actual in value, "array_contains": lambda: value in (actual or []),
+            }.get(op)
+            if compare is None or not compare():
+                return False
+        return True
+
+    def stream(self, transaction=None):
+        WORLD.call("firestore.query")
+        prefix = self._path + "/"
+        with WORLD.lock:
+            rows = [
+                (path, copy.deepcopy(data)) for path, data in WORLD.documents.items()
+                if path.startswith(prefix) and "/" not in path[len(prefix):] and self._matches(data)
+            ]
+        rows.sort(key=lambda row: row[0])
+        for field_path, direction in reversed(self._orders):
+            rows.sort(key=lambda row: (_safe_get(row[1], field_path) is None, _safe_get(row[1], field_path) or 0),
+                      reverse=direction == Query.DESCENDING)
+        if self._start_after is not None:
+            after_id = getattr(self._start_after, "id", None)
+            ids = [path.rsplit("/", 1)[-1] for path, _ in rows]
+            if after_id in ids:
+                rows = rows[ids.index(after_id) + 1:]
+        if self._limit is not None:
+            rows = rows[:self._limit]
+        for path, data in rows:
+            if self._fields is not None:
+                data = {k: v for k, v in data.items() if k in self._fields}
+            yield DocumentSnapshot(DocumentReference(path), data)
+
+    def get(self, transaction=None):
+        return list(self.stream())
+
+
+def _safe_get(data, field_path):
+    try:
+        return _get_path(data, field_path)
+    except KeyError:
+        return None
+
+
+class CollectionReference(Query):
+
+    def __init__(self, path):
+        super().__init__(path)
+        self.id = path.rsplit("/", 1)[-1]
+
+    def document(self, document_id=None):
+        return DocumentReference(f"{self._path}/{document_id or uuid.uuid4().hex[:20]}")
+
+    def add(self, data):
+        ref = self.document()
+        ref.set(data)
+        return None, ref
+
+    def list_documents(self):
+        return [snapshot.reference for snapshot in self.stream()]
+
+
+class WriteBatch:
+
+    def __init__(self):
+        self._ops = []
+
+    def set(self, reference, data, merge=False):
+        self._ops.append(lambda: reference._apply_set(data, merge))
+
+    def update(self, reference, data):
+        self._ops.append(lambda: reference._apply_update(data))
+
+    def delete(self, reference):
+        self._ops.append(reference._apply_delete)
+
+    def commit(self):
+        WORLD.call("firestore.commit")
+        with WORLD.lock:
+            for op in self._ops:
+                op()
+        self._ops = []
+
+
+class Transaction(WriteBatch):
+
+    def get(self, ref_or_query):
+        if isinstance(ref_or_query, DocumentReference):
+            return ref_or_query.get()
+        return ref_or_query.stream()
+
+
+def transactional(fn):
+    def wrapper(transaction, *args, **kwargs):
+        # The world lock makes the read-modify-write atomic, like a retried transaction.
+        with WORLD.lock:
+            result = fn(transaction, *args, **kwargs)
+            transaction.commit()
+        return result
+    return wrapper
+
+
+class FirestoreClient:
+
+    def __init__(self, *args, **kwargs):
+        pass
+
+    def collection(self, name):
+        return CollectionReference(name)
+
+    def document(self, path):
+        return DocumentReference(path)
+
+    def batch(self):
+        return WriteBatch()
+
+    def transaction(self, **kwargs):
+        return Transaction()
+
+    def get_all(self, references, field_paths=None, transaction=None):
+        WORLD.call("firestore.batch_get")
+        return [reference._read() for reference in references]
+
+
+class FieldFilter:
+
+    def __init__(self, field_path, op_string, value):
+        self.field_path, self.op_string, self.value = field_path, op_string, value
+
+
+firestore = types.ModuleType("google.cloud.firestore")
+firestore.Client = FirestoreClient
+firestore.SERVER_TIMESTAMP = SERVER_TIMESTAMP
+firestore.DELETE_FIELD = DELETE_FIELD
+firestore.Increment = Increment
+firestore.ArrayUnion = ArrayUnion
+firestore.Query = Query
+firestore.FieldFilter = FieldFilter
+firestore.transactional = transactional
+firestore.DocumentReference = DocumentReference
+firestore.DocumentSnapshot = DocumentSnapshot
+
+
+# ---------------------------------------------------------------------------
+# google.cloud.documentai
+# ---------------------------------------------------------------------------
+
+def _gcs_split(uri):
+    bucket, _, name = uri[len("gs://"):].partition("/")
+    return bucket, name
+
+
+def _page_layout(pages, offsets):
+    return [
+        _Proto(page_number=number, layout=_Proto(text_anchor=_Proto(text_segments=[
+            _Proto(start_index=start, end_index=end)
+        ])))
+        for number, (start, end) in zip(pages, offsets)
+    ]
+
+
+def _join_pages(page_texts):
+    offsets, position = [], 0
+    for text in page_texts:
+        offsets.append((position, position + len(text)))
+        position += len(text)
+    return "".join(page_texts), offsets
+
+
+class DocumentProcessorServiceClient:
+
+    def __init__(self, *args, **kwargs):
+        pass
+
+    def process_document(self, request=None, **kwargs):
+        uri = request.gcs_document.gcs_uri
+        pages = WORLD.docai_sources[uri]
+        selector = request.process_options.individual_page_selector if request.process_options else None
+        numbers = list(selector.pages) if selector else list(range(1, len(pages) + 1))
+        text, offsets = _join_pages([pages[n - 1] for n in numbers])
+        WORLD.call("docai.process_document", error_cls=exceptions.ResourceExhausted)
+        return _Proto(document=_Proto(text=text, pages=_page_layout(numbers, offsets)))
+
+    def batch_process_documents(self, request=None, **kwargs):
+        WORLD.call("docai.batch_process_documents", error_cls=exceptions.ResourceExhausted)
+        operation_id = uuid.uuid4().int % 10 ** 18
+        # Output is written when the harness completes the operation, so the
+        # service-side work is not timed as part of the calling function.
+        with WORLD.lock:
+            WORLD.pending_operations.append((operation_id, request))
+        return _Proto(operation=_Proto(name=f"projects/fake/operations/{operation_id}"))
+
+
+def complete_batch_operations():
+    """Writes the sharded JSON output of every pending batch request."""
+    with WORLD.lock:
+        pending, WORLD.pending_operations = WORLD.pending_operations, []
+    for operation_id, request in pending:
+        _write_batch_output(operation_id, request)
+
+
+def _write_batch_output(operation_id, request):
+    gcs_output = request.document_output_config.gcs_output_config
+    out_bucket, out_prefix = _gcs_split(gcs_output.gcs_uri)
+    pages_per_shard = getattr(gcs_output.sharding_config, "pages_per_shard", None) or 0
+    for index, document in enumerate(request.input_documents.gcs_documents.documents):
+        pages = WORLD.docai_sources[document.gcs_uri]
+        per_shard = pages_per_shard or len(pages)
+        shards = [list(range(s, min(s + per_shard, len(pages)))) for s in range(0, len(pages), per_shard)]
+        base = document.gcs_uri.rsplit("/", 1)[-1].rsplit(".", 1)[0]
+        text_offset = 0
+        for shard_index, shard_pages in enumerate(shards):
+            text, offsets = _join_pages([pages[i] for i in shard_pages])
+            shard = {
+                "uri": document.gcs_uri,
+                "mimeType": "application/pdf",
+                "text": text,
+                "pages": [
+                    {
+                        "pageNumber": i + 1,
+                        "layout": {"textAnchor": {"textSegments": [{"startIndex": str(start), "endIndex": str(end)}]}},
+                        # Layout tokens make real outputs many times larger than their text.
+                        "tokens": [
+                            {"layout": {"textAnchor": {"textSegments": [{"startIndex": str(start + t), "endIndex": str(start + t + 5)}]},
+                                        "confidence": 0.99, "boundingPoly": {"normalizedVertices": [{"x": 0.1, "y": 0.1}] * 4}}}
+                            for t in range(0, end - start, 6)
+                        ],
+                    }
+                    for i, (start, end) in zip(shard_pages, offsets)
+                ],
+                "shardInfo": {"shardIndex": str(shard_index), "shardCount": str(len(shards)), "textOffset": str(text_offset)},
+            }
+            text_offset += len(text)
+            name = f"{out_prefix.rstrip('/')}/{operation_id}/{index}/{base}-{shard_index}.json"
+            data = json.dumps(shard).encode("utf-8")
+            with WORLD.lock:
+                WORLD.buckets[out_bucket][name] = FakeObject(data, content_type="application/json")
+                WORLD.uploaded.append((out_bucket, name))
+
+
+class _ProcessOptions(_Proto):
+    IndividualPageSelector = _Proto
+
+
+class _GcsOutputConfig(_Proto):
+    ShardingConfig = _Proto
+
+
+class _DocumentOutputConfig(_Proto):
+    GcsOutputConfig = _GcsOutputConfig
+
+
+documentai = types.ModuleType("google.cloud.documentai")
+documentai.DocumentProcessorServiceClient = DocumentProcessorServiceClient
+for _name in ["GcsDocument", "GcsDocuments", "GcsPrefix", "ProcessRequest", "BatchDocumentsInputConfig",
+              "BatchProcessRequest", "RawDocument", "Document"]:
+    setattr(documentai, _name, type(_name, (_Proto,), {}))
+documentai.ProcessOptions = _ProcessOptions
+documentai.DocumentOutputConfig = _DocumentOutputConfig
+
+
+# ---------------------------------------------------------------------------
+# vertexai
+# ---------------------------------------------------------------------------
+
+_SECTION_RE = re.compile(r"SECTION\s+(\d+)")
+# The benchmark's seeded analysis prompt contains this phrase; see run_benchmarks.py.
+ANALYSIS_PROMPT_MARKER = "Return a JSON object with a 'requirements' list."
+
+
+def fake_model_response(prompt):
+    """Deterministic stand-in for Gemini: one requirement per SECTION of an analysis chunk."""
+    if "EXTRACTED REQUIREMENTS" in prompt or "PARTIAL SUMMARIES" in prompt:
+        return "The bill directs the agency to implement the listed requirements."
+    if ANALYSIS_PROMPT_MARKER in prompt:
+        sections = sorted(set(_SECTION_RE.findall(prompt)), key=int)
+        return json.dumps({"requirements": [
+            {"description": f"Implement the provisions of Section {n}.", "type": "Operational", "deadline": "N/A"}
+            for n in sections
+        ]})
+    return "# Statement of Work\n\n" + "Generated content. " * 200
+
+
+class _UsageMetadata(_Proto):
+    pass
+
+
+class _Response:
+
+    def __init__(self, text, prompt_tokens, cached_tokens=0):
+        self.text = text
+        self.usage_metadata = _UsageMetadata(
+            prompt_token_count=prompt_tokens,
+            candidates_token_count=len(text) // 4,
+            total_token_count=prompt_tokens + len(text) // 4,
+            cached_content_token_count=cached_tokens,
+        )
+
+
+def _contents_text(contents):
+    if isinstance(contents, str):
+        return contents
+    if isinstance(contents, (list, tuple)):
+        return "".join(_contents_text(c) for c in contents)
+    return str(getattr(contents, "text", contents))
+
+
+class GenerativeModel:
+
+    def __init__(self, model_name, system_instruction=None, **kwargs):
+        self.model_name = model_name
+        self.system_instruction = system_instruction
+        self.cached_content = kwargs.get("cached_content")
+
+    @classmethod
+    def from_cached_content(cls, cached_content, **kwargs):
+        return cls(cached_content.model_name, cached_content=cached_content)
+
+    def generate_content(self, contents, generation_config=None, stream=False, **kwargs):
+        prompt = _contents_text(contents)
+        cached_tokens = 0
+        if self.cached_content is not None:
+            if self.cached_content.name not in WORLD.context_caches:
+                raise exceptions.NotFound(f"Cached content {self.cached_content.name} not found")
+            prompt = self.cached_content.prefix + prompt
+            cached_tokens = len(self.cached_content.prefix) // 4
+        WORLD.call("vertex.generate_content", error_cls=exceptions.ResourceExhausted)
+        response = _Response(fake_model_response(prompt), len(prompt) // 4, cached_tokens)
+        if not stream:
+            return response
+        text = response.text
+        return iter([_Response(text[i:i + 200], 0) for i in range(0, len(text), 200)])
+
+    def count_tokens(self, contents):
+        WORLD.call("vertex.count_tokens")
+        return _Proto(total_tokens=len(_contents_text(contents)) // 4)
+
+
+class GenerationConfig(_Proto):
+    pass
+
+
+class CachedContent:
+    """Context cache: holds the prompt prefix that models created from it prepend."""
+
+    def __init__(self, cached_content_name):
+        WORLD.call("vertex.get_cached_content")
+        cached = WORLD.context_caches.get(cached_content_name)
+        if cached is None:
+            raise exceptions.NotFound(f"Cached content {cached_content_name} not found")
+        self.__dict__.update(cached.__dict__)
+
+    @classmethod
+    def create(cls, model_name, contents=None, ttl=None, display_name=None, **kwargs):
+        WORLD.call("vertex.create_cached_content")
+        cached = cls.__new__(cls)
+        cached.name = f"projects/benchmark/locations/us-central1/cachedContents/{uuid.uuid4().hex}"
+        cached.model_name = model_name
+        cached.prefix = _contents_text(contents)
+        cached.display_name = display_name
+        WORLD.context_caches[cached.name] = cached
+        return cached
+
+    def update(self, ttl=None, **kwargs):
+        WORLD.call("vertex.update_cached_content")
+
+
+vertexai = types.ModuleType("vertexai")
+vertexai.init = lambda **kwargs: None
+generative_models = types.ModuleType("vertexai.generative_models")
+generative_models.GenerativeModel = GenerativeModel
+generative_models.GenerationConfig = GenerationConfig
+generative_models.Part = _Proto
+generative_models.Content = _Proto
+vertexai.generative_models = generative_models
+preview = types.ModuleType("vertexai.preview")
+caching = types.ModuleType("vertexai.preview.caching")
+caching.CachedContent = CachedContent
+preview.caching, preview.generative_models = caching, generative_models
+vertexai.preview = preview
+
+
+# ---------------------------------------------------------------------------
+# functions_framework, flask, PyPDF2
+# ---------------------------------------------------------------------------
+
+functions_framework = types.ModuleType("functions_framework")
+functions_framework.cloud_event = lambda fn: fn
+functions_framework.http = lambda fn: fn
+
+flask = types.ModuleType("flask")
+
+
+class Response:
+
+    def __init__(self, response=None, status=200, headers=None, mimetype=None, **kwargs):
+        self.response = response
+        self.status_code = status
+        self.headers = headers or {}
+        self.mimetype = mimetype
+
+
+flask.Response = Response
+flask.stream_with_context = lambda generator: generator
+
+pypdf2 = types.ModuleType("PyPDF2")
+
+
+class PdfReader:
+
+    def __init__(self, stream):
+        data = stream.read()
+        self.pages = [None] * len(re.findall(rb"/Type\s*/Page\b", data))
+
+
+pypdf2.PdfReader = PdfReader
+
+
+# ---------------------------------------------------------------------------
+# Request / event helpers and installation
+# ---------------------------------------------------------------------------
+
+class FakeRequest:
+
+    def __init__(self, json_body=None, args=None, headers=None, method="POST"):
+        self._json = json_body
+        self.args = args or {}
+        self.headers = headers or {}
+        self.method = method
+        self.url = "https://fake-function.local/"
+
+    def get_json(self, silent=False):
+        return copy.deepcopy(self._json)
+
+
+class FakeCloudEvent:
+
+    def __init__(self, bucket, name):
+        obj = WORLD.buckets[bucket][name]
+        self.data = {
+            "bucket": bucket,
+            "name": name,
+            "size": str(len(obj.data)),
+            "generation": str(obj.generation),
+            "metageneration": "1",
+            "md5Hash": obj.md5_hash,
+            "metadata": dict(obj.metadata),
+            "contentType": obj.content_type,
+        }
+        self.attributes = {"id": uuid.uuid4().hex, "type": "google.cloud.storage.object.v1.finalized"}
+
+    def __getitem__(self, key):
+        return self.attributes[key]
+
+
+def install():
+    """Registers the fake modules. Must run before any function source is imported."""
+    google = sys.modules.get("google") or types.ModuleType("google")
+    google.__path__ = []
+    cloud = types.ModuleType("google.cloud")
+    cloud.__path__ = []
+    cloud.storage, cloud.firestore, cloud.documentai = storage, firestore, documentai
+    api_core = types.ModuleType("google.api_core")
+    api_core.__path__ = []
+    api_core.exceptions, api_core.client_options = exceptions, client_options
+    google.cloud, google.api_core = cloud, api_core
+    sys.modules.update({
+        "google": google,
+        "google.cloud": cloud,
+        "google.cloud.storage": storage,
+        "google.cloud.firestore": firestore,
+        "google.cloud.documentai": documentai,
+        "google.api_core": api_core,
+        "google.api_core.exceptions": exceptions,
+        "google.api_core.client_options": client_options,
+        "vertexai": vertexai,
+        "vertexai.generative_models": generative_models,
+        "vertexai.preview": preview,
+        "vertexai.preview.caching": caching,
+        "vertexai.preview.generative_models": generative_models,
+        "functions_framework": functions_framework,
+        "flask": flask,
+        "PyPDF2": pypdf2,
+    })
@@ -0,0 +1,354 @@
+"""
+Offline benchmark for the SOW-Forge pipeline.
+
+Drives process_pdf, handle_batch_result, analyze_text, generate_sow and
+generate_template end to end against the in-memory fakes in fakes.py, for
+synthetic bills of several sizes. For every stage it reports wall time,
+remote calls by service and method, bytes moved to and from GCS, and peak
+Python memory (tracemalloc). Results are printed as JSON.
+
+Usage (from the backend directory):
+
+    python benchmarks/run_benchmarks.py
+    python benchmarks/run_benchmarks.py --pages 10 100 --latency-ms vertex.*=800 --latency-ms gcs.*=20
+    python benchmarks/run_benchmarks.py --failure-rate vertex.generate_content=0.1 --output bench.json
+    python benchmarks/run_benchmarks.py --setting docai_sharding_mode=parallel_sync
+
+Latency and failure keys are call names as reported under 'remote_calls'
+('gcs.download', 'vertex.generate_content', ...), 'service.*', or '*'.
+Injected failures raise the same exception types the real clients raise
+(ResourceExhausted for Vertex AI and Document AI, ServiceUnavailable otherwise).
+"""
+import argparse
+import contextlib
+import importlib.util
+import io
+import json
+import os
+import sys
+import time
+import tracemalloc
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+BACKEND_DIR = os.path.dirname(BENCHMARKS_DIR)
+sys.path.insert(0, BENCHMARKS_DIR)
+
+import fakes  # noqa: E402  (must be installed before any function source is imported)
+
+fakes.install()
+
+FUNCTION_DIRS = [
+    "doc_preprocess_trigger", "batch_result_handler", "legislative_analysis_func",
+    "sow_generation_func", "template_generation_func",
+]
+for _func_dir in [BACKEND_DIR] + [os.path.join(BACKEND_DIR, d) for d in FUNCTION_DIRS]:
+    if _func_dir not in sys.path:
+        sys.path.insert(1, _func_dir)
+
+UPLOADS_BUCKET = "sow-forge-texas-dmv-uploads"
+PROCESSED_TEXT_BUCKET = "sow-forge-texas-dmv-processed-text"
+BATCH_OUTPUT_BUCKET = "sow-forge-texas-dmv-batch-output"
+TEMPLATES_BUCKET = "sow-forge-texas-dmv-templates"
+TEMPLATE_SAMPLES_BUCKET = "sow-forge-texas-dmv-template-samples"
+
+DEFAULT_PAGES = [10, 100, 1000]
+CHARS_PER_PAGE = 2800
+PDF_BYTES_PER_PAGE = 16 * 1024
+
+BASE_SETTINGS = {
+    "gcp_project_number": "000000000000",
+    "docai_processor_id": "benchmark-processor",
+    "docai_location": "us",
+    "processed_text_bucket": PROCESSED_TEXT_BUCKET,
+    "batch_output_bucket": BATCH_OUTPUT_BUCKET,
+    "legislative_analysis_model": "gemini-2.5-pro",
+    "legislative_analysis_prompt_id": "legislative_analysis_default",
+    "sow_generation_model": "gemini-2.5-pro",
+    "sow_generation_prompt_id": "sow_generation_default",
+    # Pace like a generous quota so runs measure the pipeline, not the limiter;
+    # override with --setting vertex_requests_per_minute=... to study pacing.
+    "vertex_requests_per_minute": 60000,
+    "vertex_burst": 100,
+    # The synthetic prompts are far below Vertex AI's minimum cache size; cache them anyway
+    # so runs exercise context caching.
+    "context_cache_min_tokens": 0,
+}
+
+PROMPTS = {
+    "legislative_analysis_default": (
+        "Identify every requirement this bill places on the agency. "
+        f"{fakes.ANALYSIS_PROMPT_MARKER}\n\nBILL TEXT:\n{{DOCUMENT_TEXT}}"
+    ),
+    "sow_generation_default": (
+        "Mark assumptions as {ai_review_tag}.\n\nTEMPLATE:\n{template_content}\n\n"
+        "Fill in the template for {project_name_placeholder} ({original_filename}).\n\n"
+        "ANALYSIS:\n{analysis_data_json}"
+    ),
+    "template_generation_default": "Write a reusable SOW template from these samples:\n{concatenated_text}",
+}
+
+
+# ---------------------------------------------------------------------------
+# Synthetic inputs
+# ---------------------------------------------------------------------------
+
+def synthetic_pages(page_count, seed_text="The department shall"):
+    """Bill-like page text with a numbered SECTION heading on every page."""
+    pages = []
+    for number in range(1, page_count + 1):
+        body = (
+            f"{seed_text} establish procedures under this section for registration "
+            f"records, fees and reporting to the legislature by September 1. "
+        )
+        paragraph = body * (CHARS_PER_PAGE // (2 * len(body)))
+        pages.append(f"SECTION {number}. Amendment to Transportation Code.\n\n{paragraph}\n\n{paragraph}\n\n")
+    return pages
+
+
+def synthetic_pdf(page_count, bytes_per_page=PDF_BYTES_PER_PAGE):
+    """
+    A structurally valid, uncompressed PDF with a classic xref table and one
+    filler content stream per page, sized like a scanned bill.
+    """
+    objects = {}
+    kids = " ".join(f"{3 + 2 * i} 0 R" for i in range(page_count))
+    objects[1] = b"<< /Type /Catalog /Pages 2 0 R >>"
+    objects[2] = f"<< /Type /Pages /Kids [{kids}] /Count {page_count} >>".encode()
+    filler = b"0 0 m 612 792 l S\n" * (bytes_per_page // 18)
+    for i in range(page_count):
+        page_obj, content_obj = 3 + 2 * i, 4 + 2 * i
+        objects[page_obj] = (
+            f"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 612 792] /Contents {content_obj} 0 R >>".encode()
+        )
+        objects[content_obj] = b"<< /Length %d >>\nstream\n%s\nendstream" % (len(filler), filler)
+
+    out = io.BytesIO()
+    out.write(b"%PDF-1.7\n%\xe2\xe3\xcf\xd3\n")
+    offsets = {}
+    for number in sorted(objects):
+        offsets[number] = out.tell()
+        out.write(b"%d 0 obj\n%s\nendobj\n" % (number, objects[number]))
+    xref_offset = out.tell()
+    size = max(objects) + 1
+    out.write(b"xref\n0 %d\n0000000000 65535 f \n" % size)
+    for number in range(1, size):
+        out.write(b"%010d 00000 n \n" % offsets[number])
+    out.write(b"trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n" % (size, xref_offset))
+    return out.getvalue()
+
+
+# ---------------------------------------------------------------------------
+# Harness
+# ---------------------------------------------------------------------------
+
+def load_function(func_dir):
+    path = os.path.join(BACKEND_DIR, func_dir, "main.py")
+    spec = importlib.util.spec_from_file_location(f"{func_dir}_main", path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def put_object(bucket, name, data, metadata=None, content_type=None):
+    """Seeds an object without counting it as pipeline traffic."""
+    if isinstance(data, str):
+        data = data.encode("utf-8")
+    fakes.WORLD.buckets[bucket][name] = fakes.FakeObject(data, metadata, content_type)
+
+
+def reset_runtime():
+    """Drops per-instance caches so every document size starts from a cold instance."""
+    from shared import context_cache, llm_cache, rate_limiter, runtime, template_store
+    runtime._clients.clear()
+    runtime._settings_cache.update({"value": None, "fetched_at": 0.0})
+    runtime._prompt_cache.clear()
+    llm_cache._memory_backends.clear()
+    template_store._templates.clear()
+    rate_limiter._schedulers.clear()
+    context_cache._handles.clear()
+
+
+def seed_world(settings):
+    world = fakes.WORLD
+    world.reset_state()
+    world.documents["settings/global_config"] = dict(settings)
+    for prompt_id, text in PROMPTS.items():
+        world.documents[f"prompts/{prompt_id}"] = {"prompt_text": text}
+    world.documents["templates/benchmark_template"] = {"name": "Benchmark", "gcs_path": "benchmark_template.md"}
+    put_object(TEMPLATES_BUCKET, "benchmark_template.md", "# {project_name}\n\n## Scope\n\n## Deliverables\n" * 20)
+
+
+def run_stage(name, fn, verbose, track_memory):
+    fakes.WORLD.reset_counters()
+    if track_memory:
+        tracemalloc.start()
+    error = None
+    start = time.perf_counter()
+    sink = contextlib.nullcontext() if verbose else contextlib.redirect_stdout(io.StringIO())
+    try:
+        with sink:
+            fn()
+    except Exception as e:
+        error = f"{type(e).__name__}: {e}"
+    wall_time = time.perf_counter() - start
+    peak = None
+    if track_memory:
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+    result = {"stage": name, "wall_time_s": round(wall_time, 4), "peak_memory_bytes": peak}
+    result.update(fakes.WORLD.snapshot())
+    if error:
+        result["error"] = error
+    return result
+
+
+def new_uploads(bucket, since):
+    return [name for b, name in fakes.WORLD.uploaded[since:] if b == bucket]
+
+
+def benchmark_document(functions, page_count, settings, verbose, track_memory):
+    seed_world(settings)
+    reset_runtime()
+    world = fakes.WORLD
+
+    doc_id = f"HB{page_count:05d}"
+    pdf_name = f"{doc_id}.pdf"
+    pdf = synthetic_pdf(page_count)
+    put_object(UPLOADS_BUCKET, pdf_name, pdf, content_type="application/pdf")
+    world.docai_sources[f"gs://{UPLOADS_BUCKET}/{pdf_name}"] = synthetic_pages(page_count)
+
+    sample_names = []
+    for i in range(3):
+        sample_name = f"samples/sample_{i}.pdf"
+        put_object(TEMPLATE_SAMPLES_BUCKET, sample_name, synthetic_pdf(10), content_type="application/pdf")
+        world.docai_sources[f"gs://{TEMPLATE_SAMPLES_BUCKET}/{sample_name}"] = synthetic_pages(10, "The contractor shall")
+        sample_names.append(sample_name)
+    put_object(TEMPLATE_SAMPLES_BUCKET, "samples/notes.txt", "".join(synthetic_pages(5, "The vendor will")))
+    sample_names.append("samples/notes.txt")
+
+    stages = []
+    mark = len(world.uploaded)
+    stages.append(run_stage(
+        "process_pdf", lambda: functions["doc_preprocess_trigger"].process_pdf(fakes.FakeCloudEvent(UPLOADS_BUCKET, pdf_name)),
+        verbose, track_memory,
+    ))
+
+    fakes.complete_batch_operations()
+    batch_outputs = new_uploads(BATCH_OUTPUT_BUCKET, mark)
+    if batch_outputs:
+        def handle_all():
+            for name in batch_outputs:
+                functions["batch_result_handler"].handle_batch_result(fakes.FakeCloudEvent(BATCH_OUTPUT_BUCKET, name))
+        stages.append(run_stage("handle_batch_result", handle_all, verbose, track_memory))
+        stages[-1]["invocations"] = len(batch_outputs)
+
+    text_objects = [name for name in new_uploads(PROCESSED_TEXT_BUCKET, mark) if name.endswith(".txt")]
+    if text_objects:
+        stages.append(run_stage(
+            "analyze_text",
+            lambda: functions["legislative_analysis_func"].analyze_text(fakes.FakeCloudEvent(PROCESSED_TEXT_BUCKET, text_objects[-1])),
+            verbose, track_memory,
+        ))
+    else:
+        stages.append({"stage": "analyze_text", "error": "No extracted text was written; skipped."})
+
+    def call_http(func_dir, entry_point, body):
+        response = getattr(functions[func_dir], entry_point)(fakes.FakeRequest(body))
+        status = response[1] if isinstance(response, tuple) and len(response) > 1 else 200
+        if status >= 400:
+            raise RuntimeError(f"HTTP {status}: {str(response[0])[:200]}")
+
+    stages.append(run_stage(
+        "generate_sow",
+        lambda: call_http("sow_generation_func", "generate_sow", {"docId": doc_id, "templateId": "benchmark_template"}),
+        verbose, track_memory,
+    ))
+    stages.append(run_stage(
+        "generate_template",
+        lambda: call_http("template_generation_func", "generate_template", {"sample_files": sample_names, "template_name": "Benchmark Generated"}),
+        verbose, track_memory,
+    ))
+
+    sow = world.documents.get(f"sows/{doc_id}", {})
+    # A large analysis is offloaded to the payload store; read it back the way the functions do.
+    from shared.payload_store import read_field
+    analysis = read_field(fakes.StorageClient(), sow, "analysis") or {}
+    timed = [s for s in stages if "wall_time_s" in s]
+    return {
+        "pages": page_count,
+        "pdf_bytes": len(pdf),
+        "final_status": sow.get("status"),
+        "requirements_found": len(analysis.get("requirements", [])),
+        "stages": stages,
+        "totals": {
+            "wall_time_s": round(sum(s["wall_time_s"] for s in timed), 4),
+            "remote_calls": sum(sum(s["remote_calls"].values()) for s in timed),
+            "bytes_downloaded": sum(s["bytes_downloaded"] for s in timed),
+            "bytes_uploaded": sum(s["bytes_uploaded"] for s in timed),
+            "peak_memory_bytes": max((s["peak_memory_bytes"] for s in timed), default=None) if track_memory else None,
+        },
+    }
+
+
+def parse_pairs(pairs, convert):
+    parsed = {}
+    for pair in pairs or []:
+        key, _, value = pair.partition("=")
+        if not key or not value:
+            raise SystemExit(f"Expected KEY=VALUE, got '{pair}'")
+        parsed[key] = convert(value)
+    return parsed
+
+
+def parse_setting_value(value):
+    try:
+        return json.loads(value)
+    except ValueError:
+        return value
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--pages", type=int, nargs="+", default=DEFAULT_PAGES, help="Synthetic document sizes.")
+    parser.add_argument("--latency-ms", action="append", metavar="CALL=MS", help="Per-call latency to inject.")
+    parser.add_argument("--failure-rate", action="append", metavar="CALL=P", help="Probability of an injected failure per call.")
+    parser.add_argument("--setting", action="append", metavar="KEY=VALUE", help="Override a settings/global_config field.")
+    parser.add_argument("--seed", type=int, default=0, help="Seed for failure injection.")
+    parser.add_argument("--no-memory", action="store_true", help="Skip tracemalloc (it slows the run down).")
+    parser.add_argument("--verbose", action="store_true", help="Show the functions' own log output.")
+    parser.add_argument("--output", help="Write the JSON report to this file instead of stdout.")
+    args = parser.parse_args(argv)
+
+    latency = parse_pairs(args.latency_ms, lambda v: float(v) / 1000.0)
+    failure_rate = parse_pairs(args.failure_rate, float)
+    settings = dict(BASE_SETTINGS)
+    settings.update(parse_pairs(args.setting, parse_setting_value))
+
+    fakes.WORLD = fakes.World(latency=latency, failure_rate=failure_rate, seed=args.seed)
+    functions = {func_dir: load_function(func_dir) for func_dir in FUNCTION_DIRS}
+
+    report = {
+        "config": {
+            "pages": args.pages,
+            "latency_s": latency,
+            "failure_rate": failure_rate,
+            "settings_overrides": parse_pairs(args.setting, parse_setting_value),
+            "seed": args.seed,
+            "memory_tracked": not args.no_memory,
+        },
+        "results": [
+            benchmark_document(functions, pages, settings, args.verbose, not args.no_memory)
+            for pages in args.pages
+        ],
+    }
+
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+    else:
+        print(output)
+
+
+if __name__ == "__main__":
+    main()
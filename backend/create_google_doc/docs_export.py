@@ -0,0 +1,373 @@
+"""
+Markdown to Google Docs export.
+
+The SOW markdown is parsed into sections (one per heading, plus any text
+before the first heading) made of paragraphs, list items and tables. A
+section is rendered as documents.batchUpdate requests in three passes:
+
+  1. All of its text goes in with as few insertText requests as possible,
+     a table standing in as one empty placeholder paragraph. Paragraph
+     styles (merged over runs of equal style), inline bold/italic/code/link
+     styles and one named range per section are then applied to the known
+     offsets.
+  2. List runs get their bullets. createParagraphBullets takes the nesting
+     level from leading tabs and removes them, so runs are bulleted last to
+     first and later offsets are corrected for the removed tabs.
+  3. Tables are inserted last to first at their placeholders, and their
+     cells filled last to first, so no insertion moves an index still to be
+     used.
+
+Each section's named range is called 'sow-section:<hash of its markdown>'.
+A re-export reads the named ranges back from the document, diffs them
+against the new sections and only deletes and re-renders the sections that
+changed, last to first, leaving the rest of the document (and any edits made
+to it in Docs) alone.
+
+All indices are in UTF-16 code units, as the Docs API counts them.
+"""
+import hashlib
+import json
+import re
+from collections import namedtuple
+from difflib import SequenceMatcher
+
+NAMED_RANGE_PREFIX = "sow-section:"
+DEFAULT_MAX_REQUESTS_PER_BATCH = 500
+DEFAULT_MAX_BATCH_BYTES = 1024 * 1024
+# Text is inserted in pieces of at most this many characters, split at paragraph ends.
+MAX_INSERT_CHARS = 50000
+
+BULLET_PRESETS = {"bullet": "BULLET_DISC_CIRCLE_SQUARE", "number": "NUMBERED_DECIMAL_ALPHA_ROMAN"}
+CODE_FONT = {"weightedFontFamily": {"fontFamily": "Courier New"}}
+_RESET_TEXT_FIELDS = "bold,italic,underline,strikethrough,link,weightedFontFamily"
+
+# kind: 'paragraph' or 'table'; style: a Docs namedStyleType; list_kind: None,
+# 'bullet' or 'number'; inline: [(start, end, text_style)] within `text`.
+Block = namedtuple("Block", ["kind", "style", "text", "inline", "list_kind", "level", "rows"])
+Section = namedtuple("Section", ["hash", "blocks"])
+
+_HEADING_RE = re.compile(r"^(#{1,6})\s+(.*?)\s*#*\s*$")
+_BULLET_RE = re.compile(r"^(\s*)[-*+]\s+(.*)$")
+_NUMBERED_RE = re.compile(r"^(\s*)\d+[.)]\s+(.*)$")
+_RULE_RE = re.compile(r"^\s*([-*_])(\s*\1){2,}\s*$")
+_TABLE_SEPARATOR_RE = re.compile(r"^\s*\|?\s*:?-{1,}:?\s*(\|\s*:?-{1,}:?\s*)*\|?\s*$")
+_FENCE_RE = re.compile(r"^\s*(```|~~~)")
+_INLINE_RE = re.compile(
+    r"\\([\\`*_\[\]()#+\-.!|])"           # escaped character
+    r"|\*\*(.+?)\*\*|__(.+?)__"            # bold
+    r"|\*(?!\s)(.+?)\*"                    # italic
+    r"|`([^`]+)`"                          # code
+    r"|\[([^\]]+)\]\(([^)\s]+)\)"          # link
+)
+
+
+def utf16_len(text):
+    return len(text.encode("utf-16-le")) // 2
+
+
+def parse_inline(text):
+    """Returns (plain text, [(start, end, text_style)]) with markdown emphasis, code and links resolved."""
+    plain = []
+    ranges = []
+    position = 0
+    last = 0
+    for match in _INLINE_RE.finditer(text):
+        before = text[last:match.start()]
+        plain.append(before)
+        position += utf16_len(before)
+        escaped, bold, bold_alt, italic, code, link_text, url = match.groups()
+        if escaped is not None:
+            inner, inner_ranges, style = escaped, [], None
+        else:
+            content = bold or bold_alt or italic or code or link_text
+            # Code is literal; everything else may nest emphasis.
+            inner, inner_ranges = (content, []) if code else parse_inline(content)
+            if bold or bold_alt:
+                style = {"bold": True}
+            elif italic:
+                style = {"italic": True}
+            elif code:
+                style = CODE_FONT
+            else:
+                style = {"link": {"url": url}}
+        length = utf16_len(inner)
+        if style and length:
+            ranges.append((position, position + length, style))
+        ranges.extend((position + start, position + end, s) for start, end, s in inner_ranges)
+        plain.append(inner)
+        position += length
+        last = match.end()
+    plain.append(text[last:])
+    return "".join(plain), ranges
+
+
+def _paragraph(text, style="NORMAL_TEXT", list_kind=None, level=0):
+    plain, inline = parse_inline(text)
+    return Block("paragraph", style, plain, inline, list_kind, level, None)
+
+
+def _table_cells(line):
+    line = line.strip()
+    if line.startswith("|"):
+        line = line[1:]
+    if line.endswith("|") and not line.endswith("\\|"):
+        line = line[:-1]
+    return [cell.strip() for cell in re.split(r"(?<!\\)\|", line)]
+
+
+def _indent_level(indent):
+    return len(indent.replace("\t", "    ")) // 2
+
+
+def parse_blocks(lines):
+    """Parses markdown lines into Blocks. Soft-wrapped lines are joined into one paragraph."""
+    blocks = []
+    pending = []
+
+    def flush():
+        if pending:
+            blocks.append(_paragraph(" ".join(line.strip() for line in pending)))
+            pending.clear()
+
+    i = 0
+    while i < len(lines):
+        line = lines[i]
+        if not line.strip():
+            flush()
+        elif _FENCE_RE.match(line):
+            flush()
+            i += 1
+            while i < len(lines) and not _FENCE_RE.match(lines[i]):
+                blocks.append(Block("paragraph", "NORMAL_TEXT", lines[i], [(0, utf16_len(lines[i]), CODE_FONT)] if lines[i] else [], None, 0, None))
+                i += 1
+        elif _HEADING_RE.match(line):
+            flush()
+            hashes, text = _HEADING_RE.match(line).groups()
+            blocks.append(_paragraph(text, f"HEADING_{len(hashes)}"))
+        elif _RULE_RE.match(line):
+            flush()
+        elif line.lstrip().startswith("|") and i + 1 < len(lines) and _TABLE_SEPARATOR_RE.match(lines[i + 1]):
+            flush()
+            rows = [_table_cells(line)]
+            i += 2
+            while i < len(lines) and lines[i].lstrip().startswith("|"):
+                rows.append(_table_cells(lines[i]))
+                i += 1
+            columns = max(len(row) for row in rows)
+            blocks.append(Block("table", None, None, None, None, 0, [row + [""] * (columns - len(row)) for row in rows]))
+            continue
+        elif _BULLET_RE.match(line) or _NUMBERED_RE.match(line):
+            flush()
+            bullet = _BULLET_RE.match(line)
+            indent, text = (bullet or _NUMBERED_RE.match(line)).groups()
+            blocks.append(_paragraph(text, list_kind="bullet" if bullet else "number", level=_indent_level(indent)))
+        elif line.lstrip().startswith(">"):
+            flush()
+            blocks.append(_paragraph(line.lstrip()[1:].strip()))
+        else:
+            pending.append(line)
+        i += 1
+    flush()
+    return blocks
+
+
+def parse_sections(markdown):
+    """Splits the markdown at every heading and parses each part into a Section."""
+    parts = [[]]
+    in_fence = False
+    for line in markdown.splitlines():
+        if _FENCE_RE.match(line):
+            in_fence = not in_fence
+        elif not in_fence and _HEADING_RE.match(line) and parts[-1]:
+            parts.append([])
+        parts[-1].append(line.rstrip())
+    sections = []
+    for lines in parts:
+        blocks = parse_blocks(lines)
+        if blocks:
+            digest = hashlib.sha256("\n".join(lines).strip().encode("utf-8")).hexdigest()[:24]
+            sections.append(Section(digest, blocks))
+    return sections
+
+
+def _text_style_request(start, end, style):
+    return {"updateTextStyle": {
+        "range": {"startIndex": start, "endIndex": end},
+        "textStyle": style,
+        "fields": ",".join(style),
+    }}
+
+
+def _insert_text_requests(text, index):
+    requests = []
+    while text:
+        piece = text[:MAX_INSERT_CHARS]
+        if len(piece) < len(text):
+            cut = piece.rfind("\n") + 1
+            piece = piece[:cut] if cut else piece
+        requests.append({"insertText": {"location": {"index": index}, "text": piece}})
+        index += utf16_len(piece)
+        text = text[len(piece):]
+    return requests
+
+
+def _table_requests(index, rows):
+    """insertTable at an empty paragraph at `index`, then the cells, last to first."""
+    columns = len(rows[0])
+    requests = [{"insertTable": {"rows": len(rows), "columns": columns, "location": {"index": index}}}]
+    # A newline is inserted before the table; each row and each cell take one
+    # index, and an empty cell holds a single newline.
+    table_start = index + 1
+    for r in reversed(range(len(rows))):
+        for c in reversed(range(columns)):
+            text, inline = parse_inline(rows[r][c])
+            if not text:
+                continue
+            cell = table_start + 3 + r * (2 * columns + 1) + 2 * c
+            requests.append({"insertText": {"location": {"index": cell}, "text": text}})
+            if r == 0:
+                requests.append(_text_style_request(cell, cell + utf16_len(text), {"bold": True}))
+            requests.extend(_text_style_request(cell + start, cell + end, style) for start, end, style in inline)
+    return requests
+
+
+def render_sections(sections, index):
+    """Returns the requests that insert `sections` at body index `index`."""
+    text = []
+    cursor = index
+    paragraph_styles = []     # [start, end, namedStyleType], merged
+    inline_styles = []
+    bullet_runs = []          # [start, end, list_kind]
+    tables = []               # (placeholder index, rows, tabs before it)
+    named_ranges = []
+    tabs = 0
+
+    def add_paragraph(content, style):
+        nonlocal cursor
+        start = cursor
+        text.append(content + "\n")
+        cursor += utf16_len(content) + 1
+        if paragraph_styles and paragraph_styles[-1][2] == style and paragraph_styles[-1][1] == start:
+            paragraph_styles[-1][1] = cursor
+        else:
+            paragraph_styles.append([start, cursor, style])
+        return start
+
+    for section in sections:
+        section_start = cursor
+        for block in section.blocks:
+            if block.kind == "table":
+                tables.append((cursor, block.rows, tabs))
+                add_paragraph("", "NORMAL_TEXT")
+                continue
+            prefix = "\t" * block.level if block.list_kind else ""
+            start = add_paragraph(prefix + block.text, block.style)
+            offset = start + len(prefix)
+            inline_styles.extend((offset + s, offset + e, style) for s, e, style in block.inline)
+            if block.list_kind:
+                if bullet_runs and bullet_runs[-1][2] == block.list_kind and bullet_runs[-1][1] == start:
+                    bullet_runs[-1][1] = cursor
+                else:
+                    bullet_runs.append([start, cursor, block.list_kind])
+                tabs += block.level
+        named_ranges.append((NAMED_RANGE_PREFIX + section.hash, section_start, cursor))
+
+    if cursor == index:
+        return []
+    requests = _insert_text_requests("".join(text), index)
+    # Inserted text takes on the style of its surroundings, so it is reset first.
+    requests.append({"updateTextStyle": {
+        "range": {"startIndex": index, "endIndex": cursor}, "textStyle": {}, "fields": _RESET_TEXT_FIELDS,
+    }})
+    requests.append({"deleteParagraphBullets": {"range": {"startIndex": index, "endIndex": cursor}}})
+    requests.extend({"updateParagraphStyle": {
+        "range": {"startIndex": start, "endIndex": end},
+        "paragraphStyle": {"namedStyleType": style},
+        "fields": "namedStyleType",
+    }} for start, end, style in paragraph_styles)
+    requests.extend(_text_style_request(start, end, style) for start, end, style in inline_styles)
+    requests.extend({"createNamedRange": {"name": name, "range": {"startIndex": start, "endIndex": end}}}
+                    for name, start, end in named_ranges)
+    requests.extend({"createParagraphBullets": {
+        "range": {"startIndex": start, "endIndex": end},
+        "bulletPreset": BULLET_PRESETS[kind],
+    }} for start, end, kind in reversed(bullet_runs))
+    for placeholder, rows, tabs_before in reversed(tables):
+        requests.extend(_table_requests(placeholder - tabs_before, rows))
+    return requests
+
+
+def exported_sections(document):
+    """Returns the sections a previous export left in `document`, in document order."""
+    sections = []
+    for name, group in (document.get("namedRanges") or {}).items():
+        if not name.startswith(NAMED_RANGE_PREFIX):
+            continue
+        for named_range in group.get("namedRanges", []):
+            spans = [span for span in named_range.get("ranges", []) if not span.get("segmentId")]
+            if not spans:
+                continue
+            sections.append({
+                "hash": name[len(NAMED_RANGE_PREFIX):],
+                "id": named_range["namedRangeId"],
+                "start": min(span.get("startIndex", 0) for span in spans),
+                "end": max(span.get("endIndex", 0) for span in spans),
+            })
+    return sorted(sections, key=lambda section: section["start"])
+
+
+def _delete_requests(old_sections, start, end):
+    requests = [{"deleteNamedRange": {"namedRangeId": section["id"]}} for section in old_sections]
+    if end > start:
+        requests.append({"deleteContentRange": {"range": {"startIndex": start, "endIndex": end}}})
+    return requests
+
+
+def plan_update(document, sections):
+    """
+    Returns (requests, sections re-rendered) that bring an existing document
+    in line with `sections`. Without sections from an earlier export, the
+    whole body is replaced.
+    """
+    old = exported_sections(document)
+    if not old:
+        body_end = document["body"]["content"][-1]["endIndex"]
+        # The body's final newline cannot be deleted.
+        requests = _delete_requests([], 1, body_end - 1)
+        return requests + render_sections(sections, 1), len(sections)
+
+    requests = []
+    rendered = 0
+    matcher = SequenceMatcher(a=[s["hash"] for s in old], b=[s.hash for s in sections], autojunk=False)
+    # Last to first, so every index still to be used stays valid.
+    for tag, i1, i2, j1, j2 in reversed(matcher.get_opcodes()):
+        if tag == "equal":
+            continue
+        if i1 < i2:
+            position = old[i1]["start"]
+            requests.extend(_delete_requests(old[i1:i2], position, old[i2 - 1]["end"]))
+        else:
+            position = old[i1]["start"] if i1 < len(old) else old[-1]["end"]
+        requests.extend(render_sections(sections[j1:j2], position))
+        rendered += j2 - j1
+    return requests, rendered
+
+
+def batch_requests(requests, max_requests=DEFAULT_MAX_REQUESTS_PER_BATCH, max_bytes=DEFAULT_MAX_BATCH_BYTES):
+    """
+    Splits `requests` into consecutive batchUpdate bodies of at most
+    `max_requests` requests and about `max_bytes` of JSON. Batches are sent
+    in order, so the indices computed for the whole list stay valid.
+    """
+    batches = []
+    current, size = [], 0
+    for request in requests:
+        request_bytes = len(json.dumps(request, separators=(",", ":")))
+        if current and (len(current) >= max_requests or size + request_bytes > max_bytes):
+            batches.append(current)
+            current, size = [], 0
+        current.append(request)
+        size += request_bytes
+    if current:
+        batches.append(current)
+    return batches
@@ -1,67 +1,111 @@
 import functions_framework
+import hashlib
 from google.cloud import firestore
-from googleapiclient.discovery import build
-from google.oauth2 import service_account
+from googleapiclient.errors import HttpError
+from docs_export import DEFAULT_MAX_BATCH_BYTES, DEFAULT_MAX_REQUESTS_PER_BATCH, batch_requests, parse_sections, plan_update, render_sections
+from shared.instrumentation import StageRecorder, resolve_trace_id
+from shared.payload_store import read_field
+from shared.pipeline_state import StageWrites
+from shared.runtime import get_docs_service, get_firestore_client, get_settings, get_storage_client
+
+DOC_URL_FORMAT = "https://docs.google.com/document/d/{}/edit"
+
+
+def load_linked_document(service, google_doc_id):
+    """Returns the linked document's body end and named ranges, or None if it no longer exists."""
+    try:
+        return service.documents().get(
+            documentId=google_doc_id, fields="documentId,body(content(endIndex)),namedRanges"
+        ).execute()
+    except HttpError as e:
+        if e.resp.status in (403, 404):
+            print(f"Linked Google Doc {google_doc_id} is not accessible ({e.resp.status}); creating a new one.")
+            return None
+        raise
+
 
 @functions_framework.http
 def create_doc(request):
     """
-    An HTTP-triggered function that creates a new Google Doc from SOW text.
+    An HTTP-triggered function that exports the SOW markdown to Google Docs
+    with its headings, lists and tables (see docs_export.py). The first export
+    creates the document; later ones update the linked document in place,
+    re-writing only the sections that changed since the last export.
     """
-    # We need the service account key to create an authenticated Docs client
-    # In a real app, you'd use a more secure way to get these credentials.
-    # For this demo, we assume the function's own SA has access.
-    # It needs "Google Docs API" enabled and potentially domain-wide delegation.
-    
-    # NOTE: This part is complex and often requires special auth setup.
-    # This code provides the basic structure.
-    
-    request_json = request.get_json(silent=True)
+    request_json = request.get_json(silent=True) or {}
     doc_id = request_json.get('docId')
 
     if not doc_id:
         return ("Missing 'docId' in request body.", 400)
 
+    recorder = StageRecorder("create_doc", doc_id)
+    doc_ref = None
+    saved = False
     try:
-        db = firestore.Client()
+        db = get_firestore_client()
         doc_ref = db.collection('sows').document(doc_id)
-        doc_data = doc_ref.get().to_dict()
-        sow_text = doc_data.get('generated_sow', '# Error: SOW Text Not Found')
-        
-        # This uses the function's default service account credentials
-        creds = service_account.Credentials.from_service_account_file(
-            'PATH_TO_YOUR_SA_KEY.json',  # This needs to be handled securely
-            scopes=['https://www.googleapis.com/auth/documents']
-        )
-
-        service = build('docs', 'v1', credentials=creds)
-
-        title = f"SOW Draft: {doc_data.get('original_filename', doc_id)}"
-        body = {
-            'title': title,
-            'body': {
-                'content': [
-                    {
-                        'paragraph': {
-                            'elements': [
-                                {'textRun': {'content': sow_text}}
-                            ]
-                        }
-                    }
-                ]
-            }
-        }
-        
-        document = service.documents().create(body=body).execute()
-        doc_url = f"https://docs.google.com/document/d/{document.get('documentId')}/edit"
-        
-        print(f"Created document with ID: {document.get('documentId')}")
-        
-        # Save the URL back to Firestore
-        doc_ref.update({'google_doc_url': doc_url})
-        
-        return ({'doc_url': doc_url}, 200)
+        with recorder.stage("firestore.read"):
+            doc_data = doc_ref.get().to_dict() or {}
+            recorder.trace_id = resolve_trace_id(doc_data)
+        with recorder.stage("gcs.download_payload"):
+            sow_text = read_field(get_storage_client(), doc_data, 'generated_sow', '# Error: SOW Text Not Found')
+        sow_hash = hashlib.sha256(sow_text.encode('utf-8')).hexdigest()
+
+        settings = get_settings()
+        MAX_REQUESTS_PER_BATCH = int(settings.get('docs_export_max_requests_per_batch', DEFAULT_MAX_REQUESTS_PER_BATCH))
+        MAX_BATCH_BYTES = int(settings.get('docs_export_max_batch_bytes', DEFAULT_MAX_BATCH_BYTES))
+
+        google_doc_id = doc_data.get('google_doc_id')
+        if google_doc_id and doc_data.get('google_doc_hash') == sow_hash:
+            print(f"Google Doc {google_doc_id} is already up to date.")
+            return ({'doc_url': DOC_URL_FORMAT.format(google_doc_id), 'mode': 'unchanged', 'sections_updated': 0}, 200)
+
+        # Built once per instance from the bundled discovery document.
+        service = get_docs_service()
+        sections = parse_sections(sow_text)
+
+        document = None
+        if google_doc_id:
+            with recorder.stage("docs.get"):
+                document = load_linked_document(service, google_doc_id)
+
+        if document is not None:
+            requests, sections_updated = plan_update(document, sections)
+            mode = 'updated'
+        else:
+            title = f"SOW Draft: {doc_data.get('original_filename', doc_id)}"
+            with recorder.stage("docs.create"):
+                google_doc_id = service.documents().create(body={'title': title}).execute()['documentId']
+            print(f"Created document with ID: {google_doc_id}")
+            requests, sections_updated = render_sections(sections, 1), len(sections)
+            mode = 'created'
+
+        batches = batch_requests(requests, MAX_REQUESTS_PER_BATCH, MAX_BATCH_BYTES)
+        with recorder.stage("docs.batch_update", requests=len(requests), batches=len(batches)):
+            # In order: each batch's indices assume the previous batches were applied.
+            for batch in batches:
+                service.documents().batchUpdate(documentId=google_doc_id, body={'requests': batch}).execute()
+        print(f"Exported {sections_updated} of {len(sections)} sections in {len(requests)} requests ({len(batches)} batches).")
+
+        doc_url = DOC_URL_FORMAT.format(google_doc_id)
+        # Save the link and the exported version back to Firestore, together with the stage timings
+        writes = StageWrites(db)
+        writes.set_fields(doc_ref, {
+            'google_doc_url': doc_url,
+            'google_doc_id': google_doc_id,
+            'google_doc_hash': sow_hash,
+            'google_doc_exported_at': firestore.SERVER_TIMESTAMP,
+        })
+        recorder.flush(doc_ref, writes)
+        writes.commit()
+        saved = True
+
+        return ({'doc_url': doc_url, 'mode': mode, 'sections_updated': sections_updated}, 200)
 
     except Exception as e:
         print(f"!!! CRITICAL ERROR creating Google Doc: {e}")
-        return (f"An error occurred: {e}", 500)
\ No newline at end of file
+        return (f"An error occurred: {e}", 500)
+    finally:
+        # A saved URL already carries the timings.
+        if not saved:
+            recorder.flush(doc_ref)
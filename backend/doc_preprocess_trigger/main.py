@@ -1,26 +1,327 @@
 import functions_framework
-from google.cloud import documentai, storage, firestore
+from google.cloud import documentai, firestore
 from PyPDF2 import PdfReader
 import os
 import io
-# --- FIX #1: Import ClientOptions from the correct library ---
-from google.api_core.client_options import ClientOptions
+import json
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from shared.bulk_batches import (
+    BULK_BATCH_COLLECTION, DEFAULT_BULK_UPLOAD_PREFIX, MANIFEST_SUFFIX, batch_record, bulk_doc_id,
+    new_batch_id, output_prefix, parse_gcs_uri, plan_batches
+)
+from shared.idempotency import EventLease
+from shared.instrumentation import StageRecorder, resolve_trace_id
+from shared.page_index import SOURCE_MD5_KEY, build_page_index, document_page_spans, upload_page_index
+from shared.pipeline_state import OCR_FAILED, PROCESSING_OCR, ProgressWriter, StageWrites, status_fields
+from shared.runtime import get_docai_client, get_firestore_client, get_settings, get_storage_client
+from pdf_probe import page_count_from_metadata, probe_page_count
+
+
+def get_page_count(blob, size, metadata, full_parse_max_bytes):
+    """
+    Determines the page count without downloading the whole PDF when possible:
+    an upload-time metadata hint first, then a ranged probe of the PDF
+    structure, and only then a full parse for files up to
+    `full_parse_max_bytes`. Returns (page_count or None, method).
+    """
+    hinted = page_count_from_metadata(metadata)
+    if hinted:
+        return hinted, "metadata"
+
+    if not size:
+        blob.reload()
+        size = blob.size or 0
+
+    page_count, bytes_read = probe_page_count(
+        lambda start, end: blob.download_as_bytes(start=start, end=end), size
+    )
+    if page_count:
+        print(f"  -> Ranged probe read {bytes_read} of {size} bytes.")
+        return page_count, "ranged_probe"
+
+    if size <= full_parse_max_bytes:
+        reader = PdfReader(io.BytesIO(blob.download_as_bytes()))
+        return len(reader.pages), "full_parse"
+
+    print(f"  -> Could not probe page count and file is too large ({size} bytes) for a full parse.")
+    return None, "unknown"
+
+def process_pages_in_parallel(docai_client, processor_path, gcs_uri, page_count, pages_per_shard, max_concurrency, progress, recorder):
+    """
+    Splits the document into page-range shards small enough for synchronous
+    Document AI, processes them concurrently and returns the text of all
+    shards joined in page order with the pages' (start, end) spans in it.
+    Shard completion is reported to `progress`, a throttled ProgressWriter on
+    the sows document.
+    """
+    shards = [
+        list(range(first_page, min(first_page + pages_per_shard - 1, page_count) + 1))
+        for first_page in range(1, page_count + 1, pages_per_shard)
+    ]
+    progress.report(ocr_shard_count=len(shards), ocr_shards_completed=0)
+    completed_lock = threading.Lock()
+    completed = [0]
+    print(f"Processing {page_count} pages as {len(shards)} parallel shards of up to {pages_per_shard} pages.")
+
+    def process_shard(pages):
+        request = documentai.ProcessRequest(
+            name=processor_path,
+            gcs_document=documentai.GcsDocument(gcs_uri=gcs_uri, mime_type="application/pdf"),
+            process_options=documentai.ProcessOptions(
+                individual_page_selector=documentai.ProcessOptions.IndividualPageSelector(pages=pages)
+            ),
+        )
+        with recorder.stage("docai.process_shard", pages=len(pages)):
+            document = docai_client.process_document(request=request).document
+        with completed_lock:
+            completed[0] += 1
+            progress.report(ocr_shards_completed=completed[0])
+        print(f"  -> Shard for pages {pages[0]}-{pages[-1]} complete ({len(document.text)} characters).")
+        return document.text, document_page_spans(document)
+
+    with ThreadPoolExecutor(max_workers=max(1, min(max_concurrency, len(shards)))) as executor:
+        results = list(executor.map(process_shard, shards))
+    progress.flush()
+    # Each shard's page spans are relative to its own text.
+    page_spans, offset = [], 0
+    for text, spans in results:
+        page_spans.extend((start + offset, end + offset) for start, end in spans)
+        offset += len(text)
+    return "".join(text for text, _ in results), page_spans
+
+
+def save_extracted_text(output_bucket, doc_id, document_text, page_spans, recorder, source_md5=None):
+    """
+    Writes the page index sidecar and then the text, whose upload triggers
+    the analysis (see shared/page_index.py). `source_md5` is the MD5 hash of
+    the PDF the text came from.
+    """
+    metadata = {"trace_id": recorder.trace_id}
+    if source_md5:
+        metadata[SOURCE_MD5_KEY] = source_md5
+    with recorder.stage("gcs.upload_page_index") as span:
+        index = build_page_index(document_text, page_spans)
+        span["bytes"] = upload_page_index(output_bucket, doc_id, index, metadata)
+    output_blob = output_bucket.blob(f"{doc_id}.txt")
+    output_blob.metadata = metadata
+    with recorder.stage("gcs.upload", bytes=len(document_text.encode("utf-8"))):
+        output_blob.upload_from_string(document_text)
+    print(f"  -> Indexed {len(index['pages'])} pages and {len(index['sections'])} section headings.")
+    return output_blob
+
+
+def submit_batch(docai_client, processor_path, gcs_uris, output_uri, pages_per_shard):
+    """Starts one Document AI batch request for `gcs_uris`, writing JSON output under `output_uri`."""
+    gcs_documents = documentai.GcsDocuments(documents=[
+        documentai.GcsDocument(gcs_uri=gcs_uri, mime_type="application/pdf") for gcs_uri in gcs_uris
+    ])
+    input_config = documentai.BatchDocumentsInputConfig(gcs_documents=gcs_documents)
+
+    # Page-sharded output lets batch_result_handler extract each shard in parallel.
+    gcs_output_config = documentai.DocumentOutputConfig.GcsOutputConfig(gcs_uri=output_uri)
+    if pages_per_shard > 0:
+        gcs_output_config.sharding_config = documentai.DocumentOutputConfig.GcsOutputConfig.ShardingConfig(
+            pages_per_shard=pages_per_shard
+        )
+    output_config = documentai.DocumentOutputConfig(gcs_output_config=gcs_output_config)
+    request = documentai.BatchProcessRequest(
+        name=processor_path,
+        input_documents=input_config,
+        document_output_config=output_config,
+    )
+    return docai_client.batch_process_documents(request=request)
+
+
+def run_bulk_ingest(db, storage_client, settings, recorder, uris=None, prefix=None, source="http", force=False):
+    """
+    OCRs many uploaded PDFs with a few multi-document batch requests instead
+    of one process_pdf invocation each. Takes explicit GCS URIs and/or an
+    uploads-bucket prefix. Creates every sows record up front, groups the
+    small documents with plan_batches and records each request's input
+    order in bulk_batches so batch_result_handler can fan the output back
+    out. Documents that already have a sows record are skipped unless
+    `force` is set. Returns a summary for the caller.
+    """
+    GCP_PROJECT_NUMBER = settings.get("gcp_project_number")
+    DOCAI_PROCESSOR_ID = settings.get("docai_processor_id")
+    DOCAI_LOCATION = settings.get("docai_location", "us")
+    UPLOADS_BUCKET_NAME = settings.get("uploads_bucket", "sow-forge-texas-dmv-uploads")
+    BATCH_OUTPUT_BUCKET_NAME = settings.get("batch_output_bucket")
+    FULL_PARSE_MAX_BYTES = int(settings.get("page_probe_full_parse_max_bytes", 32 * 1024 * 1024))
+    BATCH_PAGES_PER_SHARD = int(settings.get("docai_batch_pages_per_shard", 50))
+    SMALL_DOCUMENT_MAX_PAGES = int(settings.get("bulk_small_document_max_pages", 50))
+    MAX_DOCUMENTS_PER_BATCH = int(settings.get("bulk_max_documents_per_batch", 100))
+    PROBE_CONCURRENCY = int(settings.get("bulk_page_probe_concurrency", 8))
+
+    if not all([GCP_PROJECT_NUMBER, DOCAI_PROCESSOR_ID, DOCAI_LOCATION, BATCH_OUTPUT_BUCKET_NAME]):
+        raise Exception("Required Document AI settings are missing from Firestore.")
+    docai_client = get_docai_client(DOCAI_LOCATION)
+    PROCESSOR_PATH = f"projects/{GCP_PROJECT_NUMBER}/locations/{DOCAI_LOCATION}/processors/{DOCAI_PROCESSOR_ID}"
+
+    # --- 1. Collect the PDFs to ingest ---
+    skipped = []
+    blobs = []
+    with recorder.stage("gcs.list"):
+        if prefix is not None:
+            blobs.extend(storage_client.list_blobs(UPLOADS_BUCKET_NAME, prefix=prefix))
+        for uri in uris or []:
+            bucket_name, name = parse_gcs_uri(uri, UPLOADS_BUCKET_NAME)
+            blob = storage_client.bucket(bucket_name).get_blob(name)
+            if blob is None:
+                skipped.append({"uri": uri, "reason": "not found"})
+                continue
+            blobs.append(blob)
+
+    candidates = {}
+    for blob in blobs:
+        uri = f"gs://{blob.bucket.name}/{blob.name}"
+        if not blob.name.lower().endswith(".pdf"):
+            continue
+        doc_id = bulk_doc_id(blob.name)
+        if doc_id in candidates:
+            skipped.append({"uri": uri, "reason": f"duplicate document id '{doc_id}'"})
+            continue
+        candidates[doc_id] = blob
+    print(f"Bulk ingestion found {len(candidates)} PDFs.")
+
+    # --- 2. Skip documents that are already in the pipeline (one batched read) ---
+    if candidates and not force:
+        refs = [db.collection("sows").document(doc_id) for doc_id in candidates]
+        with recorder.stage("firestore.read", documents=len(refs)):
+            existing = [snapshot.id for snapshot in db.get_all(refs) if snapshot.exists]
+        for doc_id in existing:
+            blob = candidates.pop(doc_id)
+            skipped.append({"uri": f"gs://{blob.bucket.name}/{blob.name}", "reason": "already ingested"})
+
+    # --- 3. Probe page counts concurrently ---
+    def describe(item):
+        doc_id, blob = item
+        page_count, method = get_page_count(blob, blob.size, blob.metadata, FULL_PARSE_MAX_BYTES)
+        return {
+            "doc_id": doc_id,
+            "uri": f"gs://{blob.bucket.name}/{blob.name}",
+            "name": blob.name,
+            "metadata": blob.metadata or {},
+            "md5_hash": blob.md5_hash,
+            "page_count": page_count,
+            "page_count_method": method,
+        }
+
+    with recorder.stage("gcs.page_count", documents=len(candidates)):
+        with ThreadPoolExecutor(max_workers=max(1, min(PROBE_CONCURRENCY, len(candidates) or 1))) as executor:
+            documents = list(executor.map(describe, candidates.items()))
+
+    # --- 4. Record and submit each batch request ---
+    batches = []
+    for group in plan_batches(documents, SMALL_DOCUMENT_MAX_PAGES, MAX_DOCUMENTS_PER_BATCH):
+        batch_id = new_batch_id()
+        batch_ref = db.collection(BULK_BATCH_COLLECTION).document(batch_id)
+        sow_refs = [db.collection("sows").document(document["doc_id"]) for document in group]
+
+        # The mapping and the records must exist before Document AI writes any output.
+        writes = StageWrites(db)
+        writes.set_fields(batch_ref, batch_record(batch_id, group, source))
+        for sow_ref, document in zip(sow_refs, group):
+            record = status_fields(
+                PROCESSING_OCR,
+                original_filename=document["name"],
+                display_name=os.path.basename(document["name"]),
+                page_count=document["page_count"],
+                page_count_method=document["page_count_method"],
+                processing_method="bulk_batch",
+                bulk_batch_id=batch_id,
+                created_at=firestore.SERVER_TIMESTAMP,
+                is_template_sample=False,
+                source_md5_hash=document["md5_hash"],
+                trace_id=resolve_trace_id(document["metadata"]),
+            )
+            if document["metadata"].get("bill_id"):
+                record["bill_id"] = document["metadata"]["bill_id"]
+            writes.set_fields(sow_ref, record)
+        with recorder.stage("firestore.write", documents=len(group)):
+            writes.commit()
+
+        try:
+            with recorder.stage("docai.batch_submit", documents=len(group),
+                                pages=sum(document["page_count"] or 0 for document in group)):
+                operation = submit_batch(
+                    docai_client, PROCESSOR_PATH, [document["uri"] for document in group],
+                    f"gs://{BATCH_OUTPUT_BUCKET_NAME}/{output_prefix(batch_id)}", BATCH_PAGES_PER_SHARD
+                )
+            batch_ref.update({"status": "SUBMITTED", "operation_name": operation.operation.name})
+            print(f"Bulk batch {batch_id} started for {len(group)} documents. Operation name: {operation.operation.name}")
+            batches.append({"batch_id": batch_id, "documents": len(group), "operation": operation.operation.name})
+        except Exception as e:
+            print(f"!!! CRITICAL ERROR submitting bulk batch {batch_id}: {e}")
+            failed = StageWrites(db)
+            failed.set_fields(batch_ref, {"status": "FAILED", "error_message": str(e)})
+            for sow_ref in sow_refs:
+                failed.set_fields(sow_ref, status_fields(OCR_FAILED, error_message=str(e)))
+            failed.commit()
+            batches.append({"batch_id": batch_id, "documents": len(group), "error": str(e)})
+
+    return {
+        "documents": sum(batch["documents"] for batch in batches if "error" not in batch),
+        "batches": batches,
+        "skipped": skipped,
+    }
+
+
+@functions_framework.http
+def bulk_ingest(request):
+    """
+    An HTTP-triggered function that OCRs many uploads at once. Send
+    {"uris": ["gs://bucket/HB1.pdf", ...]} and/or {"prefix": "bulk/session/"}
+    (a prefix in the uploads bucket); {"force": true} re-ingests documents
+    that already have a record.
+    """
+    request_json = request.get_json(silent=True) or {}
+    uris = request_json.get("uris")
+    prefix = request_json.get("prefix")
+    if not uris and prefix is None:
+        return ("Provide 'uris' or 'prefix' in the request body.", 400)
+    if uris is not None and not isinstance(uris, list):
+        return ("'uris' must be a list of GCS URIs.", 400)
+
+    recorder = StageRecorder("bulk_ingest")
+    try:
+        summary = run_bulk_ingest(
+            get_firestore_client(), get_storage_client(), get_settings(), recorder,
+            uris=uris, prefix=prefix, source="http", force=bool(request_json.get("force", False))
+        )
+        return (summary, 200)
+    except Exception as e:
+        print(f"!!! CRITICAL ERROR in bulk_ingest: {e}")
+        return (f"An error occurred: {e}", 500)
+    finally:
+        recorder.flush(None)
+
 
 @functions_framework.cloud_event
 def process_pdf(cloud_event):
     """
     Acts as a router for incoming legislative bill PDFs.
     """
-    # --- Initialize clients ---
-    storage_client = storage.Client()
-    db = firestore.Client()
+    # --- Reuse clients from the warm instance ---
+    storage_client = get_storage_client()
+    db = get_firestore_client()
     
-    file_name = "unknown_file" 
+    file_name = "unknown_file"
+    # Set once the upload is known to be a bill rather than a bulk manifest.
+    doc_id = None
+    recorder = StageRecorder("process_pdf")
+    # Final status, timings and the lease update are committed together.
+    writes = StageWrites(db)
+
+    # --- Skip duplicate deliveries of the same upload ---
+    lease = EventLease(db, "process_pdf", cloud_event.data)
+    if not lease.acquire():
+        return
 
     try:
-        # --- 1. Fetch Global Settings from Firestore ---
-        settings_ref = db.collection('settings').document('global_config')
-        settings = settings_ref.get().to_dict()
+        # --- 1. Fetch Global Settings (cached per instance) ---
+        settings = get_settings()
 
         GCP_PROJECT_NUMBER = settings.get("gcp_project_number")
         DOCAI_PROCESSOR_ID = settings.get("docai_processor_id")
@@ -28,13 +329,20 @@ def process_pdf(cloud_event):
         SYNC_PAGE_LIMIT = int(settings.get("sync_page_limit", 15))
         OUTPUT_TEXT_BUCKET_NAME = settings.get("processed_text_bucket")
         BATCH_OUTPUT_BUCKET_NAME = settings.get("batch_output_bucket")
+        FULL_PARSE_MAX_BYTES = int(settings.get("page_probe_full_parse_max_bytes", 32 * 1024 * 1024))
+        # 'parallel_sync' fans large documents out as concurrent sync requests;
+        # 'batch' (default) submits one batch job with page-sharded output.
+        SHARDING_MODE = settings.get("docai_sharding_mode", "batch")
+        MAX_SYNC_SHARDS = int(settings.get("docai_max_sync_shards", 40))
+        DOCAI_MAX_CONCURRENCY = int(settings.get("docai_max_concurrency", 4))
+        BATCH_PAGES_PER_SHARD = int(settings.get("docai_batch_pages_per_shard", 50))
+        PROGRESS_INTERVAL = float(settings.get("progress_write_interval_seconds", 5))
+        BULK_UPLOAD_PREFIX = settings.get("bulk_upload_prefix", DEFAULT_BULK_UPLOAD_PREFIX)
         
         if not all([GCP_PROJECT_NUMBER, DOCAI_PROCESSOR_ID, DOCAI_LOCATION]):
             raise Exception("Required Document AI settings are missing from Firestore.")
 
-        # --- FIX #2: Correctly initialize the Document AI client ---
-        opts = ClientOptions(api_endpoint=f"{DOCAI_LOCATION}-documentai.googleapis.com")
-        docai_client = documentai.DocumentProcessorServiceClient(client_options=opts)
+        docai_client = get_docai_client(DOCAI_LOCATION)
         PROCESSOR_PATH = f"projects/{GCP_PROJECT_NUMBER}/locations/{DOCAI_LOCATION}/processors/{DOCAI_PROCESSOR_ID}"
         print(f"Using configuration - Processor: {DOCAI_PROCESSOR_ID}")
 
@@ -42,62 +350,133 @@ def process_pdf(cloud_event):
         data = cloud_event.data
         bucket_name = data["bucket"]
         file_name = data["name"]
-        
         source_bucket = storage_client.bucket(bucket_name)
         blob = source_bucket.blob(file_name)
+
+        # Bulk uploads are OCR'd together by bulk ingestion, which a manifest
+        # upload starts. Only metadata updates (the dashboard's "regenerate")
+        # send a single bulk upload through this function.
+        if BULK_UPLOAD_PREFIX and file_name.startswith(BULK_UPLOAD_PREFIX):
+            if file_name.endswith(MANIFEST_SUFFIX):
+                manifest = json.loads(blob.download_as_text() or "{}")
+                uris, prefix = manifest.get("uris"), manifest.get("prefix")
+                if not uris and prefix is None:
+                    # A bare manifest ingests the folder it was uploaded to.
+                    prefix = os.path.dirname(file_name) + "/"
+                print(f"Starting bulk ingestion from manifest '{file_name}'.")
+                summary = run_bulk_ingest(
+                    db, storage_client, settings, recorder, uris=uris, prefix=prefix,
+                    source=f"manifest:{file_name}", force=bool(manifest.get("force", False))
+                )
+                print(f"Bulk ingestion submitted {summary['documents']} documents in {len(summary['batches'])} batches; skipped {len(summary['skipped'])}.")
+                lease.complete(writes)
+                return
+            if str(data.get("metageneration") or "1") == "1":
+                print(f"'{file_name}' is a bulk upload; it will be processed by bulk ingestion.")
+                lease.complete(writes)
+                return
+
+        # Bulk uploads are named after the bare file name (as bulk ingestion names them);
+        # other uploads keep their folder in the id.
+        if BULK_UPLOAD_PREFIX and file_name.startswith(BULK_UPLOAD_PREFIX):
+            doc_id = bulk_doc_id(file_name)
+        else:
+            doc_id = os.path.splitext(file_name)[0]
+        # Uploads may carry a trace id; otherwise this is where the document's trace starts.
+        recorder.doc_id = doc_id
+        recorder.trace_id = resolve_trace_id(data.get("metadata"))
         
-        # --- 4. Get Page Count ---
-        pdf_bytes = blob.download_as_bytes()
-        reader = PdfReader(io.BytesIO(pdf_bytes))
-        page_count = len(reader.pages)
-        print(f"Processing '{file_name}': Found {page_count} pages.")
+        # --- 4. Get Page Count (without downloading the whole file where possible) ---
+        with recorder.stage("gcs.page_count") as span:
+            page_count, page_count_method = get_page_count(
+                blob, int(data.get("size") or 0), data.get("metadata"), FULL_PARSE_MAX_BYTES
+            )
+            span["method"] = page_count_method
+        print(f"Processing '{file_name}': Found {page_count} pages (via {page_count_method}).")
         
-        # --- 5. Create Firestore Record ---
-        doc_id = os.path.splitext(file_name)[0]
+        # --- 5. Choose Sync, Parallel Sync or Batch Processing ---
+        # Unknown page counts go to batch, which has no page limit.
+        if page_count is not None and page_count <= SYNC_PAGE_LIMIT:
+            processing_method = "sync"
+        elif (SHARDING_MODE == "parallel_sync" and page_count is not None
+              and page_count <= SYNC_PAGE_LIMIT * MAX_SYNC_SHARDS):
+            processing_method = "parallel_sync"
+        else:
+            processing_method = "batch"
+
+        # --- 6. Create Firestore Record (one write for everything known up front) ---
         doc_ref = db.collection("sows").document(doc_id)
-        doc_ref.set({
-            "original_filename": file_name,
-            "display_name": file_name,
-            "status": "PROCESSING_OCR",
-            "page_count": page_count,
-            "created_at": firestore.SERVER_TIMESTAMP,
-            "last_updated_at": firestore.SERVER_TIMESTAMP,
-            "is_template_sample": False
-        }, merge=True)
+        initial_record = status_fields(
+            PROCESSING_OCR,
+            original_filename=file_name,
+            display_name=file_name,
+            page_count=page_count,
+            page_count_method=page_count_method,
+            processing_method=processing_method,
+            created_at=firestore.SERVER_TIMESTAMP,
+            is_template_sample=False,
+            # Batch results carry this over to the extracted text's metadata.
+            source_md5_hash=data.get("md5Hash"),
+            trace_id=recorder.trace_id,
+        )
+        # Uploads can name the bill explicitly so later versions are analyzed incrementally.
+        bill_id = (data.get("metadata") or {}).get("bill_id")
+        if bill_id:
+            initial_record["bill_id"] = bill_id
+        with recorder.stage("firestore.write"):
+            doc_ref.set(initial_record, merge=True)
         print(f"Created initial SOW document with ID: {doc_id}")
 
-        # --- 6. Route to Sync or Batch Processing ---
-        if page_count <= SYNC_PAGE_LIMIT:
+        # --- 7. Extract the Text ---
+        # The sync paths leave the status at PROCESSING_OCR: writing
+        # TEXT_EXTRACTED after the upload could land after analyze_text has
+        # already set ANALYZING.
+        if processing_method == "sync":
             print("Using synchronous processing.")
             gcs_document = documentai.GcsDocument(gcs_uri=f"gs://{bucket_name}/{file_name}", mime_type="application/pdf")
             request = documentai.ProcessRequest(name=PROCESSOR_PATH, gcs_document=gcs_document)
-            result = docai_client.process_document(request=request)
+            with recorder.stage("docai.process", pages=page_count):
+                result = docai_client.process_document(request=request)
             document_text = result.document.text
 
-            output_bucket = storage_client.bucket(OUTPUT_TEXT_BUCKET_NAME)
-            output_blob = output_bucket.blob(f"{doc_id}.txt")
-            output_blob.upload_from_string(document_text)
+            output_blob = save_extracted_text(
+                storage_client.bucket(OUTPUT_TEXT_BUCKET_NAME), doc_id, document_text,
+                document_page_spans(result.document), recorder, source_md5=data.get("md5Hash")
+            )
             print(f"Sync processing complete. Saved text to '{output_blob.name}'.")
 
-        else:
-            print("Using asynchronous batch processing.")
-            gcs_documents = documentai.GcsDocuments(documents=[documentai.GcsDocument(gcs_uri=f"gs://{bucket_name}/{file_name}", mime_type="application/pdf")])
-            input_config = documentai.BatchDocumentsInputConfig(gcs_documents=gcs_documents)
-            
-            output_config = documentai.DocumentOutputConfig(
-                gcs_output_config=documentai.DocumentOutputConfig.GcsOutputConfig(gcs_uri=f"gs://{BATCH_OUTPUT_BUCKET_NAME}/{doc_id}/")
+        elif processing_method == "parallel_sync":
+            document_text, page_spans = process_pages_in_parallel(
+                docai_client, PROCESSOR_PATH, f"gs://{bucket_name}/{file_name}",
+                page_count, SYNC_PAGE_LIMIT, DOCAI_MAX_CONCURRENCY,
+                ProgressWriter(doc_ref, PROGRESS_INTERVAL), recorder
             )
-            request = documentai.BatchProcessRequest(
-                name=PROCESSOR_PATH,
-                input_documents=input_config,
-                document_output_config=output_config,
+            output_blob = save_extracted_text(
+                storage_client.bucket(OUTPUT_TEXT_BUCKET_NAME), doc_id, document_text, page_spans, recorder,
+                source_md5=data.get("md5Hash")
             )
-            operation = docai_client.batch_process_documents(request=request)
+            print(f"Parallel sync processing complete. Saved text to '{output_blob.name}'.")
+
+        else:
+            print("Using asynchronous batch processing.")
+            with recorder.stage("docai.batch_submit", pages=page_count):
+                operation = submit_batch(
+                    docai_client, PROCESSOR_PATH, [f"gs://{bucket_name}/{file_name}"],
+                    f"gs://{BATCH_OUTPUT_BUCKET_NAME}/{doc_id}/", BATCH_PAGES_PER_SHARD
+                )
             print(f"Batch processing job started. Operation name: {operation.operation.name}")
+
+        lease.complete(writes)
             
     except Exception as e:
         print(f"!!! CRITICAL ERROR in doc_preprocess_trigger for file '{file_name}': {e}")
-        if file_name != "unknown_file":
-            doc_id_for_error = os.path.splitext(file_name)[0]
-            doc_ref = db.collection("sows").document(doc_id_for_error)
-            doc_ref.set({"status": "OCR_FAILED", "error_message": str(e)}, merge=True)
\ No newline at end of file
+        if doc_id is not None:
+            doc_ref = db.collection("sows").document(doc_id)
+            writes.set_fields(doc_ref, status_fields(OCR_FAILED, error_message=str(e)))
+        lease.release(e, writes)
+    finally:
+        recorder.flush(db.collection("sows").document(doc_id) if doc_id is not None else None, writes)
+        try:
+            writes.commit()
+        except Exception as e:
+            print(f"!!! Could not save final status for '{file_name}': {e}")
\ No newline at end of file
@@ -0,0 +1,291 @@
+"""
+Cheap page counting for PDFs stored in GCS.
+
+process_pdf only needs the page count to choose between sync and batch
+Document AI, so instead of downloading the whole file this module reads a few
+small byte ranges:
+
+  1. the first KB, which holds the linearization dictionary ('/N <pages>') for
+     web-optimized PDFs, trusted only while its '/L' still equals the file
+     size (an incremental update after linearization leaves '/N' stale);
+  2. the tail, to find 'startxref' and the trailer;
+  3. the cross-reference table or stream, to locate the catalog and the root
+     page tree node, whose '/Count' is the page count.
+
+Anything it cannot understand returns None, and the caller decides whether a
+bounded full parse is affordable.
+"""
+import re
+import zlib
+
+HEAD_BYTES = 1024
+TAIL_BYTES = 16 * 1024
+XREF_READ_BYTES = 64 * 1024
+MAX_XREF_READ_BYTES = 4 * 1024 * 1024
+OBJECT_READ_BYTES = 4 * 1024
+MAX_OBJECT_READ_BYTES = 256 * 1024
+MAX_XREF_SECTIONS = 16
+
+# Object metadata keys the upload path may set with a known page count.
+PAGE_COUNT_METADATA_KEYS = ("page_count", "page-count", "pagecount")
+
+_LINEARIZED_RE = re.compile(rb"/Linearized\b")
+_STARTXREF_RE = re.compile(rb"startxref\s+(\d+)")
+_ROOT_RE = re.compile(rb"/Root\s+(\d+)\s+\d+\s+R")
+_PREV_RE = re.compile(rb"/Prev\s+(\d+)")
+_PAGES_REF_RE = re.compile(rb"/Pages\s+(\d+)\s+\d+\s+R")
+_COUNT_RE = re.compile(rb"/Count\s+(\d+)")
+_OBJ_HEADER_RE = re.compile(rb"(\d+)\s+(\d+)\s+obj\b")
+_XREF_SUBSECTION_RE = re.compile(rb"\s*(\d+)\s+(\d+)[ \t]*\r?\n")
+_STREAM_START_RE = re.compile(rb">>\s*stream\r?\n")
+_INT_ARRAY_RE = r"/{key}\s*\[\s*([\d\s]+)\]"
+
+
+def page_count_from_metadata(metadata):
+    """Returns the page-count hint stored on the object at upload time, if any."""
+    for key in PAGE_COUNT_METADATA_KEYS:
+        value = (metadata or {}).get(key)
+        if value is not None and str(value).strip().isdigit() and int(value) > 0:
+            return int(value)
+    return None
+
+
+class _RangeReader:
+    """Wraps `read_range(start, end_inclusive)` and counts bytes fetched."""
+
+    def __init__(self, read_range, size):
+        self._read_range = read_range
+        self.size = size
+        self.bytes_read = 0
+        self.requests = 0
+
+    def read(self, start, length):
+        start = max(0, start)
+        end = min(self.size, start + length) - 1
+        if end < start:
+            return b""
+        data = self._read_range(start, end)
+        self.bytes_read += len(data)
+        self.requests += 1
+        return data
+
+
+def _dict_int_array(dictionary, key):
+    match = re.search(_INT_ARRAY_RE.format(key=key).encode(), dictionary)
+    return [int(n) for n in match.group(1).split()] if match else None
+
+
+def _dict_int(dictionary, key):
+    match = re.search(rb"/" + key.encode() + rb"\s+(\d+)", dictionary)
+    return int(match.group(1)) if match else None
+
+
+def _png_unpredict(data, columns):
+    """Reverses the PNG row predictors used by xref and object streams."""
+    row_len = columns + 1
+    out = bytearray()
+    prev = bytearray(columns)
+    for i in range(0, len(data) - row_len + 1, row_len):
+        filter_type = data[i]
+        row = bytearray(data[i + 1:i + row_len])
+        for j in range(columns):
+            left = row[j - 1] if j > 0 else 0
+            up = prev[j]
+            upper_left = prev[j - 1] if j > 0 else 0
+            if filter_type == 1:
+                row[j] = (row[j] + left) & 0xFF
+            elif filter_type == 2:
+                row[j] = (row[j] + up) & 0xFF
+            elif filter_type == 3:
+                row[j] = (row[j] + ((left + up) >> 1)) & 0xFF
+            elif filter_type == 4:
+                p = left + up - upper_left
+                pa, pb, pc = abs(p - left), abs(p - up), abs(p - upper_left)
+                predictor = left if pa <= pb and pa <= pc else (up if pb <= pc else upper_left)
+                row[j] = (row[j] + predictor) & 0xFF
+        out.extend(row)
+        prev = row
+    return bytes(out)
+
+
+class _PdfProbe:
+
+    def __init__(self, reader):
+        self.reader = reader
+        # object number -> ('offset', byte_offset) or ('stream', container_obj_num, index)
+        self.xref = {}
+        self.root_ref = None
+
+    def _read_object_at(self, offset):
+        """Returns (dictionary bytes, stream bytes or None) for the object at `offset`."""
+        length = OBJECT_READ_BYTES
+        while True:
+            data = self.reader.read(offset, length)
+            if b"endobj" in data or length >= MAX_OBJECT_READ_BYTES or offset + length >= self.reader.size:
+                break
+            length *= 4
+        header = _OBJ_HEADER_RE.match(data.lstrip())
+        if not header:
+            return None, None
+        body = data.split(b"endobj", 1)[0]
+        stream_start = _STREAM_START_RE.search(body)
+        if not stream_start:
+            return body, None
+        dictionary, rest = body[:stream_start.start() + 2], body[stream_start.end():]
+        stream_length = _dict_int(dictionary, "Length")
+        raw = rest[:stream_length] if stream_length is not None else rest.rsplit(b"endstream", 1)[0]
+        return dictionary, self._decode_stream(dictionary, raw)
+
+    def _decode_stream(self, dictionary, raw):
+        if b"/FlateDecode" not in dictionary:
+            return raw if b"/Filter" not in dictionary else None
+        data = zlib.decompress(raw)
+        predictor = _dict_int(dictionary, "Predictor")
+        if predictor and predictor >= 10:
+            data = _png_unpredict(data, _dict_int(dictionary, "Columns") or 1)
+        return data
+
+    def _load_xref_section(self, offset):
+        """Parses one xref section; returns the offset of the previous one or None."""
+        length = XREF_READ_BYTES
+        while True:
+            data = self.reader.read(offset, length)
+            if not data.lstrip().startswith(b"xref"):
+                return self._load_xref_stream(offset)
+            entries = self._parse_xref_table(data)
+            if entries is not None or length >= MAX_XREF_READ_BYTES or offset + length >= self.reader.size:
+                break
+            # The table plus trailer did not fit in the window; widen it.
+            length *= 4
+        if entries is None:
+            return None
+        table, trailer = entries
+        for obj_num, entry in table.items():
+            self.xref.setdefault(obj_num, entry)
+        if self.root_ref is None:
+            root = _ROOT_RE.search(trailer)
+            self.root_ref = int(root.group(1)) if root else None
+        prev = _PREV_RE.search(trailer)
+        return int(prev.group(1)) if prev else None
+
+    def _parse_xref_table(self, data):
+        """Returns ({obj_num: entry}, trailer bytes), or None if `data` is truncated."""
+        table = {}
+        pos = data.index(b"xref") + 4
+        while True:
+            match = _XREF_SUBSECTION_RE.match(data, pos)
+            if not match:
+                break
+            first, count = int(match.group(1)), int(match.group(2))
+            pos = match.end()
+            if pos + 20 * count > len(data):
+                return None
+            for i in range(count):
+                fields = data[pos:pos + 20].split()
+                if len(fields) >= 3 and fields[2] == b"n":
+                    table[first + i] = ("offset", int(fields[0]))
+                pos += 20
+        trailer = data[pos:].split(b"startxref", 1)[0]
+        if b"trailer" not in trailer or b">>" not in trailer:
+            return None
+        return table, trailer
+
+    def _load_xref_stream(self, offset):
+        dictionary, data = self._read_object_at(offset)
+        if dictionary is None or data is None or b"/XRef" not in dictionary:
+            return None
+        widths = _dict_int_array(dictionary, "W")
+        size = _dict_int(dictionary, "Size")
+        index = _dict_int_array(dictionary, "Index") or [0, size or 0]
+        if not widths or len(widths) != 3:
+            return None
+        entry_len = sum(widths)
+        pos = 0
+        for first, count in zip(index[0::2], index[1::2]):
+            for i in range(count):
+                entry = data[pos:pos + entry_len]
+                pos += entry_len
+                if len(entry) < entry_len:
+                    break
+                fields, cursor = [], 0
+                for width in widths:
+                    fields.append(int.from_bytes(entry[cursor:cursor + width], "big") if width else None)
+                    cursor += width
+                entry_type = 1 if widths[0] == 0 else fields[0]
+                if entry_type == 1:
+                    self.xref.setdefault(first + i, ("offset", fields[1]))
+                elif entry_type == 2:
+                    self.xref.setdefault(first + i, ("stream", fields[1], fields[2]))
+        if self.root_ref is None:
+            root = _ROOT_RE.search(dictionary)
+            self.root_ref = int(root.group(1)) if root else None
+        prev = _PREV_RE.search(dictionary)
+        return int(prev.group(1)) if prev else None
+
+    def _get_object(self, obj_num):
+        entry = self.xref.get(obj_num)
+        if entry is None:
+            return None
+        if entry[0] == "offset":
+            dictionary, _ = self._read_object_at(entry[1])
+            return dictionary
+        container = self.xref.get(entry[1])
+        if container is None or container[0] != "offset":
+            return None
+        dictionary, data = self._read_object_at(container[1])
+        if dictionary is None or data is None:
+            return None
+        count, first = _dict_int(dictionary, "N"), _dict_int(dictionary, "First")
+        if count is None or first is None:
+            return None
+        header = [int(n) for n in data[:first].split()]
+        offsets = dict(zip(header[0::2], header[1::2]))
+        if obj_num not in offsets:
+            return None
+        start = first + offsets[obj_num]
+        later = sorted(o for o in offsets.values() if o > offsets[obj_num])
+        end = first + later[0] if later else len(data)
+        return data[start:end]
+
+    def page_count(self):
+        head = self.reader.read(0, HEAD_BYTES)
+        first_object = head.split(b"endobj", 1)[0]
+        if _LINEARIZED_RE.search(first_object):
+            count, length = _dict_int(first_object, "N"), _dict_int(first_object, "L")
+            if count is not None and length == self.reader.size:
+                return count
+
+        tail = self.reader.read(self.reader.size - TAIL_BYTES, TAIL_BYTES)
+        startxref = _STARTXREF_RE.findall(tail)
+        if not startxref:
+            return None
+        offset = int(startxref[-1])
+        for _ in range(MAX_XREF_SECTIONS):
+            if offset is None:
+                break
+            offset = self._load_xref_section(offset)
+
+        if self.root_ref is None:
+            return None
+        catalog = self._get_object(self.root_ref)
+        pages_ref = _PAGES_REF_RE.search(catalog or b"")
+        if not pages_ref:
+            return None
+        pages = self._get_object(int(pages_ref.group(1)))
+        count = _COUNT_RE.search(pages or b"")
+        return int(count.group(1)) if count else None
+
+
+def probe_page_count(read_range, size):
+    """
+    Returns (page_count or None, bytes_read) using only small ranged reads.
+    `read_range(start, end)` must return the bytes in [start, end] inclusive,
+    which matches Blob.download_as_bytes(start=..., end=...).
+    """
+    reader = _RangeReader(read_range, size)
+    try:
+        count = _PdfProbe(reader).page_count()
+    except Exception as e:
+        print(f"  -> Ranged page-count probe failed: {e}")
+        count = None
+    return count, reader.bytes_read
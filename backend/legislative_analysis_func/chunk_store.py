@@ -0,0 +1,198 @@
+"""
+Per-chunk analysis results for incremental re-analysis.
+
+Every analyzed chunk is stored under sows/{doc_id}/chunks/{index} with a hash
+of its text and of the analysis settings (prompt, model, temperature) that
+produced its requirements. When a new version of a bill arrives (or the same
+bill is re-analyzed) only chunks whose hash has not been seen for that bill
+are sent to Gemini.
+
+Versions of the same bill are linked by a 'bill_key' on the sows document,
+taken from the 'bill_id' object metadata when present, otherwise derived from
+the file name (e.g. HB00123I, HB00123E and HB00123F all map to HB123).
+
+The same documents are the checkpoint of a running analysis: ChunkCheckpointer
+writes each chunk's result as soon as it is analyzed, tagged with the run id,
+so a retried or resumed run (same run id) only analyzes the missing chunks,
+even when incremental re-analysis is off or the LLM cache is bypassed.
+"""
+import hashlib
+import json
+import re
+import threading
+import time
+
+CHUNKS_SUBCOLLECTION = "chunks"
+DEFAULT_BILL_KEY_PATTERN = r"(?i)^(?P<chamber>H|S)(?P<type>B|JR|CR|R)[ _-]*0*(?P<number>\d+)"
+# How many earlier versions of a bill to pull chunk results from.
+MAX_PREVIOUS_VERSIONS = 5
+# Firestore's limit on the values of an 'in' filter.
+MAX_IN_VALUES = 30
+MAX_BATCH_WRITES = 450
+
+
+def derive_bill_key(doc_id, metadata=None, pattern=DEFAULT_BILL_KEY_PATTERN):
+    bill_id = (metadata or {}).get("bill_id")
+    if bill_id:
+        return str(bill_id).strip().upper()
+    match = re.match(pattern, doc_id)
+    if not match:
+        return doc_id
+    # Named groups are concatenated, which drops separators and leading zeros.
+    groups = [value for value in match.groupdict().values() if value]
+    return ("".join(groups) if groups else match.group(0)).upper()
+
+
+def chunk_hash(chunk_text, fingerprint):
+    return hashlib.sha256(f"{fingerprint}\n{chunk_text}".encode("utf-8")).hexdigest()
+
+
+def analysis_fingerprint(prompt_template, model_name, temperature):
+    """Identifies the settings that produced a chunk's requirements."""
+    return hashlib.sha256(
+        json.dumps([prompt_template, model_name, float(temperature)]).encode("utf-8")
+    ).hexdigest()
+
+
+def load_known_chunk_results(db, doc_id, bill_key, hashes):
+    """
+    Returns {chunk_hash: requirements} for those of `hashes` already analyzed
+    in this document or in the MAX_PREVIOUS_VERSIONS most recent other
+    documents with the same bill key. Versions are searched newest first and
+    only for the hashes still missing, so unchanged chunks are all that is
+    read.
+    """
+    from google.cloud import firestore
+
+    doc_ids = [doc_id]
+    versions = (
+        db.collection("sows").where("bill_key", "==", bill_key)
+        .order_by("created_at", direction=firestore.Query.DESCENDING)
+        .limit(MAX_PREVIOUS_VERSIONS + 1)
+    )
+    for snapshot in versions.select([]).stream():
+        if snapshot.id not in doc_ids:
+            doc_ids.append(snapshot.id)
+
+    known = {}
+    missing = list(dict.fromkeys(hashes))
+    for version_id in doc_ids[:MAX_PREVIOUS_VERSIONS + 1]:
+        if not missing:
+            break
+        chunks_ref = db.collection("sows").document(version_id).collection(CHUNKS_SUBCOLLECTION)
+        for start in range(0, len(missing), MAX_IN_VALUES):
+            for chunk_doc in chunks_ref.where("hash", "in", missing[start:start + MAX_IN_VALUES]).stream():
+                data = chunk_doc.to_dict()
+                if isinstance(data.get("requirements"), list):
+                    known.setdefault(data["hash"], data["requirements"])
+        missing = [hash_value for hash_value in missing if hash_value not in known]
+    return known
+
+
+def load_checkpoint(db, doc_ref, run_id):
+    """Returns {chunk_hash: requirements} for the chunks already analyzed by run `run_id`."""
+    known = {}
+    for chunk_doc in doc_ref.collection(CHUNKS_SUBCOLLECTION).where("run_id", "==", run_id).stream():
+        data = chunk_doc.to_dict()
+        if data.get("hash") and isinstance(data.get("requirements"), list):
+            known.setdefault(data["hash"], data["requirements"])
+    return known
+
+
+def _chunk_record(index, hash_value, requirements, run_id):
+    # Requirement ids are stripped because they are reassigned after merging.
+    return {
+        "index": index,
+        "hash": hash_value,
+        "run_id": run_id,
+        "requirements": [
+            {k: v for k, v in req.items() if k != "id"} if isinstance(req, dict) else req
+            for req in requirements
+        ],
+    }
+
+
+class ChunkCheckpointer:
+    """
+    Saves chunk results as they complete, at most once per `interval_seconds`,
+    together with the 'chunks_completed' progress counter on the sows
+    document. Thread-safe; `flush` writes anything still pending.
+    """
+
+    def __init__(self, db, doc_ref, run_id, chunks_total, chunks_completed=0, interval_seconds=5.0):
+        self.db = db
+        self.doc_ref = doc_ref
+        self.run_id = run_id
+        self.chunks_total = chunks_total
+        self.chunks_completed = chunks_completed
+        self.interval_seconds = interval_seconds
+        self.saved = set()
+        self._chunks_ref = doc_ref.collection(CHUNKS_SUBCOLLECTION)
+        self._lock = threading.Lock()
+        self._pending = {}
+        self._last_write = 0.0
+
+    def start(self):
+        """Publishes the chunk counts before any chunk is analyzed."""
+        with self._lock:
+            self._write_locked()
+
+    def add(self, index, hash_value, requirements):
+        with self._lock:
+            self._pending[index] = _chunk_record(index, hash_value, requirements, self.run_id)
+            self.chunks_completed += 1
+            if time.monotonic() - self._last_write >= self.interval_seconds:
+                self._write_locked()
+
+    def flush(self):
+        with self._lock:
+            if self._pending:
+                self._write_locked()
+
+    def _write_locked(self):
+        from google.cloud import firestore
+        from shared.pipeline_state import StageWrites
+
+        pending, self._pending = self._pending, {}
+        self._last_write = time.monotonic()
+        writes = StageWrites(self.db)
+        for index, record in pending.items():
+            writes.set_fields(self._chunks_ref.document(f"{index:04d}"), record)
+        writes.set_fields(self.doc_ref, {
+            "chunks_total": self.chunks_total,
+            "chunks_completed": self.chunks_completed,
+            "last_updated_at": firestore.SERVER_TIMESTAMP,
+        })
+        try:
+            writes.commit()
+            self.saved.update(pending)
+        except Exception as e:
+            # Unsaved chunks are analyzed again by the next run; never fail this one over it.
+            print(f"Warning: could not checkpoint {len(pending)} chunk results: {e}")
+
+
+def save_chunk_results(db, doc_ref, chunk_hashes, chunk_results, run_id=None, saved=()):
+    """
+    Replaces the document's stored chunk results. Chunks in `saved` were
+    already written by this run's checkpoints and are not written again.
+    """
+    chunks_ref = doc_ref.collection(CHUNKS_SUBCOLLECTION)
+    existing_ids = {snapshot.id for snapshot in chunks_ref.select([]).stream()}
+
+    writes = []
+    for index, (hash_value, requirements) in enumerate(zip(chunk_hashes, chunk_results)):
+        chunk_id = f"{index:04d}"
+        existing_ids.discard(chunk_id)
+        if index in saved:
+            continue
+        writes.append(("set", chunks_ref.document(chunk_id), _chunk_record(index, hash_value, requirements, run_id)))
+    writes.extend(("delete", chunks_ref.document(stale_id), None) for stale_id in existing_ids)
+
+    for start in range(0, len(writes), MAX_BATCH_WRITES):
+        batch = db.batch()
+        for op, ref, data in writes[start:start + MAX_BATCH_WRITES]:
+            if op == "set":
+                batch.set(ref, data)
+            else:
+                batch.delete(ref)
+        batch.commit()
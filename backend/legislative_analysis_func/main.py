@@ -1,94 +1,327 @@
 import functions_framework
 import os
 import json
-import vertexai
-from vertexai.generative_models import GenerativeModel, GenerationConfig
-from google.cloud import storage, firestore
+import time
+from concurrent.futures import ThreadPoolExecutor
+from vertexai.generative_models import GenerationConfig
+from google.cloud import firestore
 import traceback
+from chunk_store import DEFAULT_BILL_KEY_PATTERN, ChunkCheckpointer, analysis_fingerprint, chunk_hash, derive_bill_key, load_checkpoint, load_known_chunk_results, save_chunk_results
+from summarize import DEFAULT_GROUP_SIZE, DEFAULT_REDUCE_FAN_IN, DEFAULT_SIMILARITY_THRESHOLD, dedupe_similar_requirements, summarize_requirements
+from shared.chunking import DEFAULT_CHARS_PER_TOKEN, build_chunks, calibrate_chars_per_token, merge_requirements
+from shared.context_cache import ContextCache, PrefixedModel
+from shared.idempotency import IN_PROGRESS, EventLease
+from shared.instrumentation import StageRecorder, record_usage, resolve_trace_id
+from shared.llm_cache import build_llm_cache
+from shared.page_index import SIDECAR_SUFFIX, load_page_index, pages_for_span, section_starts
+from shared.payload_store import payload_fields, prune_payloads
+from shared.pipeline_state import ANALYSIS_FAILED, ANALYSIS_PARTIAL, ANALYZED_SUCCESS, ANALYZING, StageWrites, check_transition, status_fields
+from shared.prompting import split_prompt
+from shared.rate_limiter import BACKGROUND, RateLimitTimeout, get_scheduler
+from shared.runtime import get_firestore_client, get_model, get_prompt, get_settings, get_storage_client
+
+def generate_with_retry(scheduler, model, prompt, generation_config, max_retries=5, deadline=None):
+    """
+    Calls the model at background priority once the Vertex AI budget allows,
+    retrying with backoff when the request is rate limited or the service is
+    temporarily unavailable (see shared/rate_limiter.py). No attempt waits
+    for capacity past `deadline`.
+    """
+    return scheduler.generate(
+        lambda: model.generate_content(prompt, generation_config=generation_config),
+        priority=BACKGROUND, max_retries=max_retries, deadline=deadline
+    )
+
+
+class AnalysisIncomplete(Exception):
+    """Raised when the time budget runs out with chunks still to analyze."""
+
+    def __init__(self, completed, total):
+        super().__init__(f"Analyzed {completed} of {total} chunks before the time budget ran out.")
+        self.completed = completed
+        self.total = total
+
+
+def parse_chunk_requirements(response_text):
+    """
+    Pulls the 'requirements' list out of a model response that is expected to
+    contain a JSON object, tolerating any surrounding prose or code fences.
+    """
+    json_start = response_text.find('{')
+    json_end = response_text.rfind('}') + 1
+    if json_start == -1 or json_end == 0:
+        return []
+    chunk_result = json.loads(response_text[json_start:json_end])
+    chunk_reqs = chunk_result.get('requirements', [])
+    return chunk_reqs if isinstance(chunk_reqs, list) else []
+
+
+def analyze_chunks(model, scheduler, model_name, temperature, prompt_template, chunks, generation_config,
+                   llm_cache, recorder, max_concurrency=4, max_retries=5, bypass_cache=False, deadline=None,
+                   on_result=None):
+    """
+    Analyzes all chunks concurrently with at most `max_concurrency` requests in
+    flight. `model` is a PrefixedModel holding the part of the prompt before
+    {DOCUMENT_TEXT}; `prompt_template` is the rest. Returns one list of
+    requirements per chunk, in chunk order, so the caller can number
+    requirements deterministically. Chunks whose rendered prompt was seen
+    before are served from `llm_cache`; only real model calls are recorded as
+    'gemini.analyze_chunk' stages on `recorder`.
+    Chunks not yet started when time.monotonic() passes `deadline`, or still
+    waiting for Vertex AI capacity when it does, are skipped and returned as
+    None. `on_result`, if given, is called with each chunk's
+    index and requirements as soon as it is analyzed.
+    """
+    def analyze_one(index, chunk):
+        # The first chunk always runs, so every invocation makes progress.
+        if index and deadline is not None and time.monotonic() > deadline:
+            return None
+        print(f"Processing chunk {index+1}/{len(chunks)}...")
+        suffix = prompt_template.replace('{DOCUMENT_TEXT}', chunk)
+        prompt = model.prefix + suffix
+
+        def generate():
+            with recorder.stage("gemini.analyze_chunk", chunk=index) as span:
+                response = generate_with_retry(
+                    scheduler, model, suffix, generation_config, max_retries=max_retries, deadline=deadline
+                )
+                record_usage(span, response)
+                return response.text
+
+        try:
+            response_text = llm_cache.generate_text(
+                model_name, prompt, temperature, None, generate, bypass=bypass_cache
+            )
+        except RateLimitTimeout as e:
+            if not e.deadline_reached:
+                raise
+            # Left for the resumed run, like the chunks not yet started.
+            print(f"  -> Chunk {index+1} ran out of time waiting for Vertex AI capacity.")
+            return None
+        try:
+            chunk_reqs = parse_chunk_requirements(response_text)
+            print(f"  -> Found {len(chunk_reqs)} requirements in chunk {index+1}.")
+        except Exception as parse_error:
+            print(f"  -> WARNING: Could not parse JSON from chunk {index+1}. Error: {parse_error}")
+            chunk_reqs = []
+        if on_result is not None:
+            on_result(index, chunk_reqs)
+        return chunk_reqs
+
+    with ThreadPoolExecutor(max_workers=max(1, min(max_concurrency, len(chunks) or 1))) as executor:
+        futures = [executor.submit(analyze_one, i, chunk) for i, chunk in enumerate(chunks)]
+        return [future.result() for future in futures]
 
 @functions_framework.cloud_event
 def analyze_text(cloud_event):
     """
     Analyzes legislative text from a processed text file. This function
     now assumes it will only be triggered for legitimate SOW documents.
+
+    Chunk results are checkpointed as they complete. A run that reaches
+    'analysis_time_budget_seconds' stops at ANALYSIS_PARTIAL and raises, so
+    Eventarc redelivers the event and the next run only analyzes the chunks
+    that are still missing. The dashboard's "resume" action rewrites the text
+    object with a 'resume_run_id' metadata entry to continue a run explicitly.
+
+    When OCR wrote a page index next to the text, its section headings guide
+    the chunking and each requirement cites the pages of the chunk it came
+    from as 'source_pages'.
     """
-    # --- Initialize clients and variables ---
-    db = firestore.Client()
-    storage_client = storage.Client()
-    
+    started = time.monotonic()
     data = cloud_event.data
     bucket_name = data["bucket"]
     file_name = data["name"]
+    # The page index sidecar lands in the same bucket just before the text.
+    if file_name.endswith(SIDECAR_SUFFIX) or not file_name.endswith('.txt'):
+        print(f"Ignoring '{file_name}', not an extracted text file.")
+        return
+
+    # --- Reuse clients from the warm instance ---
+    db = get_firestore_client()
+    storage_client = get_storage_client()
     doc_id = os.path.splitext(file_name)[0]
+    # The extracted text object carries the trace id of the upload that produced it.
+    recorder = StageRecorder("analyze_text", doc_id, resolve_trace_id(data.get("metadata")))
     
-    raw_response_text_for_error = "Function crashed before reaching the AI response stage."
+    # --- Skip duplicate deliveries so chunks are not sent to Gemini twice ---
+    lease = EventLease(db, "analyze_text", data)
+    if not lease.acquire():
+        if lease.state == IN_PROGRESS:
+            # The holder may be a run that timed out; fail this delivery so
+            # Eventarc retries it after that run's lease has expired.
+            raise RuntimeError(f"Analysis of '{doc_id}' is already running; retrying later.")
+        return
+    # Checkpoints are shared by every run of the same text object; a resume names the run it continues.
+    run_id = (data.get("metadata") or {}).get("resume_run_id") or str(data.get("generation") or "")
 
     print(f"Starting analysis for: {file_name}")
+    doc_ref = db.collection("sows").document(doc_id)
+    # The final result (or failure), timings and lease state are committed together.
+    writes = StageWrites(db)
+    analysis_fields = None
 
     try:
         # --- Set status to ANALYZING for immediate UI feedback ---
-        doc_ref = db.collection("sows").document(doc_id)
-        doc_ref.update({"status": "ANALYZING"})
+        with recorder.stage("firestore.read"):
+            sow_data = doc_ref.get().to_dict() or {}
+        check_transition(doc_id, sow_data.get("status"), ANALYZING)
+        with recorder.stage("firestore.write"):
+            doc_ref.update(status_fields(ANALYZING, analysis_run_id=run_id))
         print(f"Set status to ANALYZING for document: {doc_id}")
 
-        # --- Fetch configuration from Firestore ---
-        settings_ref = db.collection('settings').document('global_config')
-        settings = settings_ref.get().to_dict()
+        # --- Fetch configuration (cached per instance) ---
+        settings = get_settings()
         MODEL_NAME = settings.get('legislative_analysis_model', 'gemini-2.5-pro') # Updated model name
         MODEL_TEMPERATURE = settings.get('analysis_model_temperature', 0.2)
         PROMPT_ID = settings.get('legislative_analysis_prompt_id')
+        MAX_CONCURRENCY = int(settings.get('analysis_max_concurrency', 4))
+        MAX_RETRIES = int(settings.get('analysis_max_retries', 5))
+        CHUNK_MAX_TOKENS = int(settings.get('analysis_chunk_max_tokens', 8000))
+        CHUNK_OVERLAP_TOKENS = int(settings.get('analysis_chunk_overlap_tokens', 200))
+        # 'estimate' uses a fixed chars-per-token ratio; 'model' calibrates it with one count_tokens call.
+        TOKEN_COUNTING = settings.get('analysis_token_counting', 'estimate')
+        # Reuse stored per-chunk requirements for unchanged chunks of this bill or its earlier versions.
+        INCREMENTAL = bool(settings.get('analysis_incremental', True))
+        PROGRESS_INTERVAL = float(settings.get('progress_write_interval_seconds', 5))
+        # Chunks are only started within this many seconds of the invocation, leaving
+        # time for the summary and the final writes before the 540s function timeout.
+        TIME_BUDGET = float(settings.get('analysis_time_budget_seconds', 420))
+        # Requirements sharing this fraction of their wording are treated as one (0 disables).
+        DEDUPE_SIMILARITY = float(settings.get('analysis_dedupe_similarity', DEFAULT_SIMILARITY_THRESHOLD))
+        SUMMARY_GROUP_SIZE = int(settings.get('summary_group_size', DEFAULT_GROUP_SIZE))
+        SUMMARY_REDUCE_FAN_IN = int(settings.get('summary_reduce_fan_in', DEFAULT_REDUCE_FAN_IN))
 
-        prompt_ref = db.collection('prompts').document(PROMPT_ID)
-        prompt_template = prompt_ref.get().to_dict().get('prompt_text')
-        
-        vertexai.init(project="state-of-texas-sow-demo", location="us-central1")
-        model = GenerativeModel(MODEL_NAME)
+        prompt_doc = get_prompt(PROMPT_ID)
+        if not prompt_doc:
+            raise Exception(f"Prompt document '{PROMPT_ID}' not found in 'prompts' collection.")
+        prompt_template = prompt_doc.get('prompt_text')
+
+        model = get_model(MODEL_NAME)
+        scheduler = get_scheduler(MODEL_NAME, settings, db=db)
         generation_config = GenerationConfig(temperature=float(MODEL_TEMPERATURE))
         
-        print(f"Using settings - Model: {MODEL_NAME}, Temp: {MODEL_TEMPERATURE}")
+        llm_cache = build_llm_cache(settings, db=db)
+        # Uploads can opt out of cached responses with the 'llm_cache_bypass' object metadata.
+        bypass_cache = str((data.get("metadata") or {}).get("llm_cache_bypass", "")).lower() == "true"
+
+        print(f"Using settings - Model: {MODEL_NAME}, Temp: {MODEL_TEMPERATURE}, Concurrency: {MAX_CONCURRENCY}")
 
         # --- Download and Chunk Document Text ---
         source_bucket = storage_client.bucket(bucket_name)
         blob = source_bucket.blob(file_name)
-        document_text = blob.download_as_text()
+        with recorder.stage("gcs.download") as span:
+            document_text = blob.download_as_text()
+            span["bytes"] = len(document_text)
         print(f"Downloaded {len(document_text)} characters.")
+        with recorder.stage("gcs.download_page_index"):
+            page_index = load_page_index(source_bucket, doc_id)
+        if page_index and page_index.get("text_length") != len(document_text):
+            print("Warning: page index does not match the text; ignoring it.")
+            page_index = None
 
-        chunk_size = 14000
-        chunks = [document_text[i:i + chunk_size] for i in range(0, len(document_text), chunk_size)]
-        print(f"Split document into {len(chunks)} chunks.")
+        chars_per_token = DEFAULT_CHARS_PER_TOKEN
+        if TOKEN_COUNTING == 'model':
+            chars_per_token = calibrate_chars_per_token(model, document_text)
+        chunk_spans = build_chunks(
+            document_text, CHUNK_MAX_TOKENS, overlap_tokens=CHUNK_OVERLAP_TOKENS, chars_per_token=chars_per_token,
+            section_starts=section_starts(page_index) if page_index else None
+        )
+        chunks = [chunk.text for chunk in chunk_spans]
+        print(f"Split document into {len(chunks)} chunks of up to {CHUNK_MAX_TOKENS} tokens ({chars_per_token:.2f} chars/token).")
 
-        all_requirements = []
-        
-        # --- Analyze Each Chunk ---
-        for i, chunk in enumerate(chunks):
-            print(f"Processing chunk {i+1}/{len(chunks)}...")
-            prompt = prompt_template.replace('{DOCUMENT_TEXT}', chunk)
-            response = model.generate_content(prompt, generation_config=generation_config)
-            raw_response_text_for_error = response.text
-            
-            try:
-                json_start = response.text.find('{')
-                json_end = response.text.rfind('}') + 1
-                if json_start != -1 and json_end != 0:
-                    json_string = response.text[json_start:json_end]
-                    chunk_result = json.loads(json_string)
-                    chunk_reqs = chunk_result.get('requirements', [])
-                    if isinstance(chunk_reqs, list):
-                        all_requirements.extend(chunk_reqs)
-                        print(f"  -> Found {len(chunk_reqs)} requirements in chunk {i+1}.")
-            except Exception as parse_error:
-                print(f"  -> WARNING: Could not parse JSON from chunk {i+1}. Error: {parse_error}")
-
-        print(f"Aggregated a total of {len(all_requirements)} requirements.")
+        # --- Find Chunks Already Analyzed for This Bill ---
+        fingerprint = analysis_fingerprint(prompt_template, MODEL_NAME, MODEL_TEMPERATURE)
+        chunk_hashes = [chunk_hash(chunk, fingerprint) for chunk in chunks]
+        known_results = {}
+        bill_key = None
+        if INCREMENTAL and not bypass_cache:
+            bill_key = derive_bill_key(
+                doc_id, {"bill_id": sow_data.get("bill_id")},
+                settings.get('bill_key_pattern', DEFAULT_BILL_KEY_PATTERN)
+            )
+            # This document's chunks include the checkpoints of an interrupted run.
+            with recorder.stage("firestore.load_chunk_results"):
+                known_results = load_known_chunk_results(db, doc_id, bill_key, chunk_hashes)
+        else:
+            with recorder.stage("firestore.load_checkpoint"):
+                known_results = load_checkpoint(db, doc_ref, run_id)
+        pending = [i for i, hash_value in enumerate(chunk_hashes) if hash_value not in known_results]
+        print(f"{len(chunks) - len(pending)} of {len(chunks)} chunks unchanged since a previous analysis; analyzing {len(pending)}.")
+
+        # --- Analyze Changed Chunks Concurrently ---
+        reused_count = len(chunks) - len(pending)
+        # The instructions before {DOCUMENT_TEXT} are the same for every chunk. They are
+        # cached only once a prompt makes them longer than the context cache minimum; the
+        # stock prompt is shorter and is sent whole (shared/context_cache.py).
+        prompt_prefix, chunk_prompt_template = split_prompt(prompt_template, {}, ('DOCUMENT_TEXT',))
+        if len(pending) > 1:
+            analysis_model = ContextCache(settings, db=db).prefixed_model(
+                model, MODEL_NAME, prompt_prefix, recorder, PROMPT_ID, prompt_version=prompt_doc.get('version')
+            )
+        else:
+            analysis_model = PrefixedModel(model, prompt_prefix)
+        checkpointer = ChunkCheckpointer(db, doc_ref, run_id, len(chunks), reused_count, PROGRESS_INTERVAL)
+        checkpointer.start()
+        try:
+            pending_results = analyze_chunks(
+                analysis_model, scheduler, MODEL_NAME, MODEL_TEMPERATURE, chunk_prompt_template, [chunks[i] for i in pending], generation_config,
+                llm_cache, recorder, max_concurrency=MAX_CONCURRENCY, max_retries=MAX_RETRIES, bypass_cache=bypass_cache,
+                deadline=started + TIME_BUDGET,
+                on_result=lambda i, reqs: checkpointer.add(pending[i], chunk_hashes[pending[i]], reqs)
+            )
+        finally:
+            # Chunks finished before a failure are kept for the next run.
+            checkpointer.flush()
+        skipped = sum(1 for result in pending_results if result is None)
+        if skipped:
+            raise AnalysisIncomplete(len(chunks) - skipped, len(chunks))
+        chunk_results = [
+            [dict(req) if isinstance(req, dict) else req for req in known_results.get(hash_value, [])]
+            for hash_value in chunk_hashes
+        ]
+        for i, chunk_reqs in zip(pending, pending_results):
+            chunk_results[i] = chunk_reqs
+        with recorder.stage("firestore.save_chunk_results", chunks=len(chunks)):
+            save_chunk_results(db, doc_ref, chunk_hashes, chunk_results, run_id, saved=checkpointer.saved)
+        if page_index:
+            # Stored chunk results stay page-free; the same chunk can sit on other pages in another version.
+            for chunk, chunk_reqs in zip(chunk_spans, chunk_results):
+                pages = pages_for_span(page_index, chunk.start, chunk.end)
+                chunk_reqs[:] = [
+                    dict(req, source_pages={"from": pages[0], "to": pages[-1]}) if isinstance(req, dict) else req
+                    for req in chunk_reqs
+                ]
+        # Merge in chunk order so REQ-### numbering is stable across runs; overlapping
+        # chunks can report the same requirement twice, so exact duplicates are dropped.
+        all_requirements = merge_requirements(chunk_results)
+        merged_count = len(all_requirements)
+        all_requirements = dedupe_similar_requirements(all_requirements, DEDUPE_SIMILARITY)
+
+        print(f"Aggregated a total of {len(all_requirements)} requirements ({merged_count - len(all_requirements)} near-duplicates dropped).")
 
         # --- Create Final Summary ---
         final_summary = "Summary generation from aggregated requirements is pending."
         if all_requirements:
             for i, req in enumerate(all_requirements):
                 req['id'] = f"REQ-{i+1:03d}"
-            summary_prompt = f"Based on the following list of extracted requirements from a legislative bill, please write a single, concise paragraph that summarizes the overall impact and key responsibilities for the agency.\n\nEXTRACTED REQUIREMENTS JSON:\n{json.dumps(all_requirements, indent=2)}\n\nCONCISE SUMMARY PARAGRAPH:"
-            summary_response = model.generate_content(summary_prompt, generation_config=generation_config)
-            final_summary = summary_response.text.strip()
+
+            def generate_summary(summary_prompt, stage):
+                def generate():
+                    with recorder.stage(f"gemini.{stage}") as span:
+                        response = generate_with_retry(scheduler, model, summary_prompt, generation_config, max_retries=MAX_RETRIES)
+                        record_usage(span, response)
+                        return response.text
+
+                return llm_cache.generate_text(
+                    MODEL_NAME, summary_prompt, MODEL_TEMPERATURE, None, generate, bypass=bypass_cache
+                )
+
+            # Groups are summarized in parallel and the partial summaries reduced.
+            final_summary = summarize_requirements(
+                all_requirements, generate_summary, group_size=SUMMARY_GROUP_SIZE,
+                reduce_fan_in=SUMMARY_REDUCE_FAN_IN, max_concurrency=MAX_CONCURRENCY
+            )
         else:
             final_summary = "No specific requirements for the Texas Department of Motor Vehicles were identified."
 
@@ -98,18 +331,45 @@ def analyze_text(cloud_event):
             "requirements": all_requirements
         }
 
-        doc_ref.update({
-            "status": "ANALYZED_SUCCESS",
-            "analysis": final_analysis_result,
-            "model_used": MODEL_NAME,
-            "prompt_used": PROMPT_ID,
-            "temperature_used": float(MODEL_TEMPERATURE),
-            "analyzed_at": firestore.SERVER_TIMESTAMP
-        })
-        print(f"SUCCESS: Saved final analysis for document ID '{doc_id}' to Firestore.")
+        analysis_update = status_fields(
+            ANALYZED_SUCCESS,
+            requirement_count=len(all_requirements),
+            model_used=MODEL_NAME,
+            prompt_used=PROMPT_ID,
+            temperature_used=float(MODEL_TEMPERATURE),
+            analyzed_at=firestore.SERVER_TIMESTAMP,
+            chunks_analyzed=len(pending),
+            chunks_reused=reused_count
+        )
+        if bill_key:
+            analysis_update["bill_key"] = bill_key
+        # Large analyses live in the payload store; the document keeps a pointer.
+        with recorder.stage("gcs.upload_payload"):
+            stored_fields = payload_fields(storage_client, settings, doc_id, "analysis", final_analysis_result)
+        analysis_update.update(stored_fields)
+        writes.set_fields(doc_ref, analysis_update)
+        # Earlier analyses' objects are deleted once this one is saved.
+        analysis_fields = stored_fields
+        print(f"LLM cache stats: {llm_cache.stats()}")
+        lease.complete(writes)
 
+    except AnalysisIncomplete as e:
+        print(f"Pausing analysis for document ID '{doc_id}': {e} Eventarc will retry the remaining chunks.")
+        writes.set_fields(doc_ref, status_fields(ANALYSIS_PARTIAL, chunks_completed=e.completed, chunks_total=e.total))
+        lease.release(e, writes)
+        raise
     except Exception as e:
         tb_str = traceback.format_exc()
         print(f"!!! CRITICAL ERROR in analysis for file '{file_name}':\n--- EXCEPTION ---\n{e}\n--- TRACEBACK ---\n{tb_str}\n")
-        doc_ref.set({"status": "ANALYSIS_FAILED", "error_message": str(e), "error_traceback": tb_str}, merge=True)
-        print(f"!!! Wrote failure details to Firestore for document ID '{doc_id}'.")
\ No newline at end of file
+        writes.set_fields(doc_ref, status_fields(ANALYSIS_FAILED, error_message=str(e), error_traceback=tb_str))
+        lease.release(e, writes)
+    finally:
+        recorder.flush(doc_ref, writes)
+        try:
+            writes.commit()
+            print(f"Saved final analysis state for document ID '{doc_id}' to Firestore.")
+        except Exception as e:
+            print(f"!!! CRITICAL ERROR: could not save final analysis state for document ID '{doc_id}': {e}")
+        else:
+            if analysis_fields is not None:
+                prune_payloads(storage_client, settings, doc_id, "analysis", analysis_fields)
\ No newline at end of file
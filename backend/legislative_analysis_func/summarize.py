@@ -0,0 +1,141 @@
+"""
+Hierarchical (map-reduce) summary of a bill's extracted requirements.
+
+Requirements are first de-duplicated: overlapping chunks often report the
+same requirement in slightly different words, which merge_requirements'
+exact matching does not catch. The remaining requirements are split into
+groups that are summarized in parallel (map), and the partial summaries are
+combined a few at a time (reduce) until one paragraph remains. Each round
+shrinks the input by the fan-in, so the number of sequential model calls
+grows with log(requirements) and no prompt holds more than one group.
+Requirements are serialized as compact JSON.
+"""
+import json
+import re
+from concurrent.futures import ThreadPoolExecutor
+
+DEFAULT_SIMILARITY_THRESHOLD = 0.9
+DEFAULT_GROUP_SIZE = 40
+DEFAULT_REDUCE_FAN_IN = 8
+
+_WORD_RE = re.compile(r"[a-z0-9]+")
+
+FINAL_SUMMARY_PROMPT = (
+    "Based on the following list of extracted requirements from a legislative bill, please write a single, "
+    "concise paragraph that summarizes the overall impact and key responsibilities for the agency.\n\n"
+    "EXTRACTED REQUIREMENTS JSON:\n{requirements_json}\n\nCONCISE SUMMARY PARAGRAPH:"
+)
+MAP_SUMMARY_PROMPT = (
+    "The following requirements are one part ({part} of {parts}) of those extracted from a legislative bill. "
+    "Write a short paragraph summarizing the responsibilities they place on the agency, keeping deadlines "
+    "and requirement ids that matter.\n\n"
+    "EXTRACTED REQUIREMENTS JSON:\n{requirements_json}\n\nPARTIAL SUMMARY:"
+)
+REDUCE_SUMMARY_PROMPT = (
+    "The following paragraphs each summarize part of the requirements extracted from a legislative bill. "
+    "{instruction}\n\nPARTIAL SUMMARIES:\n{summaries}\n\n{label}:"
+)
+_FINAL_REDUCE = ("Combine them into a single, concise paragraph that summarizes the overall impact and key "
+                 "responsibilities for the agency.", "CONCISE SUMMARY PARAGRAPH")
+_PARTIAL_REDUCE = ("Combine them into one short paragraph, keeping deadlines and requirement ids that matter.",
+                   "PARTIAL SUMMARY")
+
+
+def compact_json(value):
+    return json.dumps(value, separators=(",", ":"), ensure_ascii=False)
+
+
+def _words(requirement):
+    if isinstance(requirement, dict):
+        text = requirement.get("description") or compact_json({k: v for k, v in requirement.items() if k not in ("id", "source_pages")})
+    else:
+        text = str(requirement)
+    return frozenset(_WORD_RE.findall(text.lower()))
+
+
+def _kind(requirement):
+    return requirement.get("type") if isinstance(requirement, dict) else None
+
+
+def dedupe_similar_requirements(requirements, threshold=DEFAULT_SIMILARITY_THRESHOLD):
+    """
+    Drops requirements whose description shares at least `threshold` of its
+    words (Jaccard similarity) with an earlier requirement of the same type.
+    The first occurrence wins, so chunk order is preserved.
+    """
+    if not threshold or threshold <= 0:
+        return list(requirements)
+    kept = []
+    # Kept word sets indexed by word, so each requirement is only compared
+    # with the kept ones it shares vocabulary with.
+    by_word = {}
+    signatures = []
+    for requirement in requirements:
+        words = _words(requirement)
+        kind = _kind(requirement)
+        candidates = set()
+        for word in words:
+            candidates.update(by_word.get(word, ()))
+        duplicate = False
+        for index in candidates:
+            other_words, other_kind = signatures[index]
+            if other_kind != kind:
+                continue
+            union = len(words | other_words)
+            if union and len(words & other_words) / union >= threshold:
+                duplicate = True
+                break
+        if duplicate:
+            continue
+        index = len(signatures)
+        signatures.append((words, kind))
+        for word in words:
+            by_word.setdefault(word, []).append(index)
+        kept.append(requirement)
+    return kept
+
+
+def _groups(items, size):
+    size = max(1, size)
+    return [items[i:i + size] for i in range(0, len(items), size)]
+
+
+def summarize_requirements(requirements, generate, group_size=DEFAULT_GROUP_SIZE,
+                           reduce_fan_in=DEFAULT_REDUCE_FAN_IN, max_concurrency=4):
+    """
+    Returns one summary paragraph for `requirements`. `generate(prompt, stage)`
+    calls the model; stage is 'summary.map', 'summary.reduce' or
+    'summary.final'. A list that fits in one group is summarized with a
+    single call.
+    """
+    groups = _groups(requirements, group_size)
+    if len(groups) <= 1:
+        return generate(FINAL_SUMMARY_PROMPT.format(requirements_json=compact_json(requirements)), "summary.final").strip()
+
+    workers = max(1, max_concurrency)
+    with ThreadPoolExecutor(max_workers=min(workers, len(groups))) as executor:
+        summaries = list(executor.map(
+            lambda numbered: generate(MAP_SUMMARY_PROMPT.format(
+                part=numbered[0] + 1, parts=len(groups), requirements_json=compact_json(numbered[1])
+            ), "summary.map").strip(),
+            enumerate(groups),
+        ))
+        print(f"  -> Summarized {len(requirements)} requirements as {len(summaries)} partial summaries.")
+
+        fan_in = max(2, reduce_fan_in)
+        while len(summaries) > fan_in:
+            batches = _groups(summaries, fan_in)
+            summaries = list(executor.map(
+                lambda batch: generate(_reduce_prompt(batch, final=False), "summary.reduce").strip(),
+                batches,
+            ))
+            print(f"  -> Reduced to {len(summaries)} partial summaries.")
+
+    return generate(_reduce_prompt(summaries, final=True), "summary.final").strip()
+
+
+def _reduce_prompt(summaries, final):
+    instruction, label = _FINAL_REDUCE if final else _PARTIAL_REDUCE
+    return REDUCE_SUMMARY_PROMPT.format(
+        instruction=instruction, summaries="\n\n".join(f"- {summary}" for summary in summaries), label=label
+    )
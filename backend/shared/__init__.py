@@ -0,0 +1,6 @@
+"""
+Modules shared by every SOW-Forge Cloud Function.
+
+deploy.sh copies this package into each function's source archive, so
+functions import it as `from shared import ...`.
+"""
@@ -0,0 +1,88 @@
+"""
+Multi-document Document AI batches for bulk ingestion.
+
+Bills dropped into the uploads bucket under the bulk prefix are not OCR'd one
+by one. bulk_ingest (or a '.manifest.json' upload) groups the small ones into
+a few multi-document batch requests that share an output prefix,
+gs://<batch output>/bulk/<batch_id>/. Document AI writes each input's JSON
+under '<operation>/<input index>/', so the batch's bulk_batches/{batch_id}
+document maps every input index to its sows document id, and
+batch_result_handler uses it to fan the shards back out to per-document
+'.txt' files and sows records. Batch documents carry an 'expires_at' field
+for the Firestore TTL policy, well after Document AI has finished with them.
+"""
+import os
+import uuid
+from datetime import datetime, timedelta, timezone
+
+BULK_BATCH_COLLECTION = "bulk_batches"
+# Top-level directory of multi-document batch output in the batch output bucket.
+BULK_OUTPUT_DIR = "bulk"
+DEFAULT_BULK_UPLOAD_PREFIX = "bulk/"
+MANIFEST_SUFFIX = ".manifest.json"
+BATCH_RETENTION = timedelta(days=7)
+
+
+def new_batch_id():
+    return uuid.uuid4().hex[:16]
+
+
+def bulk_doc_id(object_name):
+    """Bulk uploads may sit in sub-folders; the sows id is the bare file name."""
+    return os.path.splitext(os.path.basename(object_name))[0]
+
+
+def parse_gcs_uri(uri, default_bucket=None):
+    """Splits 'gs://bucket/name' into (bucket, name); a bare object name uses `default_bucket`."""
+    if uri.startswith("gs://"):
+        bucket, _, name = uri[len("gs://"):].partition("/")
+        return bucket, name
+    return default_bucket, uri
+
+
+def output_prefix(batch_id):
+    return f"{BULK_OUTPUT_DIR}/{batch_id}/"
+
+
+def is_bulk_output(file_name):
+    return file_name.startswith(f"{BULK_OUTPUT_DIR}/")
+
+
+def parse_bulk_output(file_name):
+    """
+    Returns (batch_id, input_index) for 'bulk/<batch_id>/<operation>/<index>/<name>-<shard>.json',
+    or None if the name does not follow that layout.
+    """
+    parts = file_name.split("/")
+    if len(parts) < 5 or parts[0] != BULK_OUTPUT_DIR or not parts[3].isdigit():
+        return None
+    return parts[1], parts[3]
+
+
+def plan_batches(documents, small_document_max_pages, max_documents_per_batch):
+    """
+    Groups documents for submission. Documents with a known page count up to
+    `small_document_max_pages` share multi-document requests of at most
+    `max_documents_per_batch`; larger or unknown ones get a request of their
+    own so they can use page-sharded output. Returns a list of lists.
+    """
+    small, large = [], []
+    for document in documents:
+        page_count = document.get("page_count")
+        (small if page_count and page_count <= small_document_max_pages else large).append(document)
+    size = max(1, max_documents_per_batch)
+    return [small[i:i + size] for i in range(0, len(small), size)] + [[d] for d in large]
+
+
+def batch_record(batch_id, documents, source):
+    """The bulk_batches document for one request: input index -> sows id."""
+    from google.cloud import firestore
+    return {
+        "batch_id": batch_id,
+        "source": source,
+        "status": "SUBMITTING",
+        "document_count": len(documents),
+        "documents": {str(i): {"doc_id": d["doc_id"], "uri": d["uri"]} for i, d in enumerate(documents)},
+        "created_at": firestore.SERVER_TIMESTAMP,
+        "expires_at": datetime.now(timezone.utc) + BATCH_RETENTION,
+    }
@@ -0,0 +1,222 @@
+"""
+Structure-aware, token-budgeted chunking for legislative text.
+
+Text is first broken into structural units (SECTION/ARTICLE/CHAPTER headings,
+then paragraphs, then sentences for oversized paragraphs). Units are packed
+into chunks that fit a token budget. Chunk boundaries are content-defined: a
+chunk closes at a section heading, or after an "anchor" unit chosen by the
+hash of its own text, once it is reasonably full. Boundaries therefore
+depend only on nearby text, so an edit changes the chunks around it and the
+following chunks realign at the next anchor, keeping incremental
+re-analysis proportional to the size of the change. An optional overlap of
+trailing text (whole units, or the last sentences of a long one) is carried
+into the next chunk so requirements that straddle a boundary are seen whole.
+
+Token counts come from a local estimator. `calibrate_chars_per_token` can tune
+it against the real tokenizer with a single `model.count_tokens` call.
+"""
+import hashlib
+import json
+import math
+import re
+from collections import namedtuple
+
+DEFAULT_CHARS_PER_TOKEN = 4.0
+# Chunks close at an anchor unit once they hold this share of the budget;
+# anchors occur about once per ANCHOR_SPACING * budget characters.
+ANCHOR_MIN_FILL = 0.25
+ANCHOR_SPACING = 0.5
+CALIBRATION_SAMPLE_CHARS = 20000
+
+# A chunk of the source text; start/end are character offsets into it.
+Chunk = namedtuple("Chunk", ["text", "start", "end"])
+
+_HEADING_RE = re.compile(
+    r"^[ \t]*(?:SECTION|SEC\.|Sec\.|Section|ARTICLE|Article|CHAPTER|Chapter|SUBCHAPTER|Subchapter|PART)\s+[\w.\-]+",
+    re.M,
+)
+_PARAGRAPH_BREAK_RE = re.compile(r"\n[ \t]*\n")
+_SENTENCE_END_RE = re.compile(r"(?<=[.;:!?])\s+")
+
+
+def estimate_tokens(text, chars_per_token=DEFAULT_CHARS_PER_TOKEN):
+    return int(math.ceil(len(text) / chars_per_token))
+
+
+def calibrate_chars_per_token(model, text):
+    """
+    Measures the characters-per-token ratio of `text` with one count_tokens
+    call on a sample. Falls back to the default ratio on any failure.
+    """
+    sample = text[:CALIBRATION_SAMPLE_CHARS]
+    if not sample:
+        return DEFAULT_CHARS_PER_TOKEN
+    try:
+        total_tokens = model.count_tokens(sample).total_tokens
+        return len(sample) / total_tokens if total_tokens else DEFAULT_CHARS_PER_TOKEN
+    except Exception as e:
+        print(f"Token calibration failed, using default estimate: {e}")
+        return DEFAULT_CHARS_PER_TOKEN
+
+
+def _split_at(text, offset, boundary_re):
+    """Splits text[offset:] at every match of boundary_re, keeping separators attached."""
+    pieces = []
+    last = 0
+    for match in boundary_re.finditer(text):
+        if match.end() > last:
+            pieces.append((offset + last, text[last:match.end()]))
+            last = match.end()
+    if last < len(text):
+        pieces.append((offset + last, text[last:]))
+    return pieces
+
+
+def find_headings(text):
+    """Returns the offsets of the SECTION/ARTICLE/CHAPTER heading lines in `text`."""
+    return [m.start() for m in _HEADING_RE.finditer(text)]
+
+
+def split_into_units(text, max_unit_chars, section_starts=None):
+    """
+    Returns [(start_offset, unit_text, starts_section)] covering `text` exactly.
+    Units never exceed `max_unit_chars` characters. `section_starts` are the
+    heading offsets recorded when the text was extracted; without them the
+    headings are found in the text.
+    """
+    if section_starts is None:
+        section_starts = find_headings(text)
+    section_starts = sorted({0} | {start for start in section_starts if 0 < start < len(text)})
+    section_starts.append(len(text))
+
+    units = []
+    for i in range(len(section_starts) - 1):
+        section_offset = section_starts[i]
+        section = text[section_offset:section_starts[i + 1]]
+        first_in_section = i > 0 or bool(_HEADING_RE.match(section))
+        for paragraph_offset, paragraph in _split_at(section, section_offset, _PARAGRAPH_BREAK_RE):
+            pieces = [(paragraph_offset, paragraph)]
+            if len(paragraph) > max_unit_chars:
+                pieces = _split_at(paragraph, paragraph_offset, _SENTENCE_END_RE)
+            for piece_offset, piece in pieces:
+                # Last resort for run-on text with no sentence breaks.
+                for j in range(0, len(piece), max_unit_chars):
+                    units.append((piece_offset + j, piece[j:j + max_unit_chars], first_in_section))
+                    first_in_section = False
+    return units
+
+
+def _is_anchor(unit_text, spacing_chars):
+    """
+    Whether a chunk may close after this unit. Decided by the unit's own text
+    alone, with a probability proportional to its length, so anchors fall
+    about every `spacing_chars` characters wherever the chunking started.
+    """
+    digest = int.from_bytes(hashlib.blake2b(unit_text.encode("utf-8"), digest_size=8).digest(), "big")
+    return digest < min(1.0, len(unit_text) / spacing_chars) * 2 ** 64
+
+
+def _overlap_units(previous, overlap_chars, room):
+    """
+    Returns the trailing units of the closed chunk `previous` to repeat at the
+    start of the next one: whole units while they fit in `overlap_chars` (and
+    `room`), otherwise the last sentences of the final unit.
+    """
+    limit = min(overlap_chars, room)
+    carried, carried_chars = [], 0
+    for unit in reversed(previous):
+        if carried_chars + len(unit[1]) > limit:
+            break
+        carried.insert(0, unit)
+        carried_chars += len(unit[1])
+    if carried or limit <= 0:
+        # Never carry the whole previous chunk, or chunking would not advance.
+        return carried if len(carried) < len(previous) else []
+    offset, unit_text, _ = previous[-1]
+    tail = []
+    for piece_offset, piece in reversed(_split_at(unit_text, offset, _SENTENCE_END_RE)):
+        if carried_chars + len(piece) > limit:
+            break
+        tail.insert(0, piece_offset)
+        carried_chars += len(piece)
+    if not tail or tail[0] == offset:
+        return []
+    return [(tail[0], unit_text[tail[0] - offset:], False)]
+
+
+def build_chunks(text, max_tokens, overlap_tokens=0, chars_per_token=DEFAULT_CHARS_PER_TOKEN, section_starts=None,
+                 anchors=True):
+    """
+    Packs `text` into Chunks of at most `max_tokens` estimated tokens.
+
+    A chunk is closed when the next unit would not fit, at a section heading
+    once it is at least half full, or after an anchor unit once it is at
+    least ANCHOR_MIN_FILL full. With `overlap_tokens`, each chunk after the
+    first starts with the trailing text of the previous chunk.
+    `section_starts` is passed on to split_into_units. `anchors=False` packs
+    chunks as full as the budget and headings allow.
+    """
+    if not text:
+        return []
+    max_chars = max(1, int(max_tokens * chars_per_token))
+    overlap_chars = int(overlap_tokens * chars_per_token)
+    units = split_into_units(text, max_chars, section_starts)
+    spacing_chars = max(1, int(max_chars * ANCHOR_SPACING))
+
+    chunks = []
+    current = []
+    current_chars = 0
+    at_anchor = False
+    for unit in units:
+        _, unit_text, starts_section = unit
+        if current:
+            full = current_chars + len(unit_text) > max_chars
+            section_break = starts_section and current_chars >= max_chars // 2
+            anchor_break = anchors and at_anchor and current_chars >= max_chars * ANCHOR_MIN_FILL
+            if full or section_break or anchor_break:
+                chunks.append(current)
+                current = _overlap_units(current, overlap_chars, max_chars - len(unit_text))
+                current_chars = sum(len(u[1]) for u in current)
+        current.append(unit)
+        current_chars += len(unit_text)
+        at_anchor = _is_anchor(unit_text, spacing_chars)
+    if current:
+        chunks.append(current)
+
+    return [
+        Chunk("".join(u[1] for u in chunk_units), chunk_units[0][0], chunk_units[-1][0] + len(chunk_units[-1][1]))
+        for chunk_units in chunks
+    ]
+
+
+def fit_to_token_budget(text, max_tokens, chars_per_token=DEFAULT_CHARS_PER_TOKEN):
+    """Returns a prefix of `text`, cut at a structural boundary, that fits in `max_tokens`."""
+    if estimate_tokens(text, chars_per_token) <= max_tokens:
+        return text
+    chunks = build_chunks(text, max_tokens, chars_per_token=chars_per_token, anchors=False)
+    return chunks[0].text if chunks else ""
+
+
+def _requirement_key(requirement):
+    """Normalized identity of a requirement, ignoring ids, page citations and whitespace/case differences."""
+    if not isinstance(requirement, dict):
+        return " ".join(str(requirement).lower().split())
+    material = {k: v for k, v in requirement.items() if k not in ("id", "source_pages")}
+    return " ".join(json.dumps(material, sort_keys=True, ensure_ascii=False).lower().split())
+
+
+def merge_requirements(chunk_results):
+    """
+    Flattens per-chunk requirement lists in chunk order, dropping exact
+    duplicates produced by overlapping chunks.
+    """
+    seen = set()
+    merged = []
+    for chunk_reqs in chunk_results:
+        for requirement in chunk_reqs:
+            key = _requirement_key(requirement)
+            if key in seen:
+                continue
+            seen.add(key)
+            merged.append(requirement)
+    return merged
@@ -0,0 +1,220 @@
+"""
+Vertex AI context caching for long, stable prompt prefixes.
+
+Every SOW generated against a template repeats the whole template. Prompts
+are split (shared/prompting.split_prompt) into that stable prefix and the
+part that changes per call. A prefix large enough to be cached is uploaded
+once as a Vertex AI CachedContent; calls against it send only the suffix and
+the prefix is billed at the cached-token rate.
+
+Bill analysis goes through the same path, but its stable prefix is only the
+instructions in front of {DOCUMENT_TEXT} (the document text is different for
+every chunk). With the stock prompt that is well under the minimum Vertex AI
+accepts, so analysis sends full prompts unless its prompt grows past it; in
+practice SOW generation is what benefits.
+
+Cache handles are keyed by model, prompt id, prompt version, template
+generation and the hash of the prefix itself, and are shared between
+instances through the 'context_caches' collection, whose records carry an
+'expires_at' field for the Firestore TTL policy. A handle is extended
+when less than half of its TTL is left and is treated as gone shortly
+before it expires. Whatever goes wrong with a cache (creating it, looking it
+up, or calling a cache that expired under us) falls back to sending the
+whole prompt.
+"""
+import hashlib
+import itertools
+import json
+import threading
+from datetime import datetime, timedelta, timezone
+
+from shared.chunking import DEFAULT_CHARS_PER_TOKEN
+from shared.runtime import init_vertexai
+
+CACHE_COLLECTION = "context_caches"
+DEFAULT_TTL_SECONDS = 3600
+# Vertex AI rejects caches smaller than this.
+DEFAULT_MIN_TOKENS = 4096
+EXPIRY_MARGIN_SECONDS = 120
+
+_lock = threading.Lock()
+_handles = {}  # key -> {"model": GenerativeModel, "cached_content": ..., "expire_time": datetime}
+
+
+def context_cache_key(model_name, prompt_id, prompt_version, template_generation, prefix):
+    """Returns the SHA-256 hex digest identifying a cached prefix."""
+    prefix_hash = hashlib.sha256(prefix.encode("utf-8")).hexdigest()
+    key_material = json.dumps([model_name, prompt_id, prompt_version, template_generation, prefix_hash])
+    return hashlib.sha256(key_material.encode("utf-8")).hexdigest()
+
+
+def _cache_errors():
+    """Errors that mean the cache cannot be used; rate limits are left to the scheduler."""
+    from google.api_core import exceptions
+    return (exceptions.NotFound, exceptions.FailedPrecondition, exceptions.InvalidArgument, exceptions.PermissionDenied)
+
+
+class PrefixedModel:
+    """
+    Generates from prompts of the form prefix + suffix: callers pass only the
+    suffix. The cached model is resolved on the first call, so runs served
+    entirely from the LLM response cache never touch a context cache.
+    """
+
+    def __init__(self, model, prefix, resolve=None, on_cache_error=None):
+        self.model = model
+        self.prefix = prefix
+        self._resolve = resolve
+        self._on_cache_error = on_cache_error
+        self._cached_model = None
+        self._lock = threading.Lock()
+
+    def _get_cached_model(self):
+        with self._lock:
+            if self._resolve is not None:
+                resolve, self._resolve = self._resolve, None
+                self._cached_model = resolve()
+            return self._cached_model
+
+    def generate_content(self, suffix, generation_config=None, stream=False):
+        cached_model = self._get_cached_model()
+        if cached_model is not None:
+            try:
+                response = cached_model.generate_content(suffix, generation_config=generation_config, stream=stream)
+                if not stream:
+                    return response
+                # A streamed call reports errors with its first chunk.
+                chunks = iter(response)
+                first = next(chunks, None)
+                return itertools.chain([first] if first is not None else [], chunks)
+            except _cache_errors() as e:
+                print(f"Context cache call failed ({e}); sending the full prompt.")
+                with self._lock:
+                    self._cached_model = None
+                if self._on_cache_error is not None:
+                    self._on_cache_error()
+        return self.model.generate_content(self.prefix + suffix, generation_config=generation_config, stream=stream)
+
+
+class ContextCache:
+
+    def __init__(self, settings, db=None):
+        self.enabled = bool(settings.get("context_cache_enabled", True))
+        self.ttl_seconds = int(settings.get("context_cache_ttl_seconds", DEFAULT_TTL_SECONDS))
+        self.min_tokens = int(settings.get("context_cache_min_tokens", DEFAULT_MIN_TOKENS))
+        self.db = db
+
+    def prefixed_model(self, model, model_name, prefix, recorder, prompt_id, prompt_version=None,
+                       template_generation=None):
+        """
+        Returns a PrefixedModel for `prefix`, backed by a context cache when the
+        prefix is long enough to be cached and caching is enabled.
+        """
+        if not self.enabled or len(prefix) / DEFAULT_CHARS_PER_TOKEN < self.min_tokens:
+            return PrefixedModel(model, prefix)
+        key = context_cache_key(model_name, prompt_id, prompt_version, template_generation, prefix)
+        labels = {"prompt_id": prompt_id, "prompt_version": prompt_version, "template_generation": template_generation}
+
+        def resolve():
+            try:
+                return self._cached_model(key, model_name, prefix, labels, recorder)
+            except Exception as e:
+                print(f"Context cache unavailable ({e}); sending full prompts.")
+                return None
+
+        return PrefixedModel(model, prefix, resolve=resolve, on_cache_error=lambda: self.forget(key))
+
+    def _cached_model(self, key, model_name, prefix, labels, recorder):
+        now = datetime.now(timezone.utc)
+        margin = timedelta(seconds=EXPIRY_MARGIN_SECONDS)
+        with _lock:
+            handle = _handles.get(key)
+        if handle is None or handle["expire_time"] - margin <= now:
+            handle = self._load(key, now + margin)
+        if handle is None:
+            with recorder.stage("vertex.create_context_cache", chars=len(prefix)):
+                handle = self._create(key, model_name, prefix, labels, now)
+            print(f"  -> Created context cache {handle['cached_content'].name} for prompt '{labels['prompt_id']}'.")
+        elif (handle["expire_time"] - now).total_seconds() < self.ttl_seconds / 2:
+            with recorder.stage("vertex.extend_context_cache"):
+                self._extend(key, handle, now)
+        with _lock:
+            _handles[key] = handle
+        return handle["model"]
+
+    def _handle(self, cached_content, expire_time):
+        from vertexai.preview.generative_models import GenerativeModel
+        return {
+            "model": GenerativeModel.from_cached_content(cached_content=cached_content),
+            "cached_content": cached_content,
+            "expire_time": expire_time,
+        }
+
+    def _load(self, key, valid_until):
+        """Returns the handle another instance stored, or None if there is none still valid."""
+        if self.db is None:
+            return None
+        from google.api_core import exceptions
+        from vertexai.preview import caching
+
+        record = self.db.collection(CACHE_COLLECTION).document(key).get()
+        if not record.exists:
+            return None
+        data = record.to_dict()
+        if not data.get("expire_time") or data["expire_time"] <= valid_until:
+            return None
+        init_vertexai()
+        try:
+            cached_content = caching.CachedContent(cached_content_name=data["name"])
+        except exceptions.NotFound:
+            return None
+        return self._handle(cached_content, data["expire_time"])
+
+    def _create(self, key, model_name, prefix, labels, now):
+        from google.cloud import firestore
+        from vertexai.preview import caching
+
+        init_vertexai()
+        cached_content = caching.CachedContent.create(
+            model_name=model_name,
+            contents=[prefix],
+            ttl=timedelta(seconds=self.ttl_seconds),
+            display_name=f"sow-forge-{labels['prompt_id']}"[:128],
+        )
+        expire_time = now + timedelta(seconds=self.ttl_seconds)
+        if self.db is not None:
+            # Instances racing to create the same cache each keep their own; the last record wins.
+            self.db.collection(CACHE_COLLECTION).document(key).set({
+                "name": cached_content.name,
+                "model": model_name,
+                "prefix_chars": len(prefix),
+                "expire_time": expire_time,
+                "expires_at": expire_time + timedelta(seconds=EXPIRY_MARGIN_SECONDS),
+                "created_at": firestore.SERVER_TIMESTAMP,
+                **labels,
+            })
+        return self._handle(cached_content, expire_time)
+
+    def _extend(self, key, handle, now):
+        try:
+            handle["cached_content"].update(ttl=timedelta(seconds=self.ttl_seconds))
+        except Exception as e:
+            # Still usable until it expires.
+            print(f"Warning: could not extend context cache: {e}")
+            return
+        handle["expire_time"] = now + timedelta(seconds=self.ttl_seconds)
+        if self.db is not None:
+            self.db.collection(CACHE_COLLECTION).document(key).set({
+                "expire_time": handle["expire_time"],
+                "expires_at": handle["expire_time"] + timedelta(seconds=EXPIRY_MARGIN_SECONDS),
+            }, merge=True)
+
+    def forget(self, key):
+        """Drops a cache that turned out to be unusable, so the next call creates a new one."""
+        with _lock:
+            _handles.pop(key, None)
+        if self.db is not None:
+            try:
+                self.db.collection(CACHE_COLLECTION).document(key).delete()
+            except Exception as e:
+                print(f"Warning: could not remove context cache record: {e}")
@@ -0,0 +1,123 @@
+"""
+Duplicate-delivery suppression for the GCS-triggered functions.
+
+Eventarc delivers object.finalized events at least once, and the functions
+run with RETRY_POLICY_RETRY, so the same object can trigger a function more
+than once. Each delivery claims a lease on event_leases/{key}, where the key
+is a hash of (function, bucket, object, generation, metageneration), in a
+Firestore transaction. The metageneration is part of the key so that the
+dashboard's "regenerate" action, which re-triggers the pipeline by touching
+the upload's metadata, is not mistaken for a duplicate. A delivery finds:
+
+  - no lease yet, or an expired or released one: the delivery takes it and
+    does the work;
+  - a lease marked done: the work already succeeded, so the delivery exits;
+  - a live lease held by another delivery: the work is in progress, so the
+    delivery exits.
+
+A lease expires after `lease_seconds`, which must be longer than the
+function timeout, so a crashed or timed-out instance does not block retries
+forever. Lease documents carry an 'expires_at' field for the Firestore TTL
+policy.
+"""
+import hashlib
+import uuid
+from datetime import datetime, timedelta, timezone
+
+LEASE_COLLECTION = "event_leases"
+# Longer than the 540s maximum function timeout.
+DEFAULT_LEASE_SECONDS = 600
+LEASE_RETENTION = timedelta(days=7)
+
+ACQUIRED = "acquired"
+ALREADY_DONE = "done"
+IN_PROGRESS = "in_progress"
+
+
+def event_key(function_name, bucket, name, generation, metageneration=""):
+    return hashlib.sha256(
+        f"{function_name}\n{bucket}\n{name}\n{generation}\n{metageneration}".encode("utf-8")
+    ).hexdigest()
+
+
+class EventLease:
+    """One delivery's claim on processing an object event."""
+
+    def __init__(self, db, function_name, event_data, lease_seconds=DEFAULT_LEASE_SECONDS):
+        self.db = db
+        self.function_name = function_name
+        self.bucket = event_data.get("bucket")
+        self.name = event_data.get("name")
+        self.generation = str(event_data.get("generation") or "")
+        self.metageneration = str(event_data.get("metageneration") or "")
+        self.lease_seconds = lease_seconds
+        self.owner = uuid.uuid4().hex
+        self.state = None
+        self.ref = db.collection(LEASE_COLLECTION).document(
+            event_key(function_name, self.bucket, self.name, self.generation, self.metageneration)
+        )
+
+    def acquire(self):
+        """Returns True if this delivery should do the work."""
+        from google.cloud import firestore
+
+        @firestore.transactional
+        def claim(transaction):
+            snapshot = self.ref.get(transaction=transaction)
+            lease = snapshot.to_dict() if snapshot.exists else {}
+            now = datetime.now(timezone.utc)
+            if lease.get("state") == "done":
+                return ALREADY_DONE
+            if lease.get("state") == "running" and lease.get("lease_expires_at") and lease["lease_expires_at"] > now:
+                return IN_PROGRESS
+            transaction.set(self.ref, {
+                "function": self.function_name,
+                "bucket": self.bucket,
+                "object": self.name,
+                "generation": self.generation,
+                "metageneration": self.metageneration,
+                "state": "running",
+                "owner": self.owner,
+                "attempts": lease.get("attempts", 0) + 1,
+                "lease_expires_at": now + timedelta(seconds=self.lease_seconds),
+                "acquired_at": firestore.SERVER_TIMESTAMP,
+                "expires_at": now + LEASE_RETENTION,
+            })
+            return ACQUIRED
+
+        self.state = claim(self.db.transaction())
+        if self.state != ACQUIRED:
+            print(f"Skipping duplicate delivery of gs://{self.bucket}/{self.name}#{self.generation}: {self.state}.")
+        return self.state == ACQUIRED
+
+    def complete(self, writes=None):
+        """
+        Marks the event as processed so later deliveries exit immediately.
+        With `writes` (a pipeline_state.StageWrites) the update is committed
+        together with the stage's other writes.
+        """
+        from google.cloud import firestore
+        fields = {"state": "done", "completed_at": firestore.SERVER_TIMESTAMP}
+        if writes is not None:
+            writes.set_fields(self.ref, fields)
+            return
+        try:
+            self.ref.update(fields)
+        except Exception as e:
+            # The work is done; at worst a redelivery repeats it once the lease expires.
+            print(f"Warning: could not mark event lease as done: {e}")
+
+    def release(self, error=None, writes=None):
+        """Gives the lease up after a failure so a retry can take over at once."""
+        fields = {
+            "state": "failed",
+            "lease_expires_at": datetime.now(timezone.utc),
+            "last_error": str(error) if error is not None else None,
+        }
+        if writes is not None:
+            writes.set_fields(self.ref, fields)
+            return
+        try:
+            self.ref.update(fields)
+        except Exception as e:
+            print(f"Warning: could not release event lease: {e}")
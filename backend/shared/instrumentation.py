@@ -0,0 +1,136 @@
+"""
+Per-stage latency and token accounting with structured JSON logs.
+
+Each invocation creates a StageRecorder for its function and document. Code
+wrapped in `with recorder.stage("docai.process"):` is timed and logged as one
+JSON line on stdout, which Cloud Logging turns into a structured entry; the
+'logging.googleapis.com/trace' field groups every entry for a document in the
+Logs Explorer. Gemini token counts are copied from `response.usage_metadata`
+with `record_usage`.
+
+The trace id is created by the first function that sees a document, stored
+on the sows document as 'trace_id' and copied into the metadata of the
+objects the pipeline writes for it, so later functions pick it up from their
+triggering event or from the document. At the end of an invocation `flush`
+merges a compact summary into the document under timings.<function>, either
+directly or as part of the stage's batched writes.
+"""
+import json
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from shared.runtime import GCP_PROJECT_ID
+
+TRACE_ID_KEY = "trace_id"
+# Numeric span fields that are summed into the per-document summary.
+SUMMED_FIELDS = ("bytes", "prompt_tokens", "output_tokens", "cached_tokens")
+
+
+def new_trace_id():
+    return uuid.uuid4().hex
+
+
+def resolve_trace_id(*sources):
+    """Returns the first trace id found in the given dicts (object metadata, document data), or a new one."""
+    for source in sources:
+        value = (source or {}).get(TRACE_ID_KEY)
+        if value:
+            return str(value)
+    return new_trace_id()
+
+
+def record_usage(span, response):
+    """Copies Gemini token counts from a response onto a stage span."""
+    usage = getattr(response, "usage_metadata", None)
+    if usage is None:
+        return
+    span["prompt_tokens"] = span.get("prompt_tokens", 0) + (getattr(usage, "prompt_token_count", 0) or 0)
+    span["output_tokens"] = span.get("output_tokens", 0) + (getattr(usage, "candidates_token_count", 0) or 0)
+    cached = getattr(usage, "cached_content_token_count", 0) or 0
+    if cached:
+        span["cached_tokens"] = span.get("cached_tokens", 0) + cached
+
+
+class StageRecorder:
+
+    def __init__(self, function_name, doc_id=None, trace_id=None):
+        self.function_name = function_name
+        self.doc_id = doc_id
+        self.trace_id = trace_id or new_trace_id()
+        self._lock = threading.Lock()
+        self._totals = {}
+        self._started = time.perf_counter()
+
+    def _context(self):
+        context = {
+            "function": self.function_name,
+            TRACE_ID_KEY: self.trace_id,
+            "logging.googleapis.com/trace": f"projects/{GCP_PROJECT_ID}/traces/{self.trace_id}",
+        }
+        if self.doc_id:
+            context["doc_id"] = self.doc_id
+        return context
+
+    def log(self, message, severity="INFO", **fields):
+        record = {"severity": severity, "message": message}
+        record.update(self._context())
+        record.update(fields)
+        print(json.dumps(record, default=str), flush=True)
+
+    @contextmanager
+    def stage(self, name, **fields):
+        """
+        Times the enclosed block as stage `name`. Yields a dict the block can
+        add fields to (bytes, token counts, ...); they are logged with the
+        duration and summed into the summary.
+        """
+        span = dict(fields)
+        start = time.perf_counter()
+        error = None
+        try:
+            yield span
+        except Exception as e:
+            error = e
+            raise
+        finally:
+            duration_ms = (time.perf_counter() - start) * 1000
+            with self._lock:
+                totals = self._totals.setdefault(name, {"ms": 0.0, "n": 0})
+                totals["ms"] += duration_ms
+                totals["n"] += 1
+                for key in SUMMED_FIELDS:
+                    if isinstance(span.get(key), (int, float)):
+                        totals[key] = totals.get(key, 0) + span[key]
+            if error is not None:
+                span["error"] = str(error)
+            self.log(f"{name} took {duration_ms:.0f} ms", severity="ERROR" if error else "INFO",
+                     stage=name, duration_ms=round(duration_ms, 1), **span)
+
+    def summary(self):
+        """Compact per-stage totals: {stage: {ms, n, [bytes, prompt_tokens, ...]}} plus total_ms."""
+        with self._lock:
+            summary = {
+                name: {key: int(round(value)) for key, value in totals.items()}
+                for name, totals in self._totals.items()
+            }
+        summary["total_ms"] = int(round((time.perf_counter() - self._started) * 1000))
+        return summary
+
+    def flush(self, doc_ref, writes=None):
+        """
+        Merges the summary into the document under timings.<function>, adding
+        it to `writes` (a pipeline_state.StageWrites) when given. Never raises.
+        """
+        summary = self.summary()
+        self.log(f"{self.function_name} finished in {summary['total_ms']} ms", timings=summary)
+        if doc_ref is None:
+            return
+        if writes is not None:
+            writes.set_fields(doc_ref, {f"timings.{self.function_name}": summary})
+            return
+        try:
+            # Merging on the field path replaces this function's earlier summary but keeps the others'.
+            doc_ref.set({"timings": {self.function_name: summary}}, merge=[f"timings.{self.function_name}"])
+        except Exception as e:
+            print(f"Warning: could not save stage timings: {e}")
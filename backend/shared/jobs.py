@@ -0,0 +1,242 @@
+"""
+Asynchronous jobs for the long-running HTTP functions.
+
+A request sent with {"async": true} is recorded as jobs/{job_id} and answered
+at once with the job id; the work runs later and reports its progress,
+result or error on the job document, which the frontend polls. The job id is
+a hash of the function and the request body, so a retried or repeated
+request joins the job that is already queued or running instead of starting
+a second one.
+
+Jobs are dispatched through Cloud Tasks when 'jobs_task_queue' and the
+function's '<kind>_function_url' are set: the task calls the same function
+back with {"runJob": job_id}, and the queue's dispatch limits bound the load
+on Gemini. Without a queue the job runs within the request that submitted
+it, which then answers once the job has finished: Cloud Functions throttles
+an instance's CPU after it has responded, so work cannot be left running
+behind the response. Either way at most 'jobs_max_concurrent_per_instance'
+jobs run at once on one instance.
+"""
+import hashlib
+import json
+import threading
+from datetime import datetime, timedelta, timezone
+
+JOBS_COLLECTION = "jobs"
+
+QUEUED = "QUEUED"
+RUNNING = "RUNNING"
+SUCCEEDED = "SUCCEEDED"
+FAILED = "FAILED"
+ACTIVE_STATES = {QUEUED, RUNNING}
+
+# A queued or running job that has not reported for this long is assumed lost
+# (for example its instance was shut down) and may be started again.
+DEFAULT_STALE_SECONDS = 1800
+DEFAULT_MAX_CONCURRENT_PER_INSTANCE = 2
+JOB_RETENTION = timedelta(days=7)
+# Cloud Tasks allows HTTP targets up to 30 minutes.
+TASK_DISPATCH_DEADLINE_SECONDS = 1800
+
+_slots_lock = threading.Lock()
+_slots = {}
+
+
+class JobFailed(Exception):
+    """Raised by a job handler to fail the job with a user-facing message."""
+
+
+def job_id_for(kind, payload):
+    canonical = json.dumps(payload, sort_keys=True, separators=(",", ":"), default=str)
+    return hashlib.sha256(f"{kind}\n{canonical}".encode("utf-8")).hexdigest()[:40]
+
+
+def _now():
+    return datetime.now(timezone.utc)
+
+
+def _is_stale(job, stale_seconds):
+    heartbeat = job.get("heartbeat_at")
+    return heartbeat is None or heartbeat < _now() - timedelta(seconds=stale_seconds)
+
+
+def _worker_slots(max_concurrent):
+    with _slots_lock:
+        slots = _slots.get(max_concurrent)
+        if slots is None:
+            slots = _slots[max_concurrent] = threading.BoundedSemaphore(max(1, max_concurrent))
+        return slots
+
+
+def submit_job(db, kind, payload, stale_seconds=DEFAULT_STALE_SECONDS):
+    """
+    Records a job for `payload` unless an identical one is still queued or
+    running. Returns (job_id, created).
+    """
+    from google.cloud import firestore
+
+    job_id = job_id_for(kind, payload)
+    job_ref = db.collection(JOBS_COLLECTION).document(job_id)
+
+    @firestore.transactional
+    def claim(transaction):
+        snapshot = job_ref.get(transaction=transaction)
+        job = snapshot.to_dict() if snapshot.exists else {}
+        if job.get("state") in ACTIVE_STATES and not _is_stale(job, stale_seconds):
+            return False
+        now = _now()
+        transaction.set(job_ref, {
+            "kind": kind,
+            "payload": payload,
+            "state": QUEUED,
+            "progress": {},
+            "result": None,
+            "error": None,
+            "attempts": 0,
+            "created_at": firestore.SERVER_TIMESTAMP,
+            "last_updated_at": firestore.SERVER_TIMESTAMP,
+            "heartbeat_at": now,
+            "expires_at": now + JOB_RETENTION,
+        })
+        return True
+
+    return job_id, claim(db.transaction())
+
+
+def dispatch_job(job_id, kind, settings):
+    """
+    Hands a newly submitted job to Cloud Tasks. Returns False when no queue
+    is configured for `kind`, in which case the caller runs the job itself.
+    """
+    queue = settings.get("jobs_task_queue")
+    function_url = settings.get(f"{kind}_function_url")
+    if queue and function_url:
+        from google.cloud import tasks_v2
+        from google.protobuf import duration_pb2
+        from shared.runtime import get_tasks_client
+
+        http_request = {
+            "http_method": tasks_v2.HttpMethod.POST,
+            "url": function_url,
+            "headers": {"Content-Type": "application/json"},
+            "body": json.dumps({"runJob": job_id}).encode("utf-8"),
+        }
+        invoker = settings.get("jobs_invoker_service_account")
+        if invoker:
+            http_request["oidc_token"] = {"service_account_email": invoker, "audience": function_url}
+        get_tasks_client().create_task(parent=queue, task={
+            "http_request": http_request,
+            "dispatch_deadline": duration_pb2.Duration(seconds=TASK_DISPATCH_DEADLINE_SECONDS),
+        })
+        return True
+    return False
+
+
+def run_job(db, job_id, kind, handler, max_concurrent=DEFAULT_MAX_CONCURRENT_PER_INSTANCE,
+            stale_seconds=DEFAULT_STALE_SECONDS):
+    """
+    Runs a queued job: `handler(payload, report)` returns the result dict (or
+    raises), and `report(**progress)` publishes progress. A job that is
+    already finished, or running elsewhere, is left alone, so a redelivered
+    task is harmless. Returns the job's final state.
+    """
+    from google.cloud import firestore
+    from shared.pipeline_state import ProgressWriter
+
+    job_ref = db.collection(JOBS_COLLECTION).document(job_id)
+    with _worker_slots(max_concurrent):
+
+        @firestore.transactional
+        def start(transaction):
+            snapshot = job_ref.get(transaction=transaction)
+            job = snapshot.to_dict() if snapshot.exists else None
+            if not job or job.get("kind") != kind:
+                return None, None
+            if job.get("state") == QUEUED or (job.get("state") == RUNNING and _is_stale(job, stale_seconds)):
+                transaction.update(job_ref, {
+                    "state": RUNNING,
+                    "attempts": job.get("attempts", 0) + 1,
+                    "started_at": firestore.SERVER_TIMESTAMP,
+                    "last_updated_at": firestore.SERVER_TIMESTAMP,
+                    "heartbeat_at": _now(),
+                })
+                return RUNNING, job.get("payload") or {}
+            return job.get("state"), None
+
+        state, payload = start(db.transaction())
+        if state != RUNNING:
+            print(f"Job {job_id} not started: {state or 'not found'}.")
+            return state
+
+        progress = ProgressWriter(job_ref)
+
+        def report(**fields):
+            progress.report(heartbeat_at=_now(), **{f"progress.{key}": value for key, value in fields.items()})
+
+        try:
+            result = handler(payload, report)
+            progress.flush()
+            job_ref.update({
+                "state": SUCCEEDED,
+                "result": result,
+                "finished_at": firestore.SERVER_TIMESTAMP,
+                "last_updated_at": firestore.SERVER_TIMESTAMP,
+            })
+            print(f"Job {job_id} succeeded.")
+            return SUCCEEDED
+        except Exception as e:
+            print(f"!!! Job {job_id} failed: {e}")
+            progress.flush()
+            job_ref.update({
+                "state": FAILED,
+                "error": str(e),
+                "finished_at": firestore.SERVER_TIMESTAMP,
+                "last_updated_at": firestore.SERVER_TIMESTAMP,
+            })
+            return FAILED
+
+
+def response_result(response):
+    """
+    Turns an HTTP-style (body, status[, headers]) return value into a job
+    result, raising JobFailed for error statuses.
+    """
+    body, status = (response[0], response[1]) if isinstance(response, tuple) else (response, 200)
+    if status >= 400:
+        raise JobFailed(body if isinstance(body, str) else json.dumps(body))
+    return body
+
+
+def handle_job_request(kind, request_json, handler):
+    """
+    The async half of an HTTP function. {"runJob": id} (sent by Cloud Tasks)
+    runs a queued job; any other body is submitted as a new job, or joins the
+    identical one in flight, and answered with 202 and the job id (or, with
+    no task queue, 200 once the job has run).
+    """
+    from shared.runtime import get_firestore_client, get_settings
+
+    db = get_firestore_client()
+    settings = get_settings()
+    max_concurrent = int(settings.get("jobs_max_concurrent_per_instance", DEFAULT_MAX_CONCURRENT_PER_INSTANCE))
+    stale_seconds = int(settings.get("jobs_stale_seconds", DEFAULT_STALE_SECONDS))
+
+    def run(job_id):
+        return run_job(db, job_id, kind, handler, max_concurrent=max_concurrent, stale_seconds=stale_seconds)
+
+    job_id = request_json.get("runJob")
+    if job_id:
+        # Failed jobs still answer 200 so the task is not retried; the error is on the job.
+        return ({"jobId": job_id, "state": run(job_id)}, 200)
+
+    payload = {key: value for key, value in request_json.items() if key not in ("async", "stream")}
+    job_id, created = submit_job(db, kind, payload, stale_seconds=stale_seconds)
+    if not created:
+        print(f"Joined in-flight job {job_id}.")
+        return ({"jobId": job_id, "state": "IN_FLIGHT", "deduplicated": True}, 202)
+    if dispatch_job(job_id, kind, settings):
+        print(f"Submitted job {job_id} to Cloud Tasks.")
+        return ({"jobId": job_id, "state": QUEUED, "deduplicated": False}, 202)
+    # No queue: run it here, before responding, while the instance still has CPU.
+    print(f"No task queue configured; running job {job_id} in this request.")
+    return ({"jobId": job_id, "state": run(job_id), "deduplicated": False}, 200)
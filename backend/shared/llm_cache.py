@@ -0,0 +1,234 @@
+"""
+Content-addressed cache for Gemini responses.
+
+Responses are keyed by a hash of everything that determines the model output:
+model name, temperature, max output tokens and the fully rendered prompt. Two
+identical calls (a re-uploaded bill, an unchanged chunk in a revised bill, a
+"regenerate" click) therefore only pay for the model once.
+
+Backends are pluggable and can be stacked, e.g. an in-process LRU in front of
+the shared Firestore collection.
+"""
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta, timezone
+
+CACHE_COLLECTION = "llm_cache"
+DISK_CACHE_DIR = "/tmp/sow_forge_llm_cache"
+# Firestore documents are capped at 1 MiB; leave room for the other fields.
+MAX_FIRESTORE_ENTRY_BYTES = 900 * 1024
+
+# In-process LRUs outlive a single invocation so warm instances get hits.
+_memory_backends = {}
+
+
+def make_cache_key(model_name, temperature, max_output_tokens, prompt):
+    """Returns the SHA-256 hex digest identifying a single model call."""
+    key_material = json.dumps(
+        [model_name, float(temperature) if temperature is not None else None,
+         int(max_output_tokens) if max_output_tokens is not None else None, prompt],
+        ensure_ascii=False,
+    )
+    return hashlib.sha256(key_material.encode("utf-8")).hexdigest()
+
+
+class InMemoryLRUBackend:
+    """Bounded LRU kept for the lifetime of a warm instance."""
+
+    def __init__(self, max_entries=256, ttl_seconds=None):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            stored_at, value = entry
+            if self.ttl_seconds and time.time() - stored_at > self.ttl_seconds:
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._entries[key] = (time.time(), value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+
+class LocalDiskBackend:
+    """One file per entry under /tmp; survives between requests on a warm instance."""
+
+    def __init__(self, directory=DISK_CACHE_DIR, ttl_seconds=None):
+        self.directory = directory
+        self.ttl_seconds = ttl_seconds
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, key):
+        return os.path.join(self.directory, f"{key}.txt")
+
+    def get(self, key):
+        path = self._path(key)
+        try:
+            if self.ttl_seconds and time.time() - os.path.getmtime(path) > self.ttl_seconds:
+                os.remove(path)
+                return None
+            with open(path, "r", encoding="utf-8") as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def set(self, key, value):
+        # Write to a temp file first so concurrent readers never see a partial entry.
+        tmp_path = f"{self._path(key)}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.write(value)
+        os.replace(tmp_path, self._path(key))
+
+
+class FirestoreBackend:
+    """
+    Shared across all instances and functions. Entries carry an 'expires_at'
+    timestamp that the collection's TTL policy uses for eviction; expired
+    entries that have not been swept yet are ignored on read.
+    """
+
+    def __init__(self, db, ttl_seconds=7 * 24 * 3600, collection=CACHE_COLLECTION):
+        self.db = db
+        self.ttl_seconds = ttl_seconds
+        self.collection = collection
+
+    def get(self, key):
+        snapshot = self.db.collection(self.collection).document(key).get()
+        if not snapshot.exists:
+            return None
+        data = snapshot.to_dict()
+        expires_at = data.get("expires_at")
+        if expires_at and expires_at < datetime.now(timezone.utc):
+            return None
+        return data.get("response_text")
+
+    def set(self, key, value):
+        if len(value.encode("utf-8")) > MAX_FIRESTORE_ENTRY_BYTES:
+            print(f"LLM cache: response for key {key[:12]} is too large for Firestore, not caching.")
+            return
+        self.db.collection(self.collection).document(key).set({
+            "response_text": value,
+            "created_at": datetime.now(timezone.utc),
+            "expires_at": datetime.now(timezone.utc) + timedelta(seconds=self.ttl_seconds),
+        })
+
+
+class LLMResponseCache:
+    """
+    Looks keys up in each backend in order and writes misses through to all of
+    them. Backend failures are logged and treated as misses so the cache can
+    never break a pipeline run.
+    """
+
+    def __init__(self, backends):
+        self.backends = list(backends)
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        for i, backend in enumerate(self.backends):
+            try:
+                value = backend.get(key)
+            except Exception as e:
+                print(f"LLM cache: {backend.__class__.__name__} read failed: {e}")
+                continue
+            if value is not None:
+                # Promote into the faster backends that missed.
+                for faster in self.backends[:i]:
+                    self._safe_set(faster, key, value)
+                return value
+        return None
+
+    def set(self, key, value):
+        for backend in self.backends:
+            self._safe_set(backend, key, value)
+
+    def _safe_set(self, backend, key, value):
+        try:
+            backend.set(key, value)
+        except Exception as e:
+            print(f"LLM cache: {backend.__class__.__name__} write failed: {e}")
+
+    def lookup(self, model_name, prompt, temperature, max_output_tokens, bypass=False):
+        """
+        Returns the cached response text for this call or None, counting the
+        hit or miss. With `bypass=True` every lookup is a miss.
+        """
+        cached = None
+        if not bypass and self.backends:
+            cached = self.get(make_cache_key(model_name, temperature, max_output_tokens, prompt))
+        with self._lock:
+            if cached is not None:
+                self.hits += 1
+            else:
+                self.misses += 1
+        return cached
+
+    def store(self, model_name, prompt, temperature, max_output_tokens, text):
+        if text:
+            self.set(make_cache_key(model_name, temperature, max_output_tokens, prompt), text)
+
+    def generate_text(self, model_name, prompt, temperature, max_output_tokens, generate_fn, bypass=False):
+        """
+        Returns the cached response text for this call, or calls `generate_fn()`
+        (which must return the response text) and caches the result. With
+        `bypass=True` the lookup is skipped but the fresh result is still stored.
+        """
+        cached = self.lookup(model_name, prompt, temperature, max_output_tokens, bypass=bypass)
+        if cached is not None:
+            return cached
+        text = generate_fn()
+        self.store(model_name, prompt, temperature, max_output_tokens, text)
+        return text
+
+    def stats(self):
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses}
+
+
+def build_llm_cache(settings, db=None):
+    """
+    Builds a cache from the global settings document:
+      llm_cache_backend:      'firestore' (default), 'disk', 'memory' or 'none'
+      llm_cache_ttl_seconds:  entry lifetime, default 7 days
+      llm_cache_max_entries:  size of the in-process LRU, default 256
+    An in-process LRU always sits in front of the disk and Firestore backends.
+    Hit/miss counters are per returned cache, i.e. per invocation.
+    """
+    backend_name = settings.get("llm_cache_backend", "firestore")
+    ttl_seconds = int(settings.get("llm_cache_ttl_seconds", 7 * 24 * 3600))
+    max_entries = int(settings.get("llm_cache_max_entries", 256))
+
+    if backend_name == "none":
+        return LLMResponseCache([])
+
+    memory_key = (max_entries, ttl_seconds)
+    if memory_key not in _memory_backends:
+        _memory_backends[memory_key] = InMemoryLRUBackend(max_entries=max_entries, ttl_seconds=ttl_seconds)
+    backends = [_memory_backends[memory_key]]
+    if backend_name == "disk":
+        backends.append(LocalDiskBackend(ttl_seconds=ttl_seconds))
+    elif backend_name == "firestore":
+        if db is None:
+            from shared.runtime import get_firestore_client
+            db = get_firestore_client()
+        backends.append(FirestoreBackend(db, ttl_seconds=ttl_seconds))
+    elif backend_name != "memory":
+        print(f"LLM cache: unknown backend '{backend_name}', using in-memory only.")
+    return LLMResponseCache(backends)
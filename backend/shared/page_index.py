@@ -0,0 +1,140 @@
+"""
+Page and section offsets for extracted document text.
+
+OCR writes each document's text as {doc_id}.txt in the processed-text bucket
+together with a small JSON sidecar, {doc_id}.pages.json:
+
+  {
+    "version": 1,
+    "text_length": <characters>,
+    "text_bytes": <UTF-8 bytes>,
+    "pages": [{"page": 1, "start": 0, "end": 2210, "byte_start": 0, "byte_end": 2214}, ...],
+    "sections": [{"heading": "SECTION 2. ...", "start": 5012, "page": 3}, ...]
+  }
+
+Character offsets index the text as Python and JavaScript strings (Document
+AI text anchors count Unicode code points); byte offsets are for ranged GCS
+reads of the .txt object, so a page range can be served without downloading
+the whole document. The sidecar is uploaded before the text, so whoever is
+triggered by the text can rely on it being there.
+
+The .txt object's metadata records the MD5 hash GCS reported for the PDF it
+was extracted from (SOURCE_MD5_KEY), so the text can be matched to a copy of
+that PDF elsewhere without trusting the file name.
+"""
+import bisect
+import json
+
+from shared.chunking import find_headings
+
+SIDECAR_SUFFIX = ".pages.json"
+INDEX_VERSION = 1
+MAX_HEADING_CHARS = 160
+SOURCE_MD5_KEY = "source_md5"
+
+
+def sidecar_name(doc_id):
+    return f"{doc_id}{SIDECAR_SUFFIX}"
+
+
+def anchor_span(layout):
+    """Returns the (start, end) character span of a Document AI layout's text anchor, or None."""
+    segments = list(layout.text_anchor.text_segments) if layout and layout.text_anchor else []
+    if not segments:
+        return None
+    return min(int(s.start_index or 0) for s in segments), max(int(s.end_index or 0) for s in segments)
+
+
+def document_page_spans(document, offset=0):
+    """Returns [(start, end)] for each page of a Document AI Document, shifted by `offset`."""
+    spans = []
+    for page in document.pages:
+        span = anchor_span(page.layout)
+        if span is not None:
+            spans.append((span[0] + offset, span[1] + offset))
+    return spans
+
+
+def detect_sections(text):
+    """Returns [(start, heading)] for every section heading line in `text`."""
+    sections = []
+    for start in find_headings(text):
+        line_end = text.find("\n", start)
+        heading = text[start:line_end if line_end != -1 else len(text)].strip()
+        sections.append((start, heading[:MAX_HEADING_CHARS]))
+    return sections
+
+
+def build_page_index(text, page_spans):
+    """
+    Builds the sidecar for `text` from the pages' (start, end) character spans,
+    in page order. Pages are numbered from 1. Text that no page covers (the
+    whole document, if OCR returned no layout) is attributed to the nearest
+    page, so every offset resolves to one.
+    """
+    length = len(text)
+    spans = sorted((max(0, min(start, length)), max(0, min(end, length))) for start, end in page_spans)
+    if not spans:
+        spans = [(0, length)]
+    # Pages tile the text: each runs up to the start of the next one.
+    starts = [0] + [start for start, _ in spans[1:]]
+    ends = starts[1:] + [length]
+
+    # Byte offsets are accumulated boundary by boundary instead of encoding every prefix.
+    byte_offsets = {0: 0}
+    position = bytes_so_far = 0
+    for boundary in sorted(set(starts + ends)):
+        bytes_so_far += len(text[position:boundary].encode("utf-8"))
+        byte_offsets[boundary] = bytes_so_far
+        position = boundary
+
+    pages = [
+        {"page": number, "start": start, "end": end,
+         "byte_start": byte_offsets[start], "byte_end": byte_offsets[end]}
+        for number, (start, end) in enumerate(zip(starts, ends), start=1)
+    ]
+    index = {"version": INDEX_VERSION, "text_length": length, "text_bytes": byte_offsets[length], "pages": pages}
+    index["sections"] = [
+        {"heading": heading, "start": start, "page": page_for_offset(index, start)}
+        for start, heading in detect_sections(text)
+    ]
+    return index
+
+
+def page_for_offset(index, offset):
+    """Returns the page number containing character `offset`."""
+    pages = index["pages"]
+    position = bisect.bisect_right([page["start"] for page in pages], offset) - 1
+    return pages[max(0, position)]["page"]
+
+
+def pages_for_span(index, start, end):
+    """Returns the page numbers overlapping the character span [start, end)."""
+    first = page_for_offset(index, start)
+    last = page_for_offset(index, max(start, end - 1))
+    return list(range(first, last + 1))
+
+
+def section_starts(index):
+    return [section["start"] for section in index.get("sections", [])]
+
+
+def upload_page_index(bucket, doc_id, index, metadata=None):
+    """Writes the sidecar next to the text. Returns its size in bytes."""
+    data = json.dumps(index, separators=(",", ":"), ensure_ascii=False).encode("utf-8")
+    blob = bucket.blob(sidecar_name(doc_id))
+    if metadata:
+        blob.metadata = metadata
+    blob.upload_from_string(data, content_type="application/json")
+    return len(data)
+
+
+def load_page_index(bucket, doc_id):
+    """Returns the document's sidecar, or None for text extracted before sidecars existed."""
+    from google.api_core import exceptions
+
+    try:
+        index = json.loads(bucket.blob(sidecar_name(doc_id)).download_as_bytes())
+    except exceptions.NotFound:
+        return None
+    return index if index.get("version") == INDEX_VERSION and index.get("pages") else None
@@ -0,0 +1,132 @@
+"""
+Large sows fields kept as compressed GCS objects instead of inline.
+
+The full analysis and the generated SOW can run to hundreds of KB, which
+every read of the sows document (the dashboard listing among them) then pays
+for, and which brings big bills close to Firestore's 1 MiB document limit.
+A field larger than 'payload_inline_max_bytes' is written to the payloads
+bucket as gzip-compressed JSON or markdown, named after the SHA-256 of its
+content:
+
+  gs://<payload_bucket>/sows/{doc_id}/{field}/{sha256}.json.gz
+
+and the document keeps '{field}_payload', a pointer with the object URI,
+the hash and the sizes, in place of the field. Smaller values stay inline.
+Readers go through read_field, which handles both forms (and documents
+written before the store existed).
+
+Objects are immutable, so a re-upload of unchanged content is skipped and
+the downloaded bytes are cached per instance by hash; every read decodes its
+own copy, so callers are free to modify what they get. Once a new value has
+been saved, prune_payloads deletes the objects it superseded.
+"""
+import gzip
+import hashlib
+import json
+import threading
+from collections import OrderedDict
+
+DEFAULT_PAYLOAD_BUCKET = "sow-forge-texas-dmv-payloads"
+DEFAULT_INLINE_MAX_BYTES = 16 * 1024
+POINTER_SUFFIX = "_payload"
+MAX_CACHED_PAYLOADS = 16
+
+_lock = threading.Lock()
+_payloads = OrderedDict()
+
+
+def pointer_field(field):
+    return f"{field}{POINTER_SUFFIX}"
+
+
+def _encode(value):
+    if isinstance(value, str):
+        return value.encode("utf-8"), "text", "md"
+    return json.dumps(value, separators=(",", ":"), ensure_ascii=False).encode("utf-8"), "json", "json"
+
+
+def store_payload(storage_client, bucket_name, doc_id, field, value):
+    """Uploads `value` (a str, or anything JSON-serializable) and returns its pointer."""
+    from google.api_core import exceptions
+
+    data, payload_format, extension = _encode(value)
+    digest = hashlib.sha256(data).hexdigest()
+    name = f"sows/{doc_id}/{field}/{digest}.{extension}.gz"
+    # mtime=0 keeps the compressed bytes identical for identical content.
+    compressed = gzip.compress(data, compresslevel=6, mtime=0)
+    try:
+        storage_client.bucket(bucket_name).blob(name).upload_from_string(
+            compressed, content_type="application/gzip", if_generation_match=0
+        )
+    except exceptions.PreconditionFailed:
+        pass  # Same name, same content.
+    return {
+        "uri": f"gs://{bucket_name}/{name}",
+        "sha256": digest,
+        "format": payload_format,
+        "bytes": len(data),
+        "stored_bytes": len(compressed),
+    }
+
+
+def payload_fields(storage_client, settings, doc_id, field, value):
+    """
+    Returns the sows fields that store `value` as `field`: inline when it is
+    small, otherwise as a pointer to an uploaded payload. Either way the
+    other form is deleted, so a document never holds both.
+    """
+    from google.cloud import firestore
+
+    inline_max = int(settings.get("payload_inline_max_bytes", DEFAULT_INLINE_MAX_BYTES))
+    if len(_encode(value)[0]) <= inline_max:
+        return {field: value, pointer_field(field): firestore.DELETE_FIELD}
+    bucket_name = settings.get("payload_bucket", DEFAULT_PAYLOAD_BUCKET)
+    pointer = store_payload(storage_client, bucket_name, doc_id, field, value)
+    print(f"  -> Stored '{field}' in {pointer['uri']} ({pointer['bytes']} bytes, {pointer['stored_bytes']} compressed).")
+    return {field: firestore.DELETE_FIELD, pointer_field(field): pointer}
+
+
+def prune_payloads(storage_client, settings, doc_id, field, fields):
+    """
+    Deletes the stored objects of `field` other than the one `fields` (as
+    returned by payload_fields) points to. Call it only after `fields` has
+    been written, so the document never points at a deleted object.
+    """
+    pointer = fields.get(pointer_field(field))
+    keep = pointer["uri"] if isinstance(pointer, dict) else None
+    bucket_name = settings.get("payload_bucket", DEFAULT_PAYLOAD_BUCKET)
+    try:
+        for blob in storage_client.list_blobs(bucket_name, prefix=f"sows/{doc_id}/{field}/"):
+            if f"gs://{bucket_name}/{blob.name}" != keep:
+                blob.delete()
+                print(f"  -> Deleted superseded payload gs://{bucket_name}/{blob.name}.")
+    except Exception as e:
+        # Left for the next save of the field to clean up.
+        print(f"Warning: could not delete superseded '{field}' payloads of '{doc_id}': {e}")
+
+
+def load_payload(storage_client, pointer):
+    """Downloads, decompresses and verifies the payload a pointer refers to."""
+    digest = pointer["sha256"]
+    with _lock:
+        data = _payloads.get(digest)
+        if data is not None:
+            _payloads.move_to_end(digest)
+    if data is None:
+        bucket_name, _, name = pointer["uri"][len("gs://"):].partition("/")
+        data = gzip.decompress(storage_client.bucket(bucket_name).blob(name).download_as_bytes())
+        if hashlib.sha256(data).hexdigest() != digest:
+            raise ValueError(f"Payload {pointer['uri']} does not match its hash.")
+        with _lock:
+            _payloads[digest] = data
+            while len(_payloads) > MAX_CACHED_PAYLOADS:
+                _payloads.popitem(last=False)
+    return data.decode("utf-8") if pointer.get("format") == "text" else json.loads(data)
+
+
+def read_field(storage_client, doc_data, field, default=None):
+    """Returns `field` of a sows document, loading it from the payload store if it was offloaded."""
+    pointer = doc_data.get(pointer_field(field))
+    if pointer:
+        return load_payload(storage_client, pointer)
+    return doc_data.get(field, default)
@@ -0,0 +1,161 @@
+"""
+Status values of a sows document and batched writes to pipeline documents.
+
+A document moves through
+
+    UPLOADED -> PROCESSING_OCR -> TEXT_EXTRACTED -> ANALYZING
+             -> ANALYZED_SUCCESS | ANALYSIS_FAILED -> SOW_GENERATED
+
+with OCR_FAILED as the failure state of the OCR stage. An analysis that runs
+out of time with chunks left stops at ANALYSIS_PARTIAL and is picked up again
+at ANALYZING by a retry or an explicit resume. Re-uploads and the
+dashboard's "regenerate" action (REANALYSIS_IN_PROGRESS) restart a document at
+PROCESSING_OCR. The sync OCR path hands text straight to analysis, so
+ANALYZING may also follow PROCESSING_OCR.
+
+Functions mostly write without reading the document first, so transitions are
+checked where the current status is already known, and an unexpected one is
+logged rather than refused; a retried or manually edited document must still
+be able to make progress.
+
+StageWrites collects every field a stage writes, merges writes to the same
+document and commits them in one WriteBatch. ProgressWriter throttles
+high-frequency progress counters to one write per interval.
+"""
+import threading
+import time
+
+UPLOADED = "UPLOADED"
+PROCESSING_OCR = "PROCESSING_OCR"
+OCR_FAILED = "OCR_FAILED"
+TEXT_EXTRACTED = "TEXT_EXTRACTED"
+ANALYZING = "ANALYZING"
+ANALYZED_SUCCESS = "ANALYZED_SUCCESS"
+ANALYSIS_FAILED = "ANALYSIS_FAILED"
+ANALYSIS_PARTIAL = "ANALYSIS_PARTIAL"
+SOW_GENERATED = "SOW_GENERATED"
+# Written by the frontend.
+REANALYSIS_IN_PROGRESS = "REANALYSIS_IN_PROGRESS"
+
+TRANSITIONS = {
+    None: {UPLOADED, PROCESSING_OCR},
+    UPLOADED: {PROCESSING_OCR, OCR_FAILED},
+    PROCESSING_OCR: {PROCESSING_OCR, TEXT_EXTRACTED, ANALYZING, OCR_FAILED},
+    OCR_FAILED: {PROCESSING_OCR},
+    TEXT_EXTRACTED: {ANALYZING},
+    ANALYZING: {ANALYZED_SUCCESS, ANALYSIS_FAILED, ANALYSIS_PARTIAL},
+    ANALYSIS_FAILED: {ANALYZING},
+    ANALYSIS_PARTIAL: {ANALYZING},
+    ANALYZED_SUCCESS: {ANALYZING, SOW_GENERATED},
+    SOW_GENERATED: {ANALYZING, SOW_GENERATED},
+    REANALYSIS_IN_PROGRESS: {PROCESSING_OCR, TEXT_EXTRACTED, ANALYZING},
+}
+# A new upload of the same file may restart a document from any state.
+RESTART_STATUSES = {PROCESSING_OCR}
+
+# Firestore allows 500 writes per batch.
+MAX_BATCH_WRITES = 500
+DEFAULT_PROGRESS_INTERVAL_SECONDS = 5.0
+
+
+def is_valid_transition(current, new):
+    if new in RESTART_STATUSES:
+        return True
+    return new in TRANSITIONS.get(current, set())
+
+
+def check_transition(doc_id, current, new):
+    """Logs (but allows) a status change outside the defined transitions."""
+    if not is_valid_transition(current, new):
+        print(f"Warning: unexpected status transition for '{doc_id}': {current} -> {new}.")
+
+
+def status_fields(status, **fields):
+    """The fields to write when a document enters `status`."""
+    from google.cloud import firestore
+    if status not in TRANSITIONS:
+        raise ValueError(f"Unknown pipeline status '{status}'.")
+    values = {"status": status, "last_updated_at": firestore.SERVER_TIMESTAMP}
+    values.update(fields)
+    return values
+
+
+def _nest(field_paths):
+    nested = {}
+    for path, value in field_paths.items():
+        target = nested
+        parts = path.split(".")
+        for part in parts[:-1]:
+            target = target.setdefault(part, {})
+        target[parts[-1]] = value
+    return nested
+
+
+class StageWrites:
+    """
+    Accumulates one stage's writes. Keys are Firestore field paths
+    ('status', 'timings.analyze_text', 'processed_files.x'); each path is
+    replaced, everything else on the document is left alone, and documents
+    that do not exist yet are created.
+    """
+
+    def __init__(self, db):
+        self.db = db
+        self._docs = {}
+
+    def set_fields(self, doc_ref, fields):
+        path = doc_ref.path
+        ref, pending = self._docs.get(path, (doc_ref, {}))
+        pending.update(fields)
+        self._docs[path] = (ref, pending)
+
+    def __len__(self):
+        return len(self._docs)
+
+    def commit(self):
+        """Commits everything collected so far as one batch (or as few as the write limit allows)."""
+        docs = list(self._docs.values())
+        self._docs = {}
+        for start in range(0, len(docs), MAX_BATCH_WRITES):
+            batch = self.db.batch()
+            for ref, fields in docs[start:start + MAX_BATCH_WRITES]:
+                batch.set(ref, _nest(fields), merge=list(fields))
+            batch.commit()
+
+
+class ProgressWriter:
+    """
+    Writes progress fields to a document at most once per `interval_seconds`.
+    Thread-safe; the newest values win, and `flush` writes anything still
+    pending.
+    """
+
+    def __init__(self, doc_ref, interval_seconds=DEFAULT_PROGRESS_INTERVAL_SECONDS):
+        self.doc_ref = doc_ref
+        self.interval_seconds = interval_seconds
+        self._lock = threading.Lock()
+        self._pending = {}
+        self._last_write = 0.0
+
+    def report(self, **fields):
+        with self._lock:
+            self._pending.update(fields)
+            if time.monotonic() - self._last_write < self.interval_seconds:
+                return
+            self._write_locked()
+
+    def flush(self):
+        with self._lock:
+            if self._pending:
+                self._write_locked()
+
+    def _write_locked(self):
+        from google.cloud import firestore
+        fields, self._pending = self._pending, {}
+        fields["last_updated_at"] = firestore.SERVER_TIMESTAMP
+        self._last_write = time.monotonic()
+        try:
+            self.doc_ref.set(_nest(fields), merge=list(fields))
+        except Exception as e:
+            # Progress is informational; never fail the stage over it.
+            print(f"Warning: could not write progress: {e}")
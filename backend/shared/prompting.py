@@ -0,0 +1,42 @@
+"""
+Single-pass prompt rendering.
+
+Prompt documents use {name} placeholders. Chained str.replace calls scan the
+whole (possibly very large) prompt once per placeholder. render_prompt
+compiles one regular expression per placeholder set and fills every
+placeholder in a single scan; values are inserted verbatim and unknown
+{braces} are left alone. A value that should have its own placeholders filled
+(a SOW template using '{project_name_placeholder}') is rendered before it is
+passed in.
+
+split_prompt cuts a prompt into the part that stays the same between calls
+(instructions, a SOW template) and the part that changes, so the stable
+prefix can be served from a context cache (see shared/context_cache.py).
+"""
+import re
+from functools import lru_cache
+
+
+@lru_cache(maxsize=64)
+def _placeholder_pattern(names):
+    return re.compile("|".join(re.escape("{" + name + "}") for name in names))
+
+
+def render_prompt(template, values):
+    if not values:
+        return template
+    pattern = _placeholder_pattern(tuple(sorted(values, key=len, reverse=True)))
+    return pattern.sub(lambda match: str(values[match.group(0)[1:-1]]), template)
+
+
+def split_prompt(template, stable_values, variable_names):
+    """
+    Returns (prefix, rest): `template` up to the first placeholder named in
+    `variable_names`, rendered with `stable_values`, and the remaining
+    template, still to be rendered per call. For any values,
+    prefix + render_prompt(rest, values) == render_prompt(template, values)
+    as long as `values` agrees with `stable_values`.
+    """
+    positions = [template.find("{" + name + "}") for name in variable_names]
+    cut = min([position for position in positions if position != -1], default=len(template))
+    return render_prompt(template[:cut], stable_values), template[cut:]
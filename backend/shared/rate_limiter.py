@@ -0,0 +1,366 @@
+"""
+Scheduler for Vertex AI generate_content calls.
+
+Every Gemini request in the backend goes through VertexScheduler.generate(),
+which holds it until the model's budget allows it and retries it when Vertex
+AI sheds load:
+
+  - A per-instance token bucket for each model paces requests. Callers
+    waiting at INTERACTIVE priority (generate_sow, generate_template, where a
+    user is waiting) are always served before BACKGROUND ones (bill analysis
+    and its summaries).
+  - Tokens are also drawn, a block at a time, from a per-minute budget shared
+    by every instance: vertex_quota/{model}-{minute}-{shard} in Firestore.
+    The minute's budget is split across a few shard documents, and blocks
+    grow with the budget, so no single document sees more than a few
+    transactions a second under fan-out. BACKGROUND callers may only use
+    part of each minute's budget, so a burst of bills being analyzed cannot
+    starve the SOW editor.
+  - A 429 or 503 halves the bucket's rate, pauses it for the retry delay and
+    marks the shared window as throttled so the other instances back off as
+    well. Each success gives back a small share of the configured rate
+    (additive increase, multiplicative decrease), so throughput climbs back
+    to the quota instead of oscillating around it.
+
+A caller with its own time budget passes a deadline, which caps how long a
+request may wait for capacity; the RateLimitTimeout raised when the deadline
+is what stopped the wait has deadline_reached set.
+
+Schedulers live for as long as the instance stays warm, so the learned rate
+carries over between invocations. Failures of the shared budget are logged
+and ignored; the local bucket still paces the instance.
+"""
+import random
+import re
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+
+QUOTA_COLLECTION = "vertex_quota"
+QUOTA_WINDOW_SECONDS = 60
+QUOTA_RETENTION = timedelta(days=1)
+
+INTERACTIVE = 0
+BACKGROUND = 1
+
+DEFAULT_REQUESTS_PER_MINUTE = 300
+DEFAULT_BURST = 5
+DEFAULT_BLOCK_SIZE = 5
+DEFAULT_QUOTA_SHARDS = 4
+# Blocks are at least this share of the per-minute budget, which keeps the
+# transactions per minute bounded however large the budget is.
+MIN_BLOCK_FRACTION = 0.01
+DEFAULT_INTERACTIVE_RESERVE = 0.2
+DEFAULT_MAX_WAIT_SECONDS = 240
+# The adaptive rate never drops below this share of the configured rate.
+MIN_RATE_FRACTION = 0.05
+# Share of the configured rate restored by each successful request.
+RECOVERY_FRACTION = 0.05
+
+_schedulers_lock = threading.Lock()
+_schedulers = {}
+
+
+class RateLimitTimeout(Exception):
+    """Raised when a request could not get a token within the maximum wait."""
+
+    # True when the caller's deadline, not the maximum wait, ended the wait.
+    deadline_reached = False
+
+
+def retryable_errors():
+    """Errors that mean Vertex AI is shedding load rather than rejecting the prompt."""
+    from google.api_core import exceptions
+    return (exceptions.ResourceExhausted, exceptions.TooManyRequests, exceptions.ServiceUnavailable)
+
+
+class AdaptiveTokenBucket:
+    """
+    Token bucket whose refill rate adapts to 429s. Waiters are served in
+    priority order: a caller only takes a token when no caller of a more
+    urgent priority is waiting.
+    """
+
+    def __init__(self, requests_per_minute, burst=DEFAULT_BURST):
+        self.max_rate = max(requests_per_minute, 1) / 60.0
+        self.min_rate = self.max_rate * MIN_RATE_FRACTION
+        self.rate = self.max_rate
+        self.burst = max(1, burst)
+        self._tokens = float(self.burst)
+        self._updated_at = time.monotonic()
+        self._paused_until = 0.0
+        self._waiting = {INTERACTIVE: 0, BACKGROUND: 0}
+        self._cond = threading.Condition()
+
+    def _refill(self, now):
+        if now > self._paused_until:
+            start = max(self._updated_at, self._paused_until)
+            self._tokens = min(self.burst, self._tokens + (now - start) * self.rate)
+        self._updated_at = now
+
+    def acquire(self, priority, timeout):
+        """Takes one token, waiting at most `timeout` seconds. Returns the seconds waited."""
+        start = time.monotonic()
+        deadline = start + timeout
+        with self._cond:
+            self._waiting[priority] += 1
+            try:
+                while True:
+                    now = time.monotonic()
+                    self._refill(now)
+                    ahead = any(count for level, count in self._waiting.items() if level < priority)
+                    if not ahead and now >= self._paused_until and self._tokens >= 1:
+                        self._tokens -= 1
+                        return now - start
+                    if now >= deadline:
+                        raise RateLimitTimeout(f"No Vertex AI capacity within {timeout:.0f}s.")
+                    if now < self._paused_until:
+                        wait = self._paused_until - now
+                    elif ahead:
+                        wait = 1.0 / self.rate
+                    else:
+                        wait = (1 - self._tokens) / self.rate
+                    self._cond.wait(min(wait, deadline - now))
+            finally:
+                self._waiting[priority] -= 1
+                self._cond.notify_all()
+
+    def throttled(self, pause_seconds):
+        with self._cond:
+            self.rate = max(self.min_rate, self.rate / 2)
+            self._tokens = 0.0
+            self._paused_until = max(self._paused_until, time.monotonic() + pause_seconds)
+
+    def succeeded(self):
+        with self._cond:
+            self.rate = min(self.max_rate, self.rate + self.max_rate * RECOVERY_FRACTION)
+
+
+def _shard_limit(limit, shard, shards):
+    """`limit` split as evenly as possible over `shards` counters."""
+    return limit // shards + (1 if shard < limit % shards else 0)
+
+
+class SharedBudget:
+    """
+    Cross-instance requests-per-minute budget. Each minute's budget is split
+    over `shards` Firestore documents counting the requests granted from
+    them; instances take blocks of tokens in a transaction on a randomly
+    chosen shard, moving on to the next when it is used up, so most requests
+    cost no Firestore round trip and concurrent instances rarely contend for
+    the same document. BACKGROUND blocks are only granted while a shard's
+    usage is below (1 - interactive_reserve) of its share.
+    """
+
+    def __init__(self, db, model_name, requests_per_minute, block_size=DEFAULT_BLOCK_SIZE,
+                 interactive_reserve=DEFAULT_INTERACTIVE_RESERVE, shards=DEFAULT_QUOTA_SHARDS):
+        self.db = db
+        self.model_key = re.sub(r"[^A-Za-z0-9_.-]", "_", model_name)
+        self.limits = {
+            INTERACTIVE: requests_per_minute,
+            BACKGROUND: max(1, int(requests_per_minute * (1 - interactive_reserve))),
+        }
+        # Every shard must be able to grant at least one background request.
+        self.shards = max(1, min(shards, self.limits[BACKGROUND]))
+        self.block_size = max(1, block_size, int(requests_per_minute * MIN_BLOCK_FRACTION))
+        self._pools = {priority: {"window": None, "tokens": 0} for priority in self.limits}
+        self._locks = {priority: threading.Lock() for priority in self.limits}
+
+    def _shard_ref(self, window, shard):
+        return self.db.collection(QUOTA_COLLECTION).document(f"{self.model_key}-{window}-{shard}")
+
+    def _take_block(self, window, priority, shard):
+        """Returns (tokens granted, seconds to wait before asking again)."""
+        from google.cloud import firestore
+
+        ref = self._shard_ref(window, shard)
+        limit = _shard_limit(self.limits[priority], shard, self.shards)
+
+        @firestore.transactional
+        def take(transaction):
+            snapshot = ref.get(transaction=transaction)
+            quota = snapshot.to_dict() if snapshot.exists else {}
+            now = datetime.now(timezone.utc)
+            throttled_until = quota.get("throttled_until")
+            if throttled_until and throttled_until > now:
+                return 0, (throttled_until - now).total_seconds()
+            used = quota.get("used", 0)
+            grant = min(self.block_size, limit - used)
+            if grant <= 0:
+                return 0, (window + 1) * QUOTA_WINDOW_SECONDS - time.time()
+            transaction.set(ref, {
+                "model": self.model_key,
+                "window_start": datetime.fromtimestamp(window * QUOTA_WINDOW_SECONDS, timezone.utc),
+                "used": used + grant,
+                "shard": shard,
+                "limit": _shard_limit(self.limits[INTERACTIVE], shard, self.shards),
+                "expires_at": now + QUOTA_RETENTION,
+            }, merge=True)
+            return grant, 0
+
+        return take(self.db.transaction())
+
+    def acquire(self, priority, deadline):
+        """
+        Takes a token, waiting for the shared budget until `deadline` (a
+        time.monotonic() value). The per-priority lock is held only while a
+        block is taken from Firestore, never while waiting for the next one.
+        """
+        pool = self._pools[priority]
+        lock = self._locks[priority]
+        while True:
+            if not lock.acquire(timeout=max(deadline - time.monotonic(), 0)):
+                raise RateLimitTimeout("The shared Vertex AI budget is exhausted.")
+            try:
+                window = int(time.time() // QUOTA_WINDOW_SECONDS)
+                if pool["window"] == window and pool["tokens"] > 0:
+                    pool["tokens"] -= 1
+                    return
+                granted, waits = 0, []
+                first = random.randrange(self.shards)
+                for k in range(self.shards):
+                    try:
+                        granted, wait = self._take_block(window, priority, (first + k) % self.shards)
+                    except Exception as e:
+                        print(f"Vertex quota: shared budget unavailable, using the local limit only: {e}")
+                        return
+                    if granted:
+                        break
+                    waits.append(wait)
+                if granted:
+                    pool["window"], pool["tokens"] = window, granted - 1
+                    return
+            finally:
+                lock.release()
+            wait = min(waits)
+            if time.monotonic() + wait > deadline:
+                raise RateLimitTimeout("The shared Vertex AI budget is exhausted.")
+            time.sleep(max(wait, 0.05))
+
+    def throttled(self, pause_seconds):
+        """Tells the other instances to hold off for `pause_seconds`."""
+        now = datetime.now(timezone.utc)
+        for priority, pool in self._pools.items():
+            with self._locks[priority]:
+                pool["tokens"] = 0
+        window = int(time.time() // QUOTA_WINDOW_SECONDS)
+        try:
+            batch = self.db.batch()
+            for shard in range(self.shards):
+                batch.set(self._shard_ref(window, shard), {
+                    "model": self.model_key,
+                    "throttled_until": now + timedelta(seconds=pause_seconds),
+                    "expires_at": now + QUOTA_RETENTION,
+                }, merge=True)
+            batch.commit()
+        except Exception as e:
+            print(f"Vertex quota: could not record throttling: {e}")
+
+
+class VertexScheduler:
+    """Paces and retries the Gemini requests for one model."""
+
+    def __init__(self, model_name, bucket, shared=None, max_wait_seconds=DEFAULT_MAX_WAIT_SECONDS):
+        self.model_name = model_name
+        self.bucket = bucket
+        self.shared = shared
+        self.max_wait_seconds = max_wait_seconds
+
+    def acquire(self, priority, deadline=None):
+        """
+        Takes a token, waiting at most max_wait_seconds and never past
+        `deadline` (a time.monotonic() value). Returns the seconds waited.
+        """
+        start = time.monotonic()
+        wait_limit = self.max_wait_seconds
+        if deadline is not None:
+            wait_limit = min(wait_limit, deadline - start)
+        try:
+            if wait_limit <= 0:
+                raise RateLimitTimeout("The caller's deadline has passed.")
+            self.bucket.acquire(priority, wait_limit)
+            if self.shared is not None:
+                self.shared.acquire(priority, start + wait_limit)
+        except RateLimitTimeout as e:
+            e.deadline_reached = wait_limit < self.max_wait_seconds
+            raise
+        return time.monotonic() - start
+
+    def generate(self, call, priority=BACKGROUND, max_retries=5, base_delay=2.0, deadline=None):
+        """
+        Runs `call()` (one generate_content request) once the budget allows,
+        retrying with exponential backoff and jitter when it is rate limited
+        or the service is temporarily unavailable. No attempt waits for
+        capacity past `deadline` (a time.monotonic() value).
+        """
+        errors = retryable_errors()
+        for attempt in range(max_retries + 1):
+            waited = self.acquire(priority, deadline)
+            if waited >= 1:
+                print(f"  -> Waited {waited:.1f}s for Vertex AI capacity ({self.model_name}).")
+            try:
+                response = call()
+            except errors as e:
+                if attempt == max_retries:
+                    raise
+                delay = base_delay * (2 ** attempt) + random.uniform(0, base_delay)
+                print(f"  -> Rate limited ({e.__class__.__name__}), retrying in {delay:.1f}s (attempt {attempt + 1}/{max_retries}).")
+                self.bucket.throttled(delay)
+                if self.shared is not None:
+                    self.shared.throttled(delay)
+                continue
+            self.bucket.succeeded()
+            return response
+
+
+def _requests_per_minute(settings, model_name):
+    value = settings.get("vertex_requests_per_minute", DEFAULT_REQUESTS_PER_MINUTE)
+    if isinstance(value, dict):
+        value = value.get(model_name, value.get("default", DEFAULT_REQUESTS_PER_MINUTE))
+    return int(value)
+
+
+def get_scheduler(model_name, settings, db=None):
+    """
+    Returns the instance's scheduler for `model_name`, configured from the
+    global settings document:
+      vertex_requests_per_minute:  project-wide budget, a number or a
+                                   {model: rpm, 'default': rpm} map (default 300)
+      vertex_burst:                requests an idle instance may send at once (default 5)
+      vertex_quota_backend:        'firestore' (default) shares the budget across
+                                   instances, 'none' paces each instance alone
+      vertex_quota_block_size:     tokens taken from the shared budget at a time (default 5,
+                                   raised to 1% of the budget for large budgets)
+      vertex_quota_shards:         documents each minute's shared budget is split over (default 4)
+      vertex_interactive_reserve:  share of the budget kept for interactive requests (default 0.2)
+      vertex_max_wait_seconds:     longest a request waits for capacity (default 240)
+    A scheduler is rebuilt only when its settings change.
+    """
+    requests_per_minute = _requests_per_minute(settings, model_name)
+    config = (
+        requests_per_minute,
+        int(settings.get("vertex_burst", DEFAULT_BURST)),
+        settings.get("vertex_quota_backend", "firestore"),
+        int(settings.get("vertex_quota_block_size", DEFAULT_BLOCK_SIZE)),
+        float(settings.get("vertex_interactive_reserve", DEFAULT_INTERACTIVE_RESERVE)),
+        float(settings.get("vertex_max_wait_seconds", DEFAULT_MAX_WAIT_SECONDS)),
+        int(settings.get("vertex_quota_shards", DEFAULT_QUOTA_SHARDS)),
+    )
+    with _schedulers_lock:
+        entry = _schedulers.get(model_name)
+        if entry and entry[0] == config:
+            return entry[1]
+        _, burst, backend, block_size, reserve, max_wait, shards = config
+        shared = None
+        if backend == "firestore":
+            if db is None:
+                from shared.runtime import get_firestore_client
+                db = get_firestore_client()
+            shared = SharedBudget(
+                db, model_name, requests_per_minute, block_size=block_size, interactive_reserve=reserve, shards=shards
+            )
+        elif backend != "none":
+            print(f"Vertex quota: unknown backend '{backend}', pacing this instance only.")
+        scheduler = VertexScheduler(model_name, AdaptiveTokenBucket(requests_per_minute, burst), shared, max_wait)
+        _schedulers[model_name] = (config, scheduler)
+        return scheduler
@@ -0,0 +1,138 @@
+"""
+Per-instance runtime shared by all SOW-Forge Cloud Functions.
+
+Google Cloud clients, the Vertex AI SDK and GenerativeModel objects are built
+lazily on first use and then reused for as long as the instance stays warm.
+The global settings document and prompt documents are cached for a short TTL;
+prompts are also dropped as soon as the 'settings_version' field on
+settings/global_config changes (the frontend bumps it on every settings or
+prompt edit).
+
+Client libraries are imported inside the getters so each function only needs
+the dependencies for the clients it actually uses.
+"""
+import copy
+import os
+import threading
+import time
+
+GCP_PROJECT_ID = os.environ.get("GCP_PROJECT_ID", "state-of-texas-sow-demo")
+VERTEX_AI_LOCATION = os.environ.get("VERTEX_AI_LOCATION", "us-central1")
+CONFIG_CACHE_TTL_SECONDS = float(os.environ.get("CONFIG_CACHE_TTL_SECONDS", 60))
+
+_lock = threading.RLock()
+_clients = {}
+_settings_cache = {"value": None, "fetched_at": 0.0}
+_prompt_cache = {}
+
+
+def _get_or_create(key, factory):
+    client = _clients.get(key)
+    if client is None:
+        with _lock:
+            client = _clients.get(key)
+            if client is None:
+                client = factory()
+                _clients[key] = client
+    return client
+
+
+def get_firestore_client():
+    def factory():
+        from google.cloud import firestore
+        return firestore.Client()
+    return _get_or_create("firestore", factory)
+
+
+def get_storage_client():
+    def factory():
+        from google.cloud import storage
+        return storage.Client()
+    return _get_or_create("storage", factory)
+
+
+def get_docai_client(location):
+    """Document AI clients are regional, so one is kept per location."""
+    def factory():
+        from google.cloud import documentai
+        from google.api_core.client_options import ClientOptions
+        opts = ClientOptions(api_endpoint=f"{location}-documentai.googleapis.com")
+        return documentai.DocumentProcessorServiceClient(client_options=opts)
+    return _get_or_create(("docai", location), factory)
+
+
+def get_tasks_client():
+    def factory():
+        from google.cloud import tasks_v2
+        return tasks_v2.CloudTasksClient()
+    return _get_or_create("tasks", factory)
+
+
+def get_docs_service():
+    """
+    Google Docs API service built from the discovery document bundled with
+    google-api-python-client, so building it makes no discovery request.
+    Uses the function's own service account.
+    """
+    def factory():
+        import google.auth
+        from googleapiclient.discovery import build
+        credentials, _ = google.auth.default(scopes=["https://www.googleapis.com/auth/documents"])
+        return build("docs", "v1", credentials=credentials, static_discovery=True, cache_discovery=False)
+    return _get_or_create("docs", factory)
+
+
+def init_vertexai():
+    def factory():
+        import vertexai
+        vertexai.init(project=GCP_PROJECT_ID, location=VERTEX_AI_LOCATION)
+        return True
+    return _get_or_create("vertexai", factory)
+
+
+def get_model(model_name):
+    def factory():
+        from vertexai.generative_models import GenerativeModel
+        init_vertexai()
+        return GenerativeModel(model_name)
+    return _get_or_create(("model", model_name), factory)
+
+
+def get_settings(force_refresh=False):
+    """
+    Returns a copy of settings/global_config, re-reading it from Firestore at
+    most once per CONFIG_CACHE_TTL_SECONDS. The read happens outside the lock,
+    so threads holding a fresh copy are never held up by a refresh.
+    """
+    now = time.monotonic()
+    with _lock:
+        cached = _settings_cache["value"]
+        stale = force_refresh or cached is None or now - _settings_cache["fetched_at"] > CONFIG_CACHE_TTL_SECONDS
+    if stale:
+        settings_doc = get_firestore_client().collection('settings').document('global_config').get()
+        if not settings_doc.exists:
+            raise Exception("Critical Error: Global settings document 'global_config' not found.")
+        cached = settings_doc.to_dict()
+        with _lock:
+            _settings_cache["value"] = cached
+            _settings_cache["fetched_at"] = now
+    return copy.deepcopy(cached)
+
+
+def get_prompt(prompt_id):
+    """
+    Returns a copy of the prompt document as a dict, or None if it does not
+    exist. Cached entries are reused while they are younger than the TTL and
+    the settings version they were read under is still current.
+    """
+    settings_version = get_settings().get("settings_version")
+    now = time.monotonic()
+    with _lock:
+        entry = _prompt_cache.get(prompt_id)
+        if entry and entry["settings_version"] == settings_version and now - entry["fetched_at"] <= CONFIG_CACHE_TTL_SECONDS:
+            return copy.deepcopy(entry["value"])
+    prompt_doc = get_firestore_client().collection('prompts').document(prompt_id).get()
+    value = prompt_doc.to_dict() if prompt_doc.exists else None
+    with _lock:
+        _prompt_cache[prompt_id] = {"value": value, "settings_version": settings_version, "fetched_at": now}
+    return copy.deepcopy(value)
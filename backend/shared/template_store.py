@@ -0,0 +1,43 @@
+"""
+Per-instance cache of SOW template markdown.
+
+Entries are keyed by template id and remember the GCS generation they were
+downloaded at. A lookup sends one conditional download
+(if_generation_not_match): an unchanged template comes back as 304 Not
+Modified without its body, and an edited one is fetched and replaces the
+entry.
+"""
+import threading
+from collections import OrderedDict
+
+MAX_CACHED_TEMPLATES = 32
+
+_lock = threading.Lock()
+_templates = OrderedDict()
+
+
+def get_template_text(storage_client, bucket_name, template_id, gcs_path):
+    """Returns (template text, served_from_cache, GCS generation)."""
+    from google.api_core import exceptions
+
+    with _lock:
+        entry = _templates.get(template_id)
+    blob = storage_client.bucket(bucket_name).blob(gcs_path)
+    if entry and entry["path"] == (bucket_name, gcs_path):
+        try:
+            data = blob.download_as_bytes(if_generation_not_match=entry["generation"])
+        except exceptions.NotModified:
+            with _lock:
+                _templates.move_to_end(template_id)
+            return entry["text"], True, entry["generation"]
+    else:
+        data = blob.download_as_bytes()
+
+    text = data.decode("utf-8")
+    if blob.generation is not None:
+        with _lock:
+            _templates[template_id] = {"path": (bucket_name, gcs_path), "generation": blob.generation, "text": text}
+            _templates.move_to_end(template_id)
+            while len(_templates) > MAX_CACHED_TEMPLATES:
+                _templates.popitem(last=False)
+    return text, False, blob.generation
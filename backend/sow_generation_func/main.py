@@ -1,6 +1,157 @@
 import functions_framework
 import os
+import itertools
 import json
+import re
+import time
+from concurrent.futures import ThreadPoolExecutor
+from flask import Response, stream_with_context
+from shared.instrumentation import StageRecorder, record_usage, resolve_trace_id
+from shared.pipeline_state import SOW_GENERATED, StageWrites, check_transition, status_fields
+from shared.rate_limiter import INTERACTIVE
+
+
+def clean_sow_text(text):
+    """Strips the markdown code fences Gemini likes to wrap the SOW in."""
+    return text.replace("```markdown", "").replace("```", "")
+
+
+# A run of backticks at the end of the text so far, possibly with the start of 'markdown' after it.
+_PARTIAL_FENCE = re.compile(r"`+[a-z]{0,7}$")
+
+
+class StreamedSowCleaner:
+    """
+    Applies clean_sow_text to a SOW as it streams in, so the live preview
+    matches the text that is saved. Leading whitespace is dropped only at
+    the start of the stream, and a trailing backtick run (which may be the
+    first half of a fence) is held back until the next chunk shows whether
+    it is one.
+    """
+
+    def __init__(self):
+        self._pending = ""
+        self._started = False
+
+    def feed(self, text):
+        pending = self._pending + text
+        if not self._started:
+            pending = pending.lstrip()
+            self._started = bool(pending)
+        partial = _PARTIAL_FENCE.search(pending)
+        cut = len(pending)
+        if partial and "markdown".startswith(partial.group(0).lstrip("`")):
+            cut = partial.start()
+        self._pending = pending[cut:]
+        return clean_sow_text(pending[:cut])
+
+    def flush(self):
+        pending, self._pending = self._pending, ""
+        return clean_sow_text(pending)
+
+
+def format_sse(event, payload):
+    """Formats a single server-sent event with a JSON payload."""
+    return f"event: {event}\ndata: {json.dumps(payload)}\n\n"
+
+
+def save_generated_sow(db, sow_doc_ref, generated_sow_text, model_name, prompt_id, temperature, recorder):
+    """
+    Saves the SOW together with this invocation's stage timings in one
+    batched write. A large SOW goes to the payload store and the document
+    keeps a pointer to it; the objects of earlier SOWs are then deleted.
+    """
+    from shared.payload_store import payload_fields, prune_payloads
+    from shared.runtime import get_settings, get_storage_client
+
+    fields = status_fields(
+        SOW_GENERATED,
+        generated_sow_length=len(generated_sow_text),
+        model_used_for_sow=model_name,
+        prompt_used_for_sow=prompt_id,
+        sow_gen_temp_used=float(temperature)
+    )
+    storage_client, settings = get_storage_client(), get_settings()
+    with recorder.stage("gcs.upload_payload"):
+        sow_fields = payload_fields(storage_client, settings, sow_doc_ref.id, "generated_sow", generated_sow_text)
+    fields.update(sow_fields)
+    writes = StageWrites(db)
+    writes.set_fields(sow_doc_ref, fields)
+    recorder.flush(sow_doc_ref, writes)
+    writes.commit()
+    prune_payloads(storage_client, settings, sow_doc_ref.id, "generated_sow", sow_fields)
+    print("Successfully saved generated SOW to Firestore.")
+
+
+def open_stream(model, prompt, generation_config):
+    """
+    Starts a streamed generation and waits for its first chunk, so a rate
+    limit error surfaces here (where the scheduler can retry it) rather than
+    after tokens have been sent to the client.
+    """
+    stream = iter(model.generate_content(prompt, generation_config=generation_config, stream=True))
+    first = next(stream, None)
+    return itertools.chain([first] if first is not None else [], stream)
+
+
+def stream_sow_events(db, model, scheduler, prompt, generation_config, llm_cache, sow_doc_ref, model_name,
+                      prompt_id, temperature, max_output_tokens, recorder, bypass_cache=False):
+    """
+    Yields the SOW as server-sent events while Gemini produces it: one 'token'
+    event per streamed chunk, then a single 'done' event once the full text
+    has been saved to the 'sows' document. Failures are reported as an 'error'
+    event because the 200 status has already been sent. Stage timings are
+    saved here because the generator outlives the request handler.
+    `model` is a PrefixedModel and `prompt` the full prompt, starting with
+    its prefix.
+    """
+    saved = False
+    try:
+        cached_text = llm_cache.lookup(model_name, prompt, temperature, max_output_tokens, bypass=bypass_cache)
+        if cached_text is not None:
+            print("Serving SOW from the LLM response cache.")
+            yield format_sse('token', {'text': clean_sow_text(cached_text.strip())})
+            raw_text = cached_text
+        else:
+            print("Streaming merge prompt response from Vertex AI...")
+            parts = []
+            with recorder.stage("gemini.generate_stream") as span:
+                last_chunk = None
+                cleaner = StreamedSowCleaner()
+                started = time.perf_counter()
+                suffix = prompt[len(model.prefix):]
+                stream = scheduler.generate(lambda: open_stream(model, suffix, generation_config), priority=INTERACTIVE)
+                for chunk in stream:
+                    if last_chunk is None:
+                        span["first_token_ms"] = round((time.perf_counter() - started) * 1000, 1)
+                    last_chunk = chunk
+                    chunk_text = chunk.text
+                    if not chunk_text:
+                        continue
+                    parts.append(chunk_text)
+                    preview_text = cleaner.feed(chunk_text)
+                    if preview_text:
+                        yield format_sse('token', {'text': preview_text})
+                preview_text = cleaner.flush()
+                if preview_text:
+                    yield format_sse('token', {'text': preview_text})
+                # The final streamed chunk carries the token counts for the whole response.
+                record_usage(span, last_chunk)
+            raw_text = "".join(parts)
+            llm_cache.store(model_name, prompt, temperature, max_output_tokens, raw_text)
+
+        generated_sow_text = clean_sow_text(raw_text.strip())
+        save_generated_sow(db, sow_doc_ref, generated_sow_text, model_name, prompt_id, temperature, recorder)
+        saved = True
+        yield format_sse('done', {'length': len(generated_sow_text)})
+    except Exception as e:
+        print(f"!!! CRITICAL ERROR during streamed SOW generation: {e}")
+        yield format_sse('error', {'message': str(e)})
+    finally:
+        # A saved SOW already carries the timings.
+        if not saved:
+            recorder.flush(sow_doc_ref)
+
 
 @functions_framework.http
 def generate_sow(request):
@@ -8,26 +159,75 @@ def generate_sow(request):
     An HTTP-triggered function to generate a draft SOW.
     It dynamically fetches all its configuration (model, tuning parameters,
     prompts, and content formats) from Firestore before execution.
+    Send {"stream": true} (or ?stream=1) to receive the SOW as server-sent
+    events while it is being generated instead of one text/plain body, or
+    {"async": true} to get a job id back at once and poll jobs/{jobId}.
+    """
+    from shared.jobs import handle_job_request, response_result
+
+    request_json = request.get_json(silent=True) or {}
+    if request_json.get('async') or request_json.get('runJob'):
+        def run(payload, report):
+            sow_text = response_result(generate_sow_response(payload, report=report))
+            return {'docId': payload.get('docId'), 'length': len(sow_text)}
+        return handle_job_request('generate_sow', request_json, run)
+
+    stream = bool(request_json.get('stream', False)) or request.args.get('stream') == '1'
+    return generate_sow_response(request_json, stream=stream)
+
+
+def generate_sow_response(request_json, stream=False, report=None):
+    """
+    Generates the SOW for one request body and returns the HTTP response
+    (or the server-sent event stream). `report`, if given, receives
+    progress updates for an async job.
     """
     # --- Import heavy libraries inside the function ---
-    from google.cloud import firestore, storage
-    import vertexai
-    from vertexai.generative_models import GenerativeModel, GenerationConfig
+    from vertexai.generative_models import GenerationConfig
+    from shared.context_cache import ContextCache
+    from shared.llm_cache import build_llm_cache
+    from shared.payload_store import read_field
+    from shared.prompting import render_prompt, split_prompt
+    from shared.rate_limiter import get_scheduler
+    from shared.runtime import get_firestore_client, get_model, get_prompt, get_settings, get_storage_client
+    from shared.template_store import get_template_text
 
     print("SOW Generation function triggered.")
+    recorder = StageRecorder("generate_sow")
+    timings_ref = None
 
     try:
-        # --- 1. Initialize DB client ---
-        db = firestore.Client()
-
-        # --- 2. Fetch Global Settings from Firestore ---
-        settings_ref = db.collection('settings').document('global_config')
-        settings_doc = settings_ref.get()
-        if not settings_doc.exists:
-            raise Exception("Critical Error: Global settings document 'global_config' not found.")
-        
-        settings = settings_doc.to_dict()
+        if not request_json or 'docId' not in request_json or 'templateId' not in request_json:
+            return ("Missing 'docId' or 'templateId' in request body", 400)
         
+        doc_id = request_json['docId']
+        template_id = request_json['templateId']
+        bypass_cache = bool(request_json.get('bypassCache', False))
+        print(f"Processing docId: '{doc_id}', templateId: '{template_id}'")
+        recorder.doc_id = doc_id
+
+        # --- 1. Reuse the clients from the warm instance ---
+        db = get_firestore_client()
+        storage_client = get_storage_client()
+        sow_doc_ref = db.collection('sows').document(doc_id)
+        template_ref = db.collection('templates').document(template_id)
+
+        def load_configuration():
+            # Settings and prompts are cached per instance, so this is usually free.
+            settings = get_settings()
+            prompt_id = settings.get('sow_generation_prompt_id')
+            return settings, (get_prompt(prompt_id) if prompt_id else None)
+
+        # --- 2. Fetch the configuration and both documents concurrently ---
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            configuration = executor.submit(load_configuration)
+            with recorder.stage("firestore.read", documents=2):
+                # get_all does not promise any order.
+                snapshots = {snapshot.reference.path: snapshot for snapshot in db.get_all([sow_doc_ref, template_ref])}
+                sow_doc = snapshots[sow_doc_ref.path]
+                recorder.trace_id = resolve_trace_id(sow_doc.to_dict())
+            settings, prompt_doc = configuration.result()
+
         # Get all configuration from settings, with reasonable fallbacks
         MODEL_NAME = settings.get('sow_generation_model', 'gemini-2.5-pro')
         MODEL_TEMPERATURE = settings.get('sow_generation_model_temperature', 0.4)
@@ -35,63 +235,64 @@ def generate_sow(request):
         PROMPT_ID = settings.get('sow_generation_prompt_id')
         SOW_TITLE_PREFIX = settings.get('sow_title_prefix', 'SOW Draft for')
         AI_REVIEW_TAG = settings.get('ai_review_tag_format', '[DRAFT-AI: {content}]')
+        TEMPLATES_BUCKET_NAME = settings.get('templates_bucket', 'sow-forge-texas-dmv-templates')
 
         if not PROMPT_ID:
             raise Exception("Setting 'sow_generation_prompt_id' not found in Firestore.")
             
         print(f"Using settings - Model: {MODEL_NAME}, Temp: {MODEL_TEMPERATURE}, Prompt ID: {PROMPT_ID}")
 
-        # --- 3. Fetch the AI Prompt Text from Firestore ---
-        prompt_ref = db.collection('prompts').document(PROMPT_ID)
-        prompt_doc = prompt_ref.get()
-        if not prompt_doc.exists:
+        # --- 3. Check the AI Prompt Text ---
+        if not prompt_doc:
             raise Exception(f"Prompt document '{PROMPT_ID}' not found in 'prompts' collection.")
             
-        prompt_template = prompt_doc.to_dict().get('prompt_text')
+        prompt_template = prompt_doc.get('prompt_text')
         if not prompt_template:
             raise Exception(f"Prompt document '{PROMPT_ID}' is missing the 'prompt_text' field.")
 
-        # --- Initialize other clients and get request data ---
-        storage_client = storage.Client()
-        vertexai.init(project="state-of-texas-sow-demo", location="us-central1")
-        model = GenerativeModel(MODEL_NAME)
-        print("Services initialized successfully.")
-
-        request_json = request.get_json(silent=True)
-        if not request_json or 'docId' not in request_json or 'templateId' not in request_json:
-            return ("Missing 'docId' or 'templateId' in request body", 400)
-        
-        doc_id = request_json['docId']
-        template_id = request_json['templateId']
-        print(f"Processing docId: '{doc_id}', templateId: '{template_id}'")
-
-        # --- Fetch all necessary data ---
-        sow_doc_ref = db.collection('sows').document(doc_id)
-        sow_doc = sow_doc_ref.get()
         if not sow_doc.exists:
             return (f"Document with ID {doc_id} not found in 'sows' collection.", 404)
-        analysis_data = sow_doc.to_dict().get('analysis', {})
+        check_transition(doc_id, sow_doc.to_dict().get('status'), SOW_GENERATED)
+        with recorder.stage("gcs.download_payload"):
+            analysis_data = read_field(storage_client, sow_doc.to_dict(), 'analysis', {})
 
-        template_doc = db.collection('templates').document(template_id).get()
+        template_doc = snapshots[template_ref.path]
         if not template_doc.exists:
             return (f"Template with ID {template_id} not found.", 404)
         template_path = template_doc.to_dict().get('gcs_path')
 
-        bucket = storage_client.bucket('sow-forge-texas-dmv-templates')
-        blob = bucket.blob(template_path)
-        template_content = blob.download_as_text()
+        # Unchanged templates are served from the instance cache after a conditional request.
+        with recorder.stage("gcs.download") as span:
+            template_content, cached, template_generation = get_template_text(storage_client, TEMPLATES_BUCKET_NAME, template_id, template_path)
+            span["bytes"] = 0 if cached else len(template_content)
+            span["cached"] = cached
+        model = get_model(MODEL_NAME)
+        scheduler = get_scheduler(MODEL_NAME, settings, db=db)
         print(f"Successfully fetched all required data.")
 
-        # --- 4. Format the fetched prompt template with the data ---
+        # --- 4. Format the fetched prompt template with the data (one pass) ---
+        # Templates may use the prompt's placeholders themselves, so the template is
+        # rendered first and then inserted as it is. Everything before the first
+        # per-document placeholder is the same for every SOW generated against this
+        # template and prompt, and is served from a context cache.
         project_name = f"{SOW_TITLE_PREFIX} {doc_id}"
-        
-        prompt = prompt_template
-        
-        prompt = prompt.replace('{template_content}', template_content)
-        prompt = prompt.replace('{analysis_data_json}', json.dumps(analysis_data, indent=2))
-        prompt = prompt.replace('{original_filename}', f"{doc_id}.pdf")
-        prompt = prompt.replace('{project_name_placeholder}', project_name)
-        prompt = prompt.replace('{ai_review_tag}', AI_REVIEW_TAG)
+        document_values = {
+            'analysis_data_json': json.dumps(analysis_data, indent=2),
+            'original_filename': f"{doc_id}.pdf",
+            'project_name_placeholder': project_name,
+        }
+        stable_values = {'ai_review_tag': AI_REVIEW_TAG}
+        template_text = render_prompt(template_content, dict(stable_values, **document_values))
+        if not any('{' + name + '}' in template_content for name in document_values):
+            stable_values['template_content'] = template_text
+        values = dict(stable_values, template_content=template_text, **document_values)
+        prompt_prefix, prompt_rest = split_prompt(prompt_template, stable_values, set(values) - set(stable_values))
+        prompt_suffix = render_prompt(prompt_rest, values)
+        prompt = prompt_prefix + prompt_suffix
+        sow_model = ContextCache(settings, db=db).prefixed_model(
+            model, MODEL_NAME, prompt_prefix, recorder, PROMPT_ID,
+            prompt_version=prompt_doc.get('version'), template_generation=template_generation
+        )
 
         # --- 5. Call the AI model with the configured parameters ---
         generation_config = GenerationConfig(
@@ -99,27 +300,50 @@ def generate_sow(request):
             max_output_tokens=int(MAX_OUTPUT_TOKENS)
         )
 
+        llm_cache = build_llm_cache(settings, db=db)
+
+        if stream:
+            events = stream_sow_events(
+                db, sow_model, scheduler, prompt, generation_config, llm_cache, sow_doc_ref, MODEL_NAME,
+                PROMPT_ID, MODEL_TEMPERATURE, MAX_OUTPUT_TOKENS, recorder, bypass_cache=bypass_cache
+            )
+            return Response(
+                stream_with_context(events),
+                mimetype='text/event-stream',
+                headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+            )
+
+        timings_ref = sow_doc_ref
+
+        def generate():
+            with recorder.stage("gemini.generate") as span:
+                response = scheduler.generate(
+                    lambda: sow_model.generate_content(prompt_suffix, generation_config=generation_config), priority=INTERACTIVE
+                )
+                record_usage(span, response)
+                return response.text
+
         print(f"Sending merge prompt to Vertex AI...")
-        response = model.generate_content(
-            prompt,
-            generation_config=generation_config
+        if report:
+            report(stage='generating')
+        response_text = llm_cache.generate_text(
+            MODEL_NAME, prompt, MODEL_TEMPERATURE, MAX_OUTPUT_TOKENS, generate, bypass=bypass_cache
         )
-        generated_sow_text = response.text.strip().replace("```markdown", "").replace("```", "")
-        print("Received merged SOW from Vertex AI.")
-
-        # --- 6. Save the generated SOW back to Firestore ---
-        sow_doc_ref.update({
-            'generated_sow': generated_sow_text,
-            'status': 'SOW_GENERATED',
-            'model_used_for_sow': MODEL_NAME,
-            'prompt_used_for_sow': PROMPT_ID,
-            'sow_gen_temp_used': float(MODEL_TEMPERATURE)
-        })
-        print("Successfully saved generated SOW to Firestore.")
+        generated_sow_text = clean_sow_text(response_text.strip())
+        print(f"Received merged SOW from Vertex AI. LLM cache stats: {llm_cache.stats()}")
+
+        # --- 6. Save the generated SOW (and the timings) back to Firestore ---
+        save_generated_sow(db, sow_doc_ref, generated_sow_text, MODEL_NAME, PROMPT_ID, MODEL_TEMPERATURE, recorder)
+        timings_ref = None
 
         # 7. Return the generated SOW text as the HTTP response
         return (generated_sow_text, 200, {'Content-Type': 'text/plain; charset=utf-8'})
 
     except Exception as e:
         print(f"!!! CRITICAL ERROR during SOW generation: {e}")
-        return (f"An error occurred: {e}", 500)
\ No newline at end of file
+        return (f"An error occurred: {e}", 500)
+    finally:
+        # Streamed responses save their own timings once the stream ends, and a
+        # saved SOW already carries them.
+        if timings_ref is not None:
+            recorder.flush(timings_ref)
\ No newline at end of file
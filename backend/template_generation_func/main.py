@@ -1,31 +1,114 @@
 import functions_framework
 import os
 import json
-from google.cloud import firestore, storage, documentai
-import vertexai
-from vertexai.generative_models import GenerativeModel, GenerationConfig
-# --- FIX #1: Import the necessary libraries ---
-from google.api_core.client_options import ClientOptions
+from google.cloud import firestore, documentai
+from vertexai.generative_models import GenerationConfig
 import traceback
+from concurrent.futures import ThreadPoolExecutor
+from google.api_core import exceptions
+from shared.chunking import estimate_tokens, fit_to_token_budget
+from shared.instrumentation import StageRecorder, record_usage
+from shared.jobs import handle_job_request, response_result
+from shared.page_index import SOURCE_MD5_KEY
+from shared.rate_limiter import INTERACTIVE, get_scheduler
+from shared.runtime import get_docai_client, get_firestore_client, get_model, get_prompt, get_settings, get_storage_client
+
+def find_extracted_text(file_path, sample_bucket, processed_bucket):
+    """
+    Returns the processed-text object the main pipeline extracted from this
+    very PDF, or None. Names are only candidates (the folder-qualified id and
+    the bare name bulk uploads use); the text is used only if the MD5 hash of
+    its source PDF matches the sample's.
+    """
+    sample_blob = sample_bucket.get_blob(file_path)
+    if sample_blob is None or not sample_blob.md5_hash:
+        return None
+    base = os.path.splitext(file_path)[0]
+    for doc_id in dict.fromkeys([base, os.path.basename(base)]):
+        text_blob = processed_bucket.get_blob(f"{doc_id}.txt")
+        if text_blob is not None and (text_blob.metadata or {}).get(SOURCE_MD5_KEY) == sample_blob.md5_hash:
+            return text_blob
+    return None
+
+
+def extract_sample_text(file_path, sample_bucket, processed_bucket, docai_client, processor_path, max_tokens, recorder):
+    """
+    Returns the text of one sample, trimmed to `max_tokens`. Text the main
+    pipeline already extracted from the same PDF is reused; otherwise the
+    PDF goes through synchronous Document AI.
+    """
+    if file_path.lower().endswith('.pdf'):
+        text_blob = None
+        try:
+            with recorder.stage("gcs.metadata", sample=file_path):
+                text_blob = find_extracted_text(file_path, sample_bucket, processed_bucket)
+            if text_blob is not None:
+                with recorder.stage("gcs.download", sample=file_path) as span:
+                    # Pinned to the generation whose metadata matched.
+                    file_content = text_blob.download_as_text(if_generation_match=text_blob.generation)
+                    span["bytes"] = len(file_content)
+                print(f"  -> {file_path}: reused extracted text from '{text_blob.name}'.")
+        except (exceptions.NotFound, exceptions.PreconditionFailed):
+            # Replaced or removed while we looked; extract it ourselves.
+            text_blob = None
+        if text_blob is None:
+            gcs_uri = f"gs://{sample_bucket.name}/{file_path}"
+            gcs_document = documentai.GcsDocument(gcs_uri=gcs_uri, mime_type="application/pdf")
+            # Using simple sync processing for template samples
+            docai_request = documentai.ProcessRequest(name=processor_path, gcs_document=gcs_document)
+            with recorder.stage("docai.process", sample=file_path):
+                result = docai_client.process_document(request=docai_request)
+            file_content = result.document.text
+            print(f"  -> {file_path}: extracted text from PDF using Document AI.")
+    else:
+        with recorder.stage("gcs.download", sample=file_path) as span:
+            file_content = sample_bucket.blob(file_path).download_as_text()
+            span["bytes"] = len(file_content)
+        print(f"  -> {file_path}: read text directly.")
+
+    if estimate_tokens(file_content) > max_tokens:
+        file_content = fit_to_token_budget(file_content, max_tokens)
+        print(f"  -> {file_path}: trimmed sample to {len(file_content)} characters to fit the token budget.")
+    return file_content
+
 
 @functions_framework.http
 def generate_template(request):
     """
     A powerful, single HTTP-triggered function that generates a new SOW template.
+    Send {"async": true} to get a job id back at once and poll jobs/{jobId}.
+    """
+    request_json = request.get_json(silent=True) or {}
+    if request_json.get('async') or request_json.get('runJob'):
+        return handle_job_request(
+            'generate_template', request_json,
+            lambda payload, report: response_result(create_template_response(payload, report=report))
+        )
+    return create_template_response(request_json)
+
+
+def create_template_response(request_json, report=None):
+    """
+    Generates and saves a template for one request body and returns the
+    HTTP response. `report`, if given, receives progress updates for an
+    async job.
     """
     print("Template Generation v2 function triggered.")
     
-    db = firestore.Client()
-    storage_client = storage.Client()
+    db = get_firestore_client()
+    storage_client = get_storage_client()
+    recorder = StageRecorder("generate_template")
     
     try:
-        # --- Fetch Global Settings for AI configuration ---
-        settings_ref = db.collection('settings').document('global_config')
-        settings = settings_ref.get().to_dict()
+        # --- Fetch Global Settings for AI configuration (cached per instance) ---
+        settings = get_settings()
         
         MODEL_NAME = settings.get('sow_generation_model', 'text-bison@002')
         MODEL_TEMPERATURE = settings.get('sow_generation_model_temperature', 0.4)
         MAX_OUTPUT_TOKENS = int(settings.get('sow_generation_max_tokens', 4096))
+        SAMPLES_MAX_TOKENS = int(settings.get('template_samples_max_tokens', 400000))
+        SAMPLE_MAX_CONCURRENCY = int(settings.get('template_sample_max_concurrency', 4))
+        PROCESSED_TEXT_BUCKET_NAME = settings.get('processed_text_bucket', 'sow-forge-texas-dmv-processed-text')
         
         GCP_PROJECT_NUMBER = settings.get("gcp_project_number")
         DOCAI_PROCESSOR_ID = settings.get("docai_processor_id")
@@ -34,20 +117,16 @@ def generate_template(request):
         if not all([GCP_PROJECT_NUMBER, DOCAI_PROCESSOR_ID, DOCAI_LOCATION]):
             raise Exception("Required Document AI settings are missing from Firestore.")
 
-        # --- Initialize AI clients ---
-        vertexai.init(project="state-of-texas-sow-demo", location="us-central1")
-        model = GenerativeModel(MODEL_NAME)
+        # --- Reuse AI clients from the warm instance ---
+        model = get_model(MODEL_NAME)
+        scheduler = get_scheduler(MODEL_NAME, settings, db=db)
         generation_config = GenerationConfig(temperature=float(MODEL_TEMPERATURE), max_output_tokens=MAX_OUTPUT_TOKENS)
-        
-        # --- FIX #2: Correctly initialize the Document AI client ---
-        opts = ClientOptions(api_endpoint=f"{DOCAI_LOCATION}-documentai.googleapis.com")
-        docai_client = documentai.DocumentProcessorServiceClient(client_options=opts)
+        docai_client = get_docai_client(DOCAI_LOCATION)
         PROCESSOR_PATH = f"projects/{GCP_PROJECT_NUMBER}/locations/{DOCAI_LOCATION}/processors/{DOCAI_PROCESSOR_ID}"
 
         print(f"Using Model: {MODEL_NAME}, Temp: {MODEL_TEMPERATURE}")
 
         # --- Get inputs from the HTTP request ---
-        request_json = request.get_json(silent=True)
         sample_files = request_json.get('sample_files', [])
         template_name = request_json.get('template_name')
         template_desc = request_json.get('template_description', '')
@@ -56,44 +135,51 @@ def generate_template(request):
             return ("Missing 'sample_files' or 'template_name' in request body", 400)
         
         print(f"Generating new template '{template_name}' from {len(sample_files)} samples.")
+        if report:
+            report(stage='extracting_samples', samples_total=len(sample_files))
 
         # --- Extract text from all sample files ---
-        concatenated_text = ""
+        # Samples are extracted concurrently. Each gets an equal share of the
+        # token budget so long samples are trimmed at a section or paragraph
+        # boundary instead of overflowing the context.
+        per_sample_max_tokens = max(1, SAMPLES_MAX_TOKENS // len(sample_files))
         sample_bucket = storage_client.bucket('sow-forge-texas-dmv-template-samples')
-        
-        for file_path in sample_files:
-            print(f"Processing sample: {file_path}")
-            blob = sample_bucket.blob(file_path)
-            
-            if file_path.lower().endswith('.pdf'):
-                gcs_uri = f"gs://{sample_bucket.name}/{file_path}"
-                gcs_document = documentai.GcsDocument(gcs_uri=gcs_uri, mime_type="application/pdf")
-                # Using simple sync processing for template samples
-                docai_request = documentai.ProcessRequest(name=PROCESSOR_PATH, gcs_document=gcs_document)
-                result = docai_client.process_document(request=docai_request)
-                file_content = result.document.text
-                print(f"  -> Extracted text from PDF using Document AI.")
-            else:
-                file_content = blob.download_as_text()
-                print(f"  -> Read text directly.")
-            
-            concatenated_text += f"\n\n--- SAMPLE DOCUMENT: {file_path} ---\n{file_content}"
+        processed_bucket = storage_client.bucket(PROCESSED_TEXT_BUCKET_NAME)
+
+        with ThreadPoolExecutor(max_workers=max(1, min(SAMPLE_MAX_CONCURRENCY, len(sample_files)))) as executor:
+            sample_texts = list(executor.map(
+                lambda file_path: extract_sample_text(
+                    file_path, sample_bucket, processed_bucket, docai_client, PROCESSOR_PATH, per_sample_max_tokens, recorder
+                ),
+                sample_files,
+            ))
+
+        # Joined once, in the order the samples were requested.
+        concatenated_text = "".join(
+            f"\n\n--- SAMPLE DOCUMENT: {file_path} ---\n{file_content}"
+            for file_path, file_content in zip(sample_files, sample_texts)
+        )
         
         print(f"Extracted a total of {len(concatenated_text)} characters.")
 
         # --- Fetch the template generation prompt from Firestore ---
         # NOTE: You must create this 'template_generation_default' document in your 'prompts' collection.
-        prompt_ref = db.collection('prompts').document('template_generation_default')
-        prompt_doc = prompt_ref.get()
-        if not prompt_doc.exists:
+        prompt_doc = get_prompt('template_generation_default')
+        if not prompt_doc:
             raise Exception("Prompt 'template_generation_default' not found in Firestore.")
 
-        prompt_template = prompt_doc.to_dict().get('prompt_text')
+        prompt_template = prompt_doc.get('prompt_text')
         prompt = prompt_template.format(concatenated_text=concatenated_text)
 
         # --- Call the AI model ---
         print("Sending template generation prompt to Vertex AI...")
-        response = model.generate_content(prompt, generation_config=generation_config)
+        if report:
+            report(stage='generating')
+        with recorder.stage("gemini.generate") as span:
+            response = scheduler.generate(
+                lambda: model.generate_content(prompt, generation_config=generation_config), priority=INTERACTIVE
+            )
+            record_usage(span, response)
         generated_template_text = response.text.strip().replace("```markdown", "").replace("```", "")
         print("Received generated template from Vertex AI.")
 
@@ -103,10 +189,11 @@ def generate_template(request):
 
         template_bucket = storage_client.bucket('sow-forge-texas-dmv-templates')
         template_blob = template_bucket.blob(template_gcs_path)
-        template_blob.upload_from_string(generated_template_text)
+        with recorder.stage("gcs.upload", bytes=len(generated_template_text.encode("utf-8"))):
+            template_blob.upload_from_string(generated_template_text)
 
         template_ref = db.collection('templates').document(template_id)
-        template_ref.set({'name': template_name, 'description': template_desc, 'gcs_path': template_gcs_path, 'created_at': firestore.SERVER_TIMESTAMP, 'source_samples': sample_files})
+        template_ref.set({'name': template_name, 'description': template_desc, 'gcs_path': template_gcs_path, 'created_at': firestore.SERVER_TIMESTAMP, 'source_samples': sample_files, 'timings': recorder.summary()})
         
         print(f"SUCCESS: Saved new template to Firestore with ID: {template_id}")
 
@@ -116,4 +203,6 @@ def generate_template(request):
         # --- FIX #3: The traceback logging will now work correctly ---
         tb_str = traceback.format_exc()
         print(f"!!! CRITICAL ERROR during template generation: {e}\n--- TRACEBACK ---\n{tb_str}")
-        return (f"An error occurred: {e}", 500)
\ No newline at end of file
+        return (f"An error occurred: {e}", 500)
+    finally:
+        recorder.flush(None)
\ No newline at end of file
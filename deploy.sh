@@ -56,6 +56,10 @@ for func_name in "${FUNCTIONS_TO_DEPLOY[@]}"; do
         # Create the zip archive in the temp directory of the project root
         echo "   - Zipping source files..."
         zip -r "$START_DIR/function.zip" . > /dev/null # Redirects verbose zip output
+
+        # Bundle the shared modules so the function can 'from shared import ...'
+        echo "   - Adding shared modules..."
+        (cd "$START_DIR/backend" && zip -r "$START_DIR/function.zip" shared -x "*/__pycache__/*" > /dev/null)
         
         # Navigate back to the start
         cd "$START_DIR"
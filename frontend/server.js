@@ -1,5 +1,7 @@
 const express = require('express');
 const path = require('path');
+const crypto = require('crypto');
+const zlib = require('zlib');
 const cors = require('cors');
 const { Storage } = require('@google-cloud/storage');
 const { Firestore, FieldValue } = require('@google-cloud/firestore');
@@ -23,6 +25,45 @@ app.use(express.json());
 // The folder name is based on the "name" in your package.json
 app.use(express.static(path.join(__dirname, 'dist/sow-forge-app/browser')));
 
+// --- PAYLOAD STORE ---
+// Large 'analysis' and 'generated_sow' fields live in the payloads bucket as
+// gzip-compressed JSON/markdown named after their SHA-256, with a
+// '{field}_payload' pointer on the sows document (see backend/shared/payload_store.py).
+const PAYLOAD_BUCKET = 'sow-forge-texas-dmv-payloads';
+const PAYLOAD_INLINE_MAX_BYTES = 16 * 1024;
+const PAYLOAD_FIELDS = ['analysis', 'generated_sow'];
+
+async function loadPayload(pointer) {
+  const uri = pointer.uri.slice('gs://'.length);
+  const slash = uri.indexOf('/');
+  const [compressed] = await storage.bucket(uri.slice(0, slash)).file(uri.slice(slash + 1)).download();
+  const data = zlib.gunzipSync(compressed);
+  if (crypto.createHash('sha256').update(data).digest('hex') !== pointer.sha256) {
+    throw new Error(`Payload ${pointer.uri} does not match its hash.`);
+  }
+  return pointer.format === 'text' ? data.toString('utf8') : JSON.parse(data.toString('utf8'));
+}
+
+// Returns the sows fields that store a markdown `value` as `field`, the same way the functions do.
+async function payloadFields(docId, field, value) {
+  const data = Buffer.from(value, 'utf8');
+  if (data.length <= PAYLOAD_INLINE_MAX_BYTES) {
+    return { [field]: value, [`${field}_payload`]: FieldValue.delete() };
+  }
+  const digest = crypto.createHash('sha256').update(data).digest('hex');
+  const name = `sows/${docId}/${field}/${digest}.md.gz`;
+  const compressed = zlib.gzipSync(data, { level: 6 });
+  try {
+    await storage.bucket(PAYLOAD_BUCKET).file(name).save(compressed, {
+      contentType: 'application/gzip', resumable: false, preconditionOpts: { ifGenerationMatch: 0 },
+    });
+  } catch (error) {
+    if (error.code !== 412) throw error; // Same name, same content.
+  }
+  const pointer = { uri: `gs://${PAYLOAD_BUCKET}/${name}`, sha256: digest, format: 'text', bytes: data.length, stored_bytes: compressed.length };
+  return { [field]: FieldValue.delete(), [`${field}_payload`]: pointer };
+}
+
 // --- CORE API ROUTES ---
 
 app.post('/api/generate-upload-url', async (req, res) => {
@@ -44,21 +85,47 @@ app.post('/api/generate-upload-url', async (req, res) => {
   }
 });
 
-// Endpoint for the Document Dashboard
+// Endpoint for the Document Dashboard. Paginated, and reads only the summary
+// fields, so a page costs the same however large the analyses and SOWs grow.
+const DEFAULT_PAGE_SIZE = 50;
+const MAX_PAGE_SIZE = 200;
+const LISTING_FIELDS = [
+  'status', 'original_filename', 'display_name', 'created_at', 'last_updated_at', 'timings',
+  'is_template_sample', 'requirement_count', 'generated_sow_length', 'analyzed_at', 'model_used_for_sow',
+];
 app.get('/api/sows', async (req, res) => {
   try {
-    const snapshot = await firestore.collection('sows').orderBy('created_at', 'desc').get();
-    if (snapshot.empty) return res.status(200).send([]);
-    
-    const allSows = snapshot.docs.map(doc => {
+    const pageSize = Math.min(parseInt(req.query.pageSize, 10) || DEFAULT_PAGE_SIZE, MAX_PAGE_SIZE);
+    // Template samples are filtered in the query, so every page is full. Uploads always
+    // write is_template_sample (see backend/doc_preprocess_trigger/main.py).
+    let query = firestore.collection('sows')
+      .where('is_template_sample', '==', false)
+      .orderBy('created_at', 'desc')
+      .select(...LISTING_FIELDS);
+    if (req.query.pageToken) {
+      const cursor = await firestore.collection('sows').doc(req.query.pageToken).get();
+      if (!cursor.exists) return res.status(400).send({ message: 'Invalid page token.' });
+      query = query.startAfter(cursor);
+    }
+    // One extra document tells whether there is a next page.
+    const snapshot = await query.limit(pageSize + 1).get();
+    const docs = snapshot.docs.slice(0, pageSize);
+    const nextPageToken = snapshot.docs.length > pageSize ? docs[docs.length - 1].id : null;
+
+    const items = docs.map(doc => {
         const data = doc.data();
         if (data.created_at && data.created_at.toDate) data.created_at = data.created_at.toDate().toISOString();
         if (data.last_updated_at && data.last_updated_at.toDate) data.last_updated_at = data.last_updated_at.toDate().toISOString();
-        return { id: doc.id, ...data };
+        if (data.analyzed_at && data.analyzed_at.toDate) data.analyzed_at = data.analyzed_at.toDate().toISOString();
+        return {
+          id: doc.id,
+          ...data,
+          // Documents analyzed before the summary fields existed only have their status to go by.
+          has_analysis: data.requirement_count !== undefined || ['ANALYZED_SUCCESS', 'SOW_GENERATED'].includes(data.status),
+          has_generated_sow: data.generated_sow_length !== undefined || data.status === 'SOW_GENERATED',
+        };
     });
-
-    const filteredSows = allSows.filter(sow => sow.is_template_sample !== true);
-    res.status(200).send(filteredSows);
+    res.status(200).send({ items, nextPageToken });
   } catch (error) {
     console.error('!!! Error fetching SOW documents:', error.message);
     res.status(500).send({ message: 'Could not fetch SOW documents.' });
@@ -71,18 +138,82 @@ app.get('/api/results/:docId', async (req, res) => {
     const docRef = firestore.collection('sows').doc(req.params.docId);
     const doc = await docRef.get();
     if (!doc.exists) return res.status(404).send({ message: 'Document not found' });
-    res.status(200).send(doc.data());
+    const data = doc.data();
+    for (const field of PAYLOAD_FIELDS) {
+      const pointer = data[`${field}_payload`];
+      if (pointer) {
+        data[field] = await loadPayload(pointer);
+        delete data[`${field}_payload`];
+      }
+    }
+    res.status(200).send(data);
   } catch (error) {
     console.error('!!! Error fetching Firestore document:', error.message);
     res.status(500).send({ message: 'Could not fetch document.' });
   }
 });
 
+// Text of a page range of a document, read with a ranged download using the
+// page index OCR writes next to the text ({docId}.pages.json).
+const MAX_PAGES_PER_REQUEST = 50;
+app.get('/api/documents/:docId/pages', async (req, res) => {
+  try {
+    const bucket = storage.bucket('sow-forge-texas-dmv-processed-text');
+    let index;
+    try {
+      const [contents] = await bucket.file(`${req.params.docId}.pages.json`).download();
+      index = JSON.parse(contents.toString('utf8'));
+    } catch (error) {
+      if (error.code === 404) return res.status(404).send({ message: 'No page index for this document.' });
+      throw error;
+    }
+    const pageCount = index.pages.length;
+    const from = parseInt(req.query.from, 10) || 1;
+    const to = Math.min(parseInt(req.query.to, 10) || from, pageCount);
+    if (from < 1 || from > to) {
+      return res.status(400).send({ message: `Pages must be within 1-${pageCount}.` });
+    }
+    if (to - from + 1 > MAX_PAGES_PER_REQUEST) {
+      return res.status(400).send({ message: `At most ${MAX_PAGES_PER_REQUEST} pages can be fetched at once.` });
+    }
+    const first = index.pages[from - 1];
+    const last = index.pages[to - 1];
+    let text = '';
+    if (last.byte_end > first.byte_start) {
+      // Range ends are inclusive.
+      const [contents] = await bucket.file(`${req.params.docId}.txt`).download({ start: first.byte_start, end: last.byte_end - 1 });
+      text = contents.toString('utf8');
+    }
+    const sections = (index.sections || []).filter(section => section.page >= from && section.page <= to);
+    res.status(200).send({ docId: req.params.docId, from, to, pageCount, text, sections });
+  } catch (error) {
+    console.error('!!! Error fetching document pages:', error.message);
+    res.status(500).send({ message: 'Could not fetch document pages.' });
+  }
+});
+
+// Async job status for generate-sow / generate-template requests sent with { async: true }.
+app.get('/api/jobs/:jobId', async (req, res) => {
+  try {
+    const doc = await firestore.collection('jobs').doc(req.params.jobId).get();
+    if (!doc.exists) return res.status(404).send({ message: 'Job not found' });
+    const { kind, state, progress, result, error } = doc.data();
+    res.status(200).send({ id: doc.id, kind, state, progress, result, error });
+  } catch (error) {
+    console.error('!!! Error fetching job:', error.message);
+    res.status(500).send({ message: 'Could not fetch job.' });
+  }
+});
+
 // Generic endpoint to update a SOW document
 app.put('/api/sows/:docId', async (req, res) => {
     try {
         const docRef = firestore.collection('sows').doc(req.params.docId);
         const updateData = { ...req.body, last_updated_at: FieldValue.serverTimestamp() };
+        if (typeof updateData.generated_sow === 'string') {
+          Object.assign(updateData, await payloadFields(req.params.docId, 'generated_sow', updateData.generated_sow));
+          updateData.generated_sow_length = req.body.generated_sow.length;
+        }
         await docRef.update(updateData);
         res.status(200).send({ message: 'Document updated successfully.' });
     } catch (error) {
@@ -112,6 +243,39 @@ app.post('/api/regenerate/:docId', async (req, res) => {
   }
 });
 
+// Endpoint to continue an interrupted analysis from its checkpointed chunks.
+// Rewriting the extracted text fires analyze_text again; 'resume_run_id' makes
+// it reuse the chunk results of the run it continues.
+app.post('/api/resume-analysis/:docId', async (req, res) => {
+  try {
+    const docRef = firestore.collection('sows').doc(req.params.docId);
+    const doc = await docRef.get();
+    if (!doc.exists) return res.status(404).send({ message: 'Document not found' });
+    const { status, analysis_run_id, last_updated_at } = doc.data();
+    if (!['ANALYSIS_PARTIAL', 'ANALYSIS_FAILED', 'ANALYZING'].includes(status)) {
+      return res.status(409).send({ message: `Nothing to resume; the document is ${status}.` });
+    }
+    // A run that is still writing progress is not interrupted.
+    const idleMs = last_updated_at ? Date.now() - last_updated_at.toMillis() : Infinity;
+    if (status === 'ANALYZING' && idleMs < 10 * 60 * 1000) {
+      return res.status(409).send({ message: 'Analysis is still running.' });
+    }
+    const file = storage.bucket('sow-forge-texas-dmv-processed-text').file(`${req.params.docId}.txt`);
+    const [exists] = await file.exists();
+    if (!exists) return res.status(404).send({ message: 'Extracted text not found.' });
+
+    const [metadata] = await file.getMetadata();
+    await file.copy(file, {
+      contentType: metadata.contentType,
+      metadata: { ...(metadata.metadata || {}), resume_run_id: analysis_run_id || String(metadata.generation), resumed_at: new Date().toISOString() },
+    });
+    res.status(200).send({ message: 'Analysis resumed.' });
+  } catch (error) {
+    console.error('!!! Error resuming analysis:', error.message);
+    res.status(500).send({ message: 'Could not resume analysis.' });
+  }
+});
+
 // --- TEMPLATE MANAGEMENT ENDPOINTS ---
 app.get('/api/templates', async (req, res) => {
   try {
@@ -188,6 +352,26 @@ app.post('/api/generate-sow', async (req, res) => {
   }
 });
 
+// Streams the SOW back as server-sent events while it is being generated.
+app.post('/api/generate-sow-stream', async (req, res) => {
+  try {
+    const { docId, templateId } = req.body;
+    const functionUrl = 'https://sow-generation-func-zaolvsfwta-uc.a.run.app';
+    const client = await auth.getIdTokenClient(functionUrl);
+    const response = await client.request({ url: functionUrl, method: 'POST', data: { docId, templateId, stream: true }, responseType: 'stream' });
+    res.status(response.status);
+    res.setHeader('Content-Type', 'text/event-stream');
+    res.setHeader('Cache-Control', 'no-cache');
+    res.setHeader('X-Accel-Buffering', 'no');
+    res.flushHeaders();
+    response.data.pipe(res);
+  } catch (error) {
+    console.error('!!! Error proxying stream to sow-generation-func:', error.message);
+    if (res.headersSent) return res.end();
+    res.status(500).send({ message: 'Could not proxy to SOW generation function.' });
+  }
+});
+
 app.post('/api/generate-template', async (req, res) => {
   try {
     const functionUrl = 'https://template-generation-func-zaolvsfwta-uc.a.run.app';
@@ -200,6 +384,32 @@ app.post('/api/generate-template', async (req, res) => {
   }
 });
 
+// Exports the SOW to Google Docs, updating the linked document if there is one.
+app.post('/api/create-google-doc', async (req, res) => {
+  try {
+    const functionUrl = 'https://create-google-doc-zaolvsfwta-uc.a.run.app';
+    const client = await auth.getIdTokenClient(functionUrl);
+    const response = await client.request({ url: functionUrl, method: 'POST', data: { docId: req.body.docId } });
+    res.status(response.status).send(response.data);
+  } catch (error) {
+    console.error('!!! Error proxying to create-google-doc:', error.response ? error.response.data : error.message);
+    res.status(500).send({ message: 'Could not proxy to Google Doc export function.' });
+  }
+});
+
+// Starts bulk ingestion of many uploads: { uris: [...] } or { prefix: 'bulk/...' }.
+app.post('/api/bulk-ingest', async (req, res) => {
+  try {
+    const functionUrl = 'https://bulk-ingest-zaolvsfwta-uc.a.run.app';
+    const client = await auth.getIdTokenClient(functionUrl);
+    const response = await client.request({ url: functionUrl, method: 'POST', data: req.body });
+    res.status(response.status).send(response.data);
+  } catch (error) {
+    console.error('!!! Error proxying to bulk-ingest:', error.response ? error.response.data : error.message);
+    res.status(500).send({ message: 'Could not proxy to bulk ingestion function.' });
+  }
+});
+
 // --- SETTINGS AND PROMPTS API ENDPOINTS ---
 app.get('/api/settings', async (req, res) => {
   try {
@@ -216,7 +426,8 @@ app.get('/api/settings', async (req, res) => {
 app.put('/api/settings', async (req, res) => {
   try {
     const docRef = firestore.collection('settings').doc('global_config');
-    await docRef.set(req.body, { merge: true });
+    // Bumping the version tells warm Cloud Function instances to drop cached settings and prompts.
+    await docRef.set({ ...req.body, settings_version: FieldValue.increment(1) }, { merge: true });
     res.status(200).send({ message: 'Settings updated successfully.' });
   } catch (error) {
     console.error('!!! Error updating settings:', error.message);
@@ -253,7 +464,9 @@ app.put('/api/prompts/:promptId', async (req, res) => {
       const { prompt_text } = req.body;
       if (prompt_text === undefined) return res.status(400).send({ message: 'Missing prompt_text.' });
       const docRef = firestore.collection('prompts').doc(req.params.promptId);
-      await docRef.update({ prompt_text: prompt_text });
+      // The version is part of the functions' context cache keys.
+      await docRef.update({ prompt_text: prompt_text, version: FieldValue.increment(1) });
+      await firestore.collection('settings').doc('global_config').set({ settings_version: FieldValue.increment(1) }, { merge: true });
       res.status(200).send({ message: 'Prompt updated successfully.' });
   } catch (error) {
       console.error(`!!! Error updating prompt ${req.params.promptId}:`, error.message);
@@ -283,13 +496,14 @@ app.delete('/api/sows/:docId', async (req, res) => {
       }
     }
 
-    // 2. Delete the processed text file
-    const txtFilename = `${docId}.txt`;
-    try {
-      await storage.bucket('sow-forge-texas-dmv-processed-text').file(txtFilename).delete();
-      console.log(`Deleted GCS object: sow-forge-texas-dmv-processed-text/${txtFilename}`);
-    } catch (gcsError) {
-      console.warn(`Could not delete processed text file: ${gcsError.message}`);
+    // 2. Delete the processed text file and its page index
+    for (const txtFilename of [`${docId}.txt`, `${docId}.pages.json`]) {
+      try {
+        await storage.bucket('sow-forge-texas-dmv-processed-text').file(txtFilename).delete();
+        console.log(`Deleted GCS object: sow-forge-texas-dmv-processed-text/${txtFilename}`);
+      } catch (gcsError) {
+        console.warn(`Could not delete processed text file: ${gcsError.message}`);
+      }
     }
     
     // 3. Delete the batch output folder (if it exists)
@@ -303,8 +517,16 @@ app.delete('/api/sows/:docId', async (req, res) => {
       }
     }
 
-    // 4. Finally, delete the Firestore document
-    await docRef.delete();
+    // 4. Delete the offloaded analysis and SOW payloads
+    try {
+      const [files] = await storage.bucket(PAYLOAD_BUCKET).getFiles({ prefix: `sows/${docId}/` });
+      await Promise.all(files.map(file => file.delete()));
+    } catch (gcsError) {
+      console.warn(`Could not delete stored payloads: ${gcsError.message}`);
+    }
+
+    // 5. Finally, delete the Firestore document along with its stored chunk analyses
+    await firestore.recursiveDelete(docRef);
     console.log(`Deleted Firestore document: ${docId}`);
 
     res.status(200).send({ message: 'Document and all associated files deleted successfully.' });
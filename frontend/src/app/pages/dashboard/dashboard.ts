@@ -4,6 +4,9 @@ import { RouterModule } from '@angular/router';
 import { FormsModule } from '@angular/forms';
 import { ApiService } from '../../services/api.service';
 import { Subscription, timer } from 'rxjs';
+
+const PAGE_SIZE = 50;
+
 @Component({
   selector: 'app-dashboard',
   standalone: true,
@@ -13,7 +16,9 @@ import { Subscription, timer } from 'rxjs';
 })
 export class DashboardComponent implements OnInit, OnDestroy {
   sows: any[] = [];
+  nextPageToken: string | null = null;
   isLoading = true;
+  isLoadingMore = false;
   statusMessage = '';
   editingDocId: string | null = null;
   editingDocName: string = '';
@@ -21,7 +26,18 @@ export class DashboardComponent implements OnInit, OnDestroy {
   constructor(private apiService: ApiService) {}
   ngOnInit(): void { this.loadSows(); this.poller = timer(15000, 15000).subscribe(() => this.loadSows(false)); }
   ngOnDestroy(): void { if (this.poller) { this.poller.unsubscribe(); } }
-  loadSows(showLoadingSpinner: boolean = true): void { if (showLoadingSpinner) { this.isLoading = true; } this.apiService.getAllSows().subscribe({ next: (data) => { this.sows = data; if (showLoadingSpinner) this.isLoading = false; }, error: (err) => { this.statusMessage = 'Failed to load document history.'; console.error(err); if (showLoadingSpinner) this.isLoading = false; } }); }
+  loadSows(showLoadingSpinner: boolean = true): void { if (showLoadingSpinner) { this.isLoading = true; } this.apiService.getAllSows(Math.max(PAGE_SIZE, this.sows.length)).subscribe({ next: (data) => { this.sows = data.items; this.nextPageToken = data.nextPageToken; if (showLoadingSpinner) this.isLoading = false; }, error: (err) => { this.statusMessage = 'Failed to load document history.'; console.error(err); if (showLoadingSpinner) this.isLoading = false; } }); }
+  /**
+   * Appends the next page of documents. Polling refreshes as many rows as are shown.
+   */
+  loadMore(): void {
+    if (!this.nextPageToken || this.isLoadingMore) return;
+    this.isLoadingMore = true;
+    this.apiService.getAllSows(PAGE_SIZE, this.nextPageToken).subscribe({
+      next: (data) => { this.sows = [...this.sows, ...data.items]; this.nextPageToken = data.nextPageToken; this.isLoadingMore = false; },
+      error: (err) => { this.statusMessage = 'Failed to load more documents.'; console.error(err); this.isLoadingMore = false; }
+    });
+  }
   startEditingName(sow: any): void { this.editingDocId = sow.id; this.editingDocName = sow.display_name || sow.original_filename; }
   cancelEditing(): void { this.editingDocId = null; this.editingDocName = ''; }
   saveName(sowId: string): void { if (!this.editingDocName || !sowId) return; this.apiService.updateDocument(sowId, { display_name: this.editingDocName }).subscribe({ next: () => { this.statusMessage = 'Name updated.'; this.cancelEditing(); this.loadSows(false); setTimeout(() => this.statusMessage = '', 3000); }, error: (err) => { alert(`Failed to save name: ${err.message}`); this.cancelEditing(); } }); }
@@ -32,7 +48,29 @@ export class DashboardComponent implements OnInit, OnDestroy {
  */
 isProcessing(status: string): boolean {
   if (!status) return false;
-  return status.includes('PROCESSING') || status.includes('ANALYZING') || status.includes('REANALYSIS');
+  return status.includes('PROCESSING') || status.includes('ANALYZING') || status.includes('REANALYSIS') || status === 'ANALYSIS_PARTIAL';
+}
+
+/**
+ * Total seconds the pipeline functions spent on a document, from the
+ * per-function stage summaries under `timings`.
+ */
+totalSeconds(sow: any): number {
+  return Object.values(sow.timings || {}).reduce((sum: number, t: any) => sum + (t?.total_ms || 0), 0) / 1000;
+}
+
+/**
+ * One line per function with its slowest stages, shown as a tooltip.
+ */
+timingBreakdown(sow: any): string {
+  return Object.entries(sow.timings || {}).map(([fn, t]: [string, any]) => {
+    const stages = Object.entries(t || {})
+      .filter(([name]) => name !== 'total_ms')
+      .sort(([, a]: any, [, b]: any) => b.ms - a.ms)
+      .slice(0, 3)
+      .map(([name, s]: [string, any]) => `${name} ${(s.ms / 1000).toFixed(1)}s`);
+    return `${fn}: ${((t?.total_ms || 0) / 1000).toFixed(1)}s (${stages.join(', ')})`;
+  }).join('\n');
 }
 
 /**
@@ -50,17 +50,23 @@ export class EditorComponent implements OnInit {
   openInGoogleDocs(): void {
     if (!this.docId) return;
     if (this.sowDocument && this.sowDocument.google_doc_url) { window.open(this.sowDocument.google_doc_url, '_blank'); return; }
+    this.exportToGoogleDocs(true);
+  }
+  exportToGoogleDocs(openWhenDone = false): void {
+    if (!this.docId) return;
     this.isCreatingDoc = true;
-    this.saveStatusMessage = 'Creating Google Doc...';
+    this.saveStatusMessage = this.sowDocument?.google_doc_url ? 'Updating Google Doc...' : 'Creating Google Doc...';
     this.apiService.createGoogleDoc(this.docId).subscribe({
       next: (response: any) => {
         this.isCreatingDoc = false;
-        this.saveStatusMessage = 'Document created successfully!';
-        this.sowDocument.google_doc_url = response.doc_url; 
-        window.open(response.doc_url, '_blank');
+        this.saveStatusMessage = response.mode === 'created' ? 'Document created successfully!'
+          : response.mode === 'unchanged' ? 'Google Doc is already up to date.'
+          : `Google Doc updated (${response.sections_updated} sections changed).`;
+        this.sowDocument.google_doc_url = response.doc_url;
+        if (openWhenDone) window.open(response.doc_url, '_blank');
         setTimeout(() => this.saveStatusMessage = '', 3000);
       },
-      error: (err: any) => { this.isCreatingDoc = false; this.saveStatusMessage = `Error creating document: ${err.message}`; }
+      error: (err: any) => { this.isCreatingDoc = false; this.saveStatusMessage = `Error exporting document: ${err.message}`; }
     });
   }
 }
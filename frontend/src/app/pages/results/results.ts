@@ -18,6 +18,8 @@ export class ResultsComponent implements OnInit {
   templates: any[] = [];
   isGeneratingSow = false;
   statusMessage = '';
+  streamedSowText = '';
+  pageView: any = null;
 
   constructor(
     private route: ActivatedRoute,
@@ -46,8 +48,13 @@ export class ResultsComponent implements OnInit {
     if (!this.docId) return;
     this.isGeneratingSow = true;
     this.statusMessage = 'Generating SOW... This may take a minute.';
-    this.apiService.generateSow(this.docId, templateId).subscribe({
-      next: () => {
+    this.streamedSowText = '';
+    this.apiService.generateSowStream(this.docId, templateId).subscribe({
+      next: (sowText) => {
+        this.statusMessage = 'Generating SOW...';
+        this.streamedSowText = sowText;
+      },
+      complete: () => {
         this.isGeneratingSow = false;
         this.router.navigate(['/editor', this.docId]);
       },
@@ -58,6 +65,39 @@ export class ResultsComponent implements OnInit {
     });
   }
 
+  pageLabel(pages: { from: number, to: number }): string {
+    return pages.from === pages.to ? `p. ${pages.from}` : `pp. ${pages.from}-${pages.to}`;
+  }
+
+  showPages(pages: { from: number, to: number }): void {
+    if (!this.docId) return;
+    this.apiService.getPageText(this.docId, pages.from, pages.to).subscribe({
+      next: (data) => { this.pageView = data; },
+      error: (err) => { this.statusMessage = `Could not load pages: ${err.error?.message || err.message}`; }
+    });
+  }
+
+  canResume(): boolean {
+    return this.results?.status === 'ANALYSIS_PARTIAL' || this.results?.status === 'ANALYSIS_FAILED';
+  }
+
+  resumeAnalysis(): void {
+    if (!this.docId) return;
+    this.isGeneratingSow = true;
+    this.statusMessage = 'Resuming analysis from the last checkpoint...';
+    this.apiService.resumeAnalysis(this.docId).subscribe({
+        next: () => {
+            this.statusMessage = 'Analysis resumed. Only the remaining chunks will be analyzed.';
+            this.isGeneratingSow = false;
+            setTimeout(() => this.statusMessage = '', 5000);
+        },
+        error: (err) => {
+            this.statusMessage = `Error resuming analysis: ${err.error?.message || err.message}`;
+            this.isGeneratingSow = false;
+        }
+    });
+  }
+
   regenerateAnalysis(): void {
     if (!this.docId) return;
     this.isGeneratingSow = true;
@@ -26,5 +26,6 @@ export class TemplateManagerComponent implements OnInit {
   loadTemplates(): void { this.isLoadingTemplates = true; this.apiService.getTemplates().subscribe({ next: (data) => { this.existingTemplates = data; this.isLoadingTemplates = false; }, error: (err) => { console.error('Failed to load templates', err); this.isLoadingTemplates = false; } }); }
   onFilesSelected(event: any): void { if (event.target.files) { this.selectedFiles = Array.from(event.target.files); } }
   deleteTemplate(templateId: string, templateName: string): void { if (confirm(`Are you sure you want to delete "${templateName}"?`)) { this.apiService.deleteTemplate(templateId).subscribe({ next: () => { this.statusMessage = `Template deleted.`; this.loadTemplates(); }, error: (err: any) => { this.statusMessage = `Error: ${err.message}`; } }); } }
-  generateTemplate(): void { if (!this.newTemplateName || this.selectedFiles.length === 0) return; this.isGenerating = true; this.statusMessage = `Uploading ${this.selectedFiles.length} sample(s)...`; const uploadObs = this.selectedFiles.map(file => this.apiService.getUploadUrl(file.name, file.type, 'templates').pipe(switchMap(res => this.apiService.uploadFile(res.url, file)), filter(event => event.type === HttpEventType.Response), map(() => file.name))); forkJoin(uploadObs).pipe(catchError(err => { this.statusMessage = 'Error during upload.'; this.isGenerating = false; return of(null); })).subscribe(filenames => { if (filenames) { this.statusMessage = 'Triggering AI template generation...'; this.apiService.createTemplateFromSamples(this.newTemplateName, this.newTemplateDescription, filenames).subscribe({ next: () => { this.statusMessage = 'Template generated successfully!'; this.isGenerating = false; setTimeout(() => { this.newTemplateName = ''; this.newTemplateDescription = ''; this.selectedFiles = []; this.statusMessage = ''; this.loadTemplates(); }, 2000); }, error: (err: any) => { this.statusMessage = `AI generation failed: ${err.message}`; this.isGenerating = false; } }); } }); }
+  generateTemplate(): void { if (!this.newTemplateName || this.selectedFiles.length === 0) return; this.isGenerating = true; this.statusMessage = `Uploading ${this.selectedFiles.length} sample(s)...`; const uploadObs = this.selectedFiles.map(file => this.apiService.getUploadUrl(file.name, file.type, 'templates').pipe(switchMap(res => this.apiService.uploadFile(res.url, file)), filter(event => event.type === HttpEventType.Response), map(() => file.name))); forkJoin(uploadObs).pipe(catchError(err => { this.statusMessage = 'Error during upload.'; this.isGenerating = false; return of(null); })).subscribe(filenames => { if (filenames) { this.statusMessage = 'Triggering AI template generation...'; this.apiService.createTemplateFromSamples(this.newTemplateName, this.newTemplateDescription, filenames).pipe(switchMap(res => this.apiService.waitForJob(res.jobId))).subscribe({ next: (job: any) => { if (job.state === 'FAILED') { this.statusMessage = `AI generation failed: ${job.error}`; this.isGenerating = false; } else if (job.state === 'SUCCEEDED') { this.statusMessage = 'Template generated successfully!'; this.isGenerating = false; setTimeout(() => { this.newTemplateName = ''; this.newTemplateDescription = ''; this.selectedFiles = []; this.statusMessage = ''; this.loadTemplates(); }, 2000); } else { this.statusMessage = this.jobStatusMessage(job); } }, error: (err: any) => { this.statusMessage = `AI generation failed: ${err.message}`; this.isGenerating = false; } }); } }); }
+  jobStatusMessage(job: any): string { const stage = job.progress?.stage; if (stage === 'extracting_samples') return `Extracting text from ${job.progress.samples_total} sample(s)...`; if (stage === 'generating') return 'Generating the template with AI...'; return 'Waiting for the template job to start...'; }
 }
@@ -1,6 +1,7 @@
 import { Injectable } from '@angular/core';
-import { HttpClient, HttpRequest, HttpEvent } from '@angular/common/http';
-import { Observable } from 'rxjs';
+import { HttpClient, HttpRequest, HttpEvent, HttpEventType, HttpDownloadProgressEvent } from '@angular/common/http';
+import { Observable, timer } from 'rxjs';
+import { switchMap, takeWhile } from 'rxjs/operators';
 
 @Injectable({
   providedIn: 'root'
@@ -17,8 +18,11 @@ export class ApiService {
     const req = new HttpRequest('PUT', url, file, { reportProgress: true });
     return this.http.request(req);
   }
-  getAllSows(): Observable<any[]> {
-    return this.http.get<any[]>(`${this.apiUrl}/sows`);
+  getAllSows(pageSize?: number, pageToken?: string | null): Observable<{ items: any[]; nextPageToken: string | null }> {
+    const params: any = {};
+    if (pageSize) params.pageSize = pageSize;
+    if (pageToken) params.pageToken = pageToken;
+    return this.http.get<{ items: any[]; nextPageToken: string | null }>(`${this.apiUrl}/sows`, { params });
   }
   getAnalysisResults(docId: string): Observable<any> {
     return this.http.get(`${this.apiUrl}/results/${docId}`);
@@ -29,9 +33,65 @@ export class ApiService {
   regenerateAnalysis(docId: string): Observable<any> {
     return this.http.post(`${this.apiUrl}/regenerate/${docId}`, {});
   }
+  resumeAnalysis(docId: string): Observable<any> {
+    return this.http.post(`${this.apiUrl}/resume-analysis/${docId}`, {});
+  }
+  /** Text of pages `from`-`to` of a document's extracted text, read by byte range. */
+  getPageText(docId: string, from: number, to: number = from): Observable<any> {
+    return this.http.get(`${this.apiUrl}/documents/${docId}/pages`, { params: { from, to } });
+  }
   generateSow(docId: string, templateId: string): Observable<any> {
     return this.http.post(`${this.apiUrl}/generate-sow`, { docId, templateId }, { responseType: 'text' });
   }
+  /**
+   * Streaming variant of generateSow. Emits the SOW text accumulated so far each
+   * time the backend forwards more tokens, and completes once the full SOW has
+   * been saved to Firestore.
+   */
+  generateSowStream(docId: string, templateId: string): Observable<string> {
+    const req = new HttpRequest('POST', `${this.apiUrl}/generate-sow-stream`, { docId, templateId }, { reportProgress: true, responseType: 'text' });
+    return new Observable<string>(subscriber => {
+      let consumed = 0;
+      let sowText = '';
+      const handleFrames = (raw: string): boolean => {
+        // Only parse complete SSE frames; a partial frame is picked up on the next progress event.
+        const end = raw.lastIndexOf('\n\n');
+        if (end < consumed) return false;
+        const frames = raw.slice(consumed, end).split('\n\n');
+        consumed = end + 2;
+        for (const frame of frames) {
+          const eventLine = frame.split('\n').find(line => line.startsWith('event: '));
+          const dataLine = frame.split('\n').find(line => line.startsWith('data: '));
+          if (!eventLine || !dataLine) continue;
+          const event = eventLine.slice(7).trim();
+          const payload = JSON.parse(dataLine.slice(6));
+          if (event === 'token') {
+            sowText += payload.text;
+            subscriber.next(sowText);
+          } else if (event === 'error') {
+            subscriber.error(new Error(payload.message));
+            return true;
+          } else if (event === 'done') {
+            subscriber.complete();
+            return true;
+          }
+        }
+        return false;
+      };
+      const sub = this.http.request(req).subscribe({
+        next: (event: HttpEvent<any>) => {
+          if (event.type === HttpEventType.DownloadProgress) {
+            if (handleFrames((event as HttpDownloadProgressEvent).partialText || '')) sub.unsubscribe();
+          } else if (event.type === HttpEventType.Response) {
+            if (!handleFrames(`${event.body || ''}\n\n`)) subscriber.error(new Error('SOW stream ended unexpectedly.'));
+          }
+        },
+        error: (err) => subscriber.error(err)
+      });
+      return () => sub.unsubscribe();
+    });
+  }
+
   getTemplates(): Observable<any[]> {
     return this.http.get<any[]>(`${this.apiUrl}/templates`);
   }
@@ -44,9 +104,20 @@ export class ApiService {
   deleteTemplate(templateId: string): Observable<any> {
     return this.http.delete(`${this.apiUrl}/templates/${templateId}`);
   }
-  createTemplateFromSamples(name: string, desc: string, paths: string[]): Observable<any> {
-    const payload = { template_name: name, template_description: desc, sample_files: paths };
-    return this.http.post(`${this.apiUrl}/generate-template`, payload);
+  /** Starts template generation as a job; resolves to { jobId } at once when a task queue is configured, otherwise once the job has run. */
+  createTemplateFromSamples(name: string, desc: string, paths: string[]): Observable<{ jobId: string }> {
+    const payload = { template_name: name, template_description: desc, sample_files: paths, async: true };
+    return this.http.post<{ jobId: string }>(`${this.apiUrl}/generate-template`, payload);
+  }
+  getJob(jobId: string): Observable<any> {
+    return this.http.get(`${this.apiUrl}/jobs/${jobId}`);
+  }
+  /** Polls a job, emitting it on every poll until it has succeeded or failed. */
+  waitForJob(jobId: string, intervalMs = 3000): Observable<any> {
+    return timer(0, intervalMs).pipe(
+      switchMap(() => this.getJob(jobId)),
+      takeWhile(job => job.state !== 'SUCCEEDED' && job.state !== 'FAILED', true)
+    );
   }
   getSettings(): Observable<any> {
     return this.http.get(`${this.apiUrl}/settings`);
@@ -64,12 +135,13 @@ export class ApiService {
     return this.http.put(`${this.apiUrl}/prompts/${promptId}`, { prompt_text: newPromptText });
   }
   /**
- * Asks the backend to create a new Google Doc from the SOW text.
+ * Exports the SOW text to Google Docs. The first export creates the document;
+ * later ones update the linked document, rewriting only the changed sections.
  * @param docId The ID of the SOW document in Firestore.
- * @returns An Observable containing the URL of the newly created Google Doc.
+ * @returns An Observable containing the URL of the Google Doc and how it was exported.
  */
-  createGoogleDoc(docId: string): Observable<{ doc_url: string }> {
-    return this.http.post<{ doc_url: string }>(`${this.apiUrl}/create-google-doc`, { docId });
+  createGoogleDoc(docId: string): Observable<{ doc_url: string, mode: string, sections_updated: number }> {
+    return this.http.post<{ doc_url: string, mode: string, sections_updated: number }>(`${this.apiUrl}/create-google-doc`, { docId });
   }
  
   deleteSow(sowId: string): Observable<any> {
@@ -13,7 +13,8 @@ resource "google_project_service" "enabled_apis" {
     "artifactregistry.googleapis.com",
     "logging.googleapis.com",
     "pubsub.googleapis.com",
-    "docs.googleapis.com"
+    "docs.googleapis.com",
+    "cloudtasks.googleapis.com"
   ])
 
   project                    = var.gcp_project_id
@@ -197,4 +197,35 @@ resource "google_cloudfunctions2_function" "create_google_doc" {
     all_traffic_on_latest_revision = true
     service_account_email          = google_service_account.master_sa.email
   }
-}
\ No newline at end of file
+}
+
+# ------------------------------------------------------------------
+# Function #7: Bulk Ingestion (HTTP Trigger)
+# Shares its source with doc_preprocess_trigger. Uploads under the 'bulk/'
+# prefix are OCR'd as multi-document batches; a '.manifest.json' upload
+# there starts the same ingestion through doc_preprocess_trigger.
+# ------------------------------------------------------------------
+resource "google_cloudfunctions2_function" "bulk_ingest" {
+  project  = var.gcp_project_id
+  name     = "bulk-ingest"
+  location = var.gcp_region
+
+  build_config {
+    runtime     = "python310"
+    entry_point = "bulk_ingest"
+    source {
+      storage_source {
+        bucket = google_storage_bucket.app_buckets["functions_source"].name
+        object = "doc_preprocess_trigger.zip"
+      }
+    }
+  }
+
+  service_config {
+    max_instance_count             = 1
+    available_memory               = "512Mi"
+    timeout_seconds                = 540
+    all_traffic_on_latest_revision = true
+    service_account_email          = google_service_account.master_sa.email
+  }
+}
@@ -4,4 +4,108 @@ resource "google_firestore_database" "database" {
   location_id = var.firestore_location # Use variable
   type        = "FIRESTORE_NATIVE"
   depends_on  = [google_project_service.enabled_apis]
-}
\ No newline at end of file
+}
+
+# Expire cached Gemini responses (see backend/shared/llm_cache.py)
+resource "google_firestore_field" "llm_cache_ttl" {
+  project    = var.gcp_project_id
+  database   = google_firestore_database.database.name
+  collection = "llm_cache"
+  field      = "expires_at"
+
+  ttl_config {}
+}
+
+# Expire processed-event leases (see backend/shared/idempotency.py)
+resource "google_firestore_field" "event_leases_ttl" {
+  project    = var.gcp_project_id
+  database   = google_firestore_database.database.name
+  collection = "event_leases"
+  field      = "expires_at"
+
+  ttl_config {}
+}
+
+# Expire finished async jobs (see backend/shared/jobs.py)
+resource "google_firestore_field" "jobs_ttl" {
+  project    = var.gcp_project_id
+  database   = google_firestore_database.database.name
+  collection = "jobs"
+  field      = "expires_at"
+
+  ttl_config {}
+}
+
+# Expire per-minute Vertex AI budget windows (see backend/shared/rate_limiter.py)
+resource "google_firestore_field" "vertex_quota_ttl" {
+  project    = var.gcp_project_id
+  database   = google_firestore_database.database.name
+  collection = "vertex_quota"
+  field      = "expires_at"
+
+  ttl_config {}
+}
+
+# Earlier versions of a bill, newest first (see backend/legislative_analysis_func/chunk_store.py)
+resource "google_firestore_index" "sows_bill_key_created_at" {
+  project    = var.gcp_project_id
+  database   = google_firestore_database.database.name
+  collection = "sows"
+
+  fields {
+    field_path = "bill_key"
+    order      = "ASCENDING"
+  }
+
+  fields {
+    field_path = "created_at"
+    order      = "DESCENDING"
+  }
+}
+
+# Expire records of Vertex AI context caches (see backend/shared/context_cache.py)
+resource "google_firestore_field" "context_caches_ttl" {
+  project    = var.gcp_project_id
+  database   = google_firestore_database.database.name
+  collection = "context_caches"
+  field      = "expires_at"
+
+  ttl_config {}
+}
+
+# Dashboard listing without template samples, newest first (see frontend/server.js)
+resource "google_firestore_index" "sows_template_sample_created_at" {
+  project    = var.gcp_project_id
+  database   = google_firestore_database.database.name
+  collection = "sows"
+
+  fields {
+    field_path = "is_template_sample"
+    order      = "ASCENDING"
+  }
+
+  fields {
+    field_path = "created_at"
+    order      = "DESCENDING"
+  }
+}
+
+# Expire bulk batch input mappings (see backend/shared/bulk_batches.py)
+resource "google_firestore_field" "bulk_batches_ttl" {
+  project    = var.gcp_project_id
+  database   = google_firestore_database.database.name
+  collection = "bulk_batches"
+  field      = "expires_at"
+
+  ttl_config {}
+}
+
+# Expire batch output shard progress (see backend/batch_result_handler/main.py)
+resource "google_firestore_field" "batch_shard_progress_ttl" {
+  project    = var.gcp_project_id
+  database   = google_firestore_database.database.name
+  collection = "batch_shard_progress"
+  field      = "expires_at"
+
+  ttl_config {}
+}
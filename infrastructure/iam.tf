@@ -29,7 +29,8 @@ resource "google_project_iam_member" "master_sa_roles" {
     "roles/iam.serviceAccountUser",
     "roles/eventarc.eventReceiver",
     "roles/run.invoker",
-    "roles/cloudfunctions.invoker"
+    "roles/cloudfunctions.invoker",
+    "roles/cloudtasks.enqueuer"
   ])
   project = var.gcp_project_id
   role    = each.key
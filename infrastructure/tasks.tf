@@ -0,0 +1,26 @@
+# ------------------------------------------------------------------
+# Async job queue for generate_sow and generate_template
+# (see backend/shared/jobs.py). Point the 'jobs_task_queue' setting at
+# projects/<project>/locations/<region>/queues/sow-forge-jobs and set
+# 'generate_sow_function_url' / 'generate_template_function_url' to the
+# functions' URLs to dispatch jobs through it.
+# ------------------------------------------------------------------
+resource "google_cloud_tasks_queue" "jobs" {
+  project  = var.gcp_project_id
+  name     = "sow-forge-jobs"
+  location = var.gcp_region
+
+  # Bounds how many Gemini-heavy jobs run at once across all instances.
+  rate_limits {
+    max_concurrent_dispatches = 6
+    max_dispatches_per_second = 2
+  }
+
+  retry_config {
+    max_attempts = 3
+    min_backoff  = "10s"
+    max_backoff  = "300s"
+  }
+
+  depends_on = [google_project_service.enabled_apis]
+}
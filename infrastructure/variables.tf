@@ -68,5 +68,6 @@ variable "bucket_names" {
     template_samples = "template-samples"
     templates        = "templates"
     batch_output     = "batch-output"
+    payloads         = "payloads"
   }
 }
\ No newline at end of file